@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Time CeresNode.read on nodes fragmented into a growing number of slices.
+
+Each node holds the same week of minutely data split into N slices. With the
+'index' slice caching behavior the read latency should stay flat as N grows.
+"""
+
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ceres import CeresTree, DATAPOINT_FORMAT
+
+
+TIMESTEP = 60
+POINTS = 7 * 24 * 60
+START = 1400000000 - (1400000000 % TIMESTEP)
+
+
+def build_node(tree, nodePath, sliceCount):
+  node = tree.createNode(nodePath, timeStep=TIMESTEP)
+  pointsPerSlice = POINTS / sliceCount
+  packed = struct.pack(DATAPOINT_FORMAT, 1.0) * pointsPerSlice
+  for i in xrange(sliceCount):
+    startTime = START + i * pointsPerSlice * TIMESTEP
+    with open(os.path.join(node.fsPath, '%d@%d.slice' % (startTime, TIMESTEP)), 'wb') as fh:
+      fh.write(packed)
+  return node
+
+
+def time_reads(node, fromTime, untilTime, repeat):
+  node.read(fromTime, untilTime)  # warm up caches
+  started = time.time()
+  for i in xrange(repeat):
+    node.read(fromTime, untilTime)
+  return (time.time() - started) / repeat
+
+
+def main():
+  parser = OptionParser(usage='%prog [options]')
+  parser.add_option('--repeat', default=200, type='int')
+  parser.add_option('--slices', default='1,10,100,1000')
+  parser.add_option('--window', default=3600, type='int', help="Seconds read from the middle of the data")
+  options, args = parser.parse_args()
+
+  root = tempfile.mkdtemp()
+  try:
+    tree = CeresTree.createTree(root)
+    fromTime = START + (POINTS * TIMESTEP) / 2
+    untilTime = fromTime + options.window
+
+    print "%8s %14s %14s" % ('slices', 'none (ms)', 'index (ms)')
+    for sliceCount in [int(n) for n in options.slices.split(',')]:
+      node = build_node(tree, 'bench.read.slices%d' % sliceCount, sliceCount)
+      results = []
+      for behavior in ('none', 'index'):
+        node.setSliceCachingBehavior(behavior)
+        results.append(time_reads(node, fromTime, untilTime, options.repeat) * 1000)
+      print "%8d %14.3f %14.3f" % (sliceCount, results[0], results[1])
+  finally:
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+  main()
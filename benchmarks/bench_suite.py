@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""Time the core Ceres operations on synthetic trees built in a temp dir.
+
+Results are printed as a table, and with --json written as a JSON document
+that a later run can be checked against with --compare:
+
+  bench_suite.py --json baseline.json
+  bench_suite.py --compare baseline.json --threshold 1.25
+
+--compare exits with status 1 when any benchmark's median time grew by more
+than the threshold factor.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import struct
+import platform
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ceres
+from ceres import CeresTree, DATAPOINT_FORMAT, MAX_SLICE_GAP, recalculateSeries
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+TIMESTEP = 60
+START = 1400000000 - (1400000000 % TIMESTEP)
+BENCHMARKS = []
+
+
+def benchmark(function):
+  BENCHMARKS.append(function)
+  return function
+
+
+def measure(function, repeat, setup=None):
+  """Time `repeat` calls of `function`, calling `setup` untimed before each
+  and passing on what it returns"""
+  timings = []
+  for i in xrange(repeat):
+    args = () if setup is None else (setup(),)
+    started = time.time()
+    function(*args)
+    timings.append(time.time() - started)
+  timings.sort()
+  return {
+    'repeat': repeat,
+    'min': timings[0],
+    'median': timings[len(timings) / 2],
+    'mean': sum(timings) / len(timings),
+  }
+
+
+def write_slices(node, slices, timeStep=TIMESTEP, value=1.0):
+  """Write (startTime, points) slices of a constant value straight to disk"""
+  for startTime, points in slices:
+    path = os.path.join(node.fsPath, '%d@%d.slice' % (startTime, timeStep))
+    with open(path, 'wb') as fh:
+      fh.write(struct.pack(DATAPOINT_FORMAT, value) * points)
+  node.clearSliceCache()
+
+
+class Context(object):
+  def __init__(self, root, options):
+    self.root = root
+    self.options = options
+    self.tree = CeresTree.createTree(root)
+    self.results = []
+    self.count = 0
+
+  def newNode(self, prefix, **properties):
+    self.count += 1
+    properties.setdefault('timeStep', TIMESTEP)
+    return self.tree.createNode('%s.n%d' % (prefix, self.count), **properties)
+
+  def record(self, name, params, timing):
+    result = dict(timing, name=name, params=params)
+    self.results.append(result)
+    print "%-64s %12.3f %12.3f %8d" % (label(result), timing['median'] * 1000,
+                                       timing['min'] * 1000, timing['repeat'])
+    sys.stdout.flush()
+
+
+def label(result):
+  params = ','.join('%s=%s' % item for item in sorted(result['params'].items()))
+  return '%s[%s]' % (result['name'], params) if params else result['name']
+
+
+@benchmark
+def bench_write(ctx):
+  points = ctx.options.write_points
+  batch = 60
+  inOrder = [(START + i * TIMESTEP, float(i)) for i in xrange(points)]
+
+  outOfOrder = list(inOrder)
+  rng = random.Random(0)
+  for i in xrange(0, points, batch):  # shuffled within each batch, batches arrive late
+    chunk = outOfOrder[i:i + batch]
+    rng.shuffle(chunk)
+    outOfOrder[i:i + batch] = chunk
+  batches = [outOfOrder[i:i + batch] for i in xrange(0, points, batch)]
+  for i in xrange(0, len(batches) - 1, 2):
+    batches[i], batches[i + 1] = batches[i + 1], batches[i]
+  outOfOrder = [datapoint for datapoints in batches for datapoint in datapoints]
+
+  gappy = []
+  t = START
+  for i in xrange(points):
+    gappy.append((t, float(i)))
+    t += TIMESTEP * (MAX_SLICE_GAP * 2 if rng.random() < 0.01 else 1)
+
+  for name, datapoints in (('in-order', inOrder), ('out-of-order', outOfOrder), ('gappy', gappy)):
+    def run(node):
+      for i in xrange(0, len(datapoints), batch):
+        node.write(datapoints[i:i + batch])
+    timing = measure(run, ctx.options.repeat, lambda: ctx.newNode('write'))
+    ctx.record('write', {'input': name, 'points': points, 'batch': batch}, timing)
+
+
+@benchmark
+def bench_compact(ctx):
+  points = ctx.options.compact_points
+  rng = random.Random(0)
+  datapoints = [(START + rng.randint(0, points * 2) * TIMESTEP, 1.0) for i in xrange(points)]
+  node = ctx.newNode('compact')
+  node.readMetadata()
+  timing = measure(lambda: node.compact(datapoints), ctx.options.repeat)
+  ctx.record('compact', {'points': points}, timing)
+
+
+@benchmark
+def bench_read(ctx):
+  points = ctx.options.read_points
+  for sliceCount in (1, 10, 100, 1000):
+    node = ctx.newNode('read')
+    perSlice = points / sliceCount
+    write_slices(node, [(START + i * perSlice * TIMESTEP, perSlice) for i in xrange(sliceCount)])
+    untilTime = START + points * TIMESTEP
+    for asArray in (False, True) if numpy is not None else (False,):
+      node.read(START, untilTime, asArray=asArray)  # warm up caches
+      timing = measure(lambda: node.read(START, untilTime, asArray=asArray), ctx.options.repeat)
+      ctx.record('read', {'slices': sliceCount, 'points': points, 'asArray': asArray}, timing)
+
+  # the recent half at the node's timeStep, the older half rolled up to 5 minutes
+  node = ctx.newNode('read')
+  coarseStep = TIMESTEP * 5
+  middle = START + (points / 2) * TIMESTEP
+  coarseStart = START - START % coarseStep
+  write_slices(node, [(coarseStart, (middle - coarseStart) / coarseStep)], timeStep=coarseStep)
+  write_slices(node, [(middle, points / 2)])
+  untilTime = START + points * TIMESTEP
+  node.read(START, untilTime)
+  timing = measure(lambda: node.read(START, untilTime), ctx.options.repeat)
+  ctx.record('read', {'slices': 2, 'points': points, 'timeSteps': '60,300'}, timing)
+
+
+@benchmark
+def bench_find(ctx):
+  nodeCount = ctx.options.find_nodes
+  root = os.path.join(ctx.root, 'findtree')
+  os.mkdir(root)
+  tree = CeresTree.createTree(root)
+  width = int(round(nodeCount ** (1.0 / 3)))
+  metadata = json.dumps({'timeStep': TIMESTEP})
+  for a in xrange(width):
+    for b in xrange(width):
+      for c in xrange(width):
+        fsPath = os.path.join(root, 'host%d' % a, 'cpu%d' % b, 'metric%d' % c)
+        os.makedirs(fsPath)
+        with open(os.path.join(fsPath, '.ceres-node'), 'w') as fh:
+          fh.write(metadata)
+  nodeCount = width ** 3
+
+  patterns = ('host1.cpu2.metric3', 'host1.*.metric3', 'host*.cpu1.metric*', '*.*.metric{1,2}')
+  for indexed in (False, True):
+    if indexed:
+      tree.rebuildNameIndex()
+    for pattern in patterns:
+      def run():
+        tree.nodeCache.clear()
+        for node in tree.find(pattern):
+          pass
+      timing = measure(run, ctx.options.repeat)
+      ctx.record('find', {'nodes': nodeCount, 'pattern': pattern, 'nameIndex': indexed}, timing)
+
+
+@benchmark
+def bench_delete_before(ctx):
+  points = ctx.options.delete_points
+  for fallocate in (True, False):
+    if fallocate and ceres.fallocate is None:
+      continue
+
+    def setup():
+      node = ctx.newNode('delete')
+      write_slices(node, [(START, points)])
+      return node
+
+    def run(node):
+      node.deleteBefore(START + (points / 2) * TIMESTEP)
+
+    saved = ceres.fallocate
+    if not fallocate:
+      ceres.fallocate = None
+    try:
+      timing = measure(run, ctx.options.repeat, setup)
+    finally:
+      ceres.fallocate = saved
+    ctx.record('deleteBefore', {'points': points, 'fallocate': fallocate}, timing)
+
+
+@benchmark
+def bench_recalculate(ctx):
+  points = ctx.options.recalculate_points
+  rng = random.Random(0)
+  values = [None if rng.random() < 0.1 else rng.random() for i in xrange(points)]
+  inputs = [('list', values)]
+  if numpy is not None:
+    inputs.append(('array', ceres.toArray(values)))
+  for kind, series in inputs:
+    for method in ('avg', 'max'):
+      timing = measure(lambda: recalculateSeries(series, TIMESTEP, TIMESTEP * 5, method),
+                       ctx.options.repeat)
+      ctx.record('recalculateSeries', {'points': points, 'input': kind, 'method': method}, timing)
+
+
+def compare(results, baselineFile, threshold):
+  """Print how each median changed against a baseline, returning the number
+  of regressions beyond `threshold`"""
+  with open(baselineFile) as fh:
+    baseline = json.load(fh)
+  previous = dict((json.dumps([r['name'], r['params']], sort_keys=True), r)
+                  for r in baseline['results'])
+
+  regressions = 0
+  print
+  print "%-64s %12s %12s %8s" % ('compared to %s' % os.path.basename(baselineFile), 'before (ms)',
+                                 'after (ms)', 'ratio')
+  for result in results:
+    before = previous.get(json.dumps([result['name'], result['params']], sort_keys=True))
+    if before is None or not before['median']:
+      continue
+    ratio = result['median'] / before['median']
+    flag = ''
+    if ratio > threshold:
+      regressions += 1
+      flag = ' REGRESSION'
+    print "%-64s %12.3f %12.3f %8.2f%s" % (label(result), before['median'] * 1000,
+                                           result['median'] * 1000, ratio, flag)
+  return regressions
+
+
+def main():
+  parser = OptionParser(usage='%prog [options]')
+  parser.add_option('--only', default=None,
+                    help="Comma separated benchmarks to run: %s" %
+                         ', '.join(f.__name__[len('bench_'):] for f in BENCHMARKS))
+  parser.add_option('--repeat', default=5, type='int', help="Timed runs of each benchmark")
+  parser.add_option('--quick', action='store_true', help="Use small inputs for a fast smoke run")
+  parser.add_option('--json', default=None, help="Write the results to this file")
+  parser.add_option('--compare', default=None, help="A previous --json file to compare with")
+  parser.add_option('--threshold', default=1.25, type='float',
+                    help="Median slowdown factor counted as a regression (default %default)")
+  parser.add_option('--write-points', default=100000, type='int')
+  parser.add_option('--compact-points', default=100000, type='int')
+  parser.add_option('--read-points', default=100000, type='int')
+  parser.add_option('--find-nodes', default=100000, type='int')
+  parser.add_option('--delete-points', default=10000000, type='int')
+  parser.add_option('--recalculate-points', default=1000000, type='int')
+  options, args = parser.parse_args()
+
+  if options.quick:
+    for name in ('write_points', 'compact_points', 'read_points', 'find_nodes', 'recalculate_points'):
+      setattr(options, name, min(getattr(options, name), 10000))
+    options.delete_points = min(options.delete_points, 100000)
+
+  selected = BENCHMARKS
+  if options.only:
+    names = set(options.only.split(','))
+    selected = [f for f in BENCHMARKS if f.__name__[len('bench_'):] in names]
+
+  root = tempfile.mkdtemp()
+  try:
+    ctx = Context(root, options)
+    print "%-64s %12s %12s %8s" % ('benchmark', 'median (ms)', 'min (ms)', 'repeat')
+    for function in selected:
+      function(ctx)
+  finally:
+    shutil.rmtree(root)
+
+  if options.json:
+    document = {
+      'meta': {
+        'time': int(time.time()),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': numpy.__version__ if numpy is not None else None,
+        'options': dict((k, v) for k, v in vars(options).items() if k not in ('json', 'compare')),
+      },
+      'results': ctx.results,
+    }
+    with open(options.json, 'w') as fh:
+      json.dump(document, fh, indent=2, sort_keys=True)
+
+  if options.compare and compare(ctx.results, options.compare, options.threshold):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
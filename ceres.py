@@ -14,17 +14,56 @@
 #
 #
 
-# Ceres requires Python 2.6 or newer
+# Ceres requires Python 2.7 or newer
+import atexit
 import os
+import re
+import sqlite3
 import struct
+import tempfile
 import json
+import cPickle as pickle
 import errno
+import mmap
+import multiprocessing
+import socket
+import threading
 import time
-from math import isnan
+import weakref
+from math import isnan, isinf
+from hashlib import md5
+from Queue import Empty
 from itertools import izip
 from os.path import isdir, exists, join, dirname, abspath, getsize, getmtime
-from glob import glob
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  from concurrent import futures
+except ImportError:
+  futures = None
+
+try:
+  import whisper
+except ImportError:
+  whisper = None
+
+try:
+  import ctypes
+  import ctypes.util
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  fallocate = libc.fallocate64
+  fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+except (ImportError, OSError, AttributeError):
+  fallocate = None
 
 
 TIMESTAMP_FORMAT = "!L"
@@ -32,10 +71,52 @@ TIMESTAMP_SIZE = struct.calcsize(TIMESTAMP_FORMAT)
 DATAPOINT_FORMAT = "!d"
 DATAPOINT_SIZE = struct.calcsize(DATAPOINT_FORMAT)
 NAN = float('nan')
+INF = float('inf')
 PACKED_NAN = struct.pack(DATAPOINT_FORMAT, NAN)
+DATAPOINT_DTYPE = '>f8'
+DEFAULT_DATA_TYPE = 'float64'
+AGGREGATION_METHODS = ('avg', 'sum', 'min', 'max', 'last', 'count')
+AGGREGATION_METHOD_ALIASES = {'average': 'avg'}
+# whisper methods without a ceres equivalent are imported as the closest one
+WHISPER_AGGREGATION_METHODS = {'average': 'avg', 'avg_zero': 'avg', 'absmax': 'max', 'absmin': 'min'}
+DEFAULT_AGGREGATION_METHOD = 'avg'
+INT64_NULL = -2 ** 63
+SLICE_SUFFIX = '.slice'
+COMPRESSED_SLICE_SUFFIX = '.cslice'
+WHISPER_SUFFIX = '.wsp'
+COMPRESSED_SLICE_MAGIC = 'CSL1'
+COMPRESSED_HEADER_FORMAT = '!4sLHL'  # magic, pointCount, blockPoints, blockCount
+COMPRESSED_HEADER_SIZE = struct.calcsize(COMPRESSED_HEADER_FORMAT)
+COMPRESSED_OFFSET_SIZE = struct.calcsize('!L')
+COMPRESSED_BLOCK_POINTS = 256
 MAX_SLICE_GAP = 80
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+TRIM_CHUNK_SIZE = 1024 * 1024  # bytes copied at a time when trimming a slice in place
+DEFAULT_READ_CHUNK_POINTS = 65536
+DEFAULT_MERGE_MAX_GAP = 512  # points of padding, a 4KiB block of float64 values
 DEFAULT_TIMESTEP = 60
 DEFAULT_SLICE_CACHING_BEHAVIOR = 'none'
+DEFAULT_NODE_CACHE_SIZE = 100000
+DEFAULT_NODE_CACHE_NEGATIVE_TTL = 5
+READ_CACHE_ENTRY_OVERHEAD = 256  # approximate bytes per cached read besides its values
+MTIME_GRANULARITY = 1  # seconds, files modified more recently than this are not trusted by mtime
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # histogram bucket upper bounds in seconds
+LATENCY_PERCENTILES = (50, 90, 99)
+DEFAULT_STATS_INTERVAL = 60
+DEFAULT_STATS_PREFIX = 'ceres'
+DEFAULT_FETCH_THREADS = 8
+DEFAULT_FIND_THREADS = 4
+FIND_PARALLEL_WIDTH = 16
+NAME_INDEX_FILE = 'names'
+EXTENT_CATALOG_FILE = 'extents.db'
+DEFAULT_EXTENT_FLUSH_INTERVAL = 5
+DEFAULT_EXTENT_FLUSH_SIZE = 1000
+INDEX_RECHECK_INTERVAL = 5  # seconds between looking for an index or catalog built elsewhere
+DEFAULT_WRITE_BUFFER_POINTS = 60
+DEFAULT_WRITE_BUFFER_AGE = 60
+WRITE_BUFFER_FLUSH_ORDERS = ('oldest', 'largest')
+SLICE_CACHING_BEHAVIORS = ('none', 'all', 'latest', 'index')
 SLICE_PERMS = 0644
 DIR_PERMS = 0755
 
@@ -53,7 +134,20 @@ class CeresTree:
       self.root = abspath(root)
     else:
       raise ValueError("Invalid root directory '%s'" % root)
-    self.nodeCache = {}
+    self.nodeCache = NodeCache(DEFAULT_NODE_CACHE_SIZE, DEFAULT_NODE_CACHE_NEGATIVE_TTL)
+    self.sliceMapPool = None
+    self.readCache = None
+    self.maxSlicePoints = None
+    self.fetchThreads = DEFAULT_FETCH_THREADS
+    self.fetchPool = None
+    self.findThreads = DEFAULT_FIND_THREADS
+    self.findPool = None
+    self.storePool = None
+    self.instrumentation = None
+    self.nameIndex = None
+    self.extentCatalog = None
+    self.indexesChecked = None
+    self.loadIndexes()
 
   def __repr__(self):
     return "<CeresTree[0x%x]: %s>" % (id(self), self.root)
@@ -81,6 +175,285 @@ class CeresTree:
 
     return cls(root)
 
+  def setNodeCacheSize(self, maxSize, negativeTTL=DEFAULT_NODE_CACHE_NEGATIVE_TTL):
+    """Replace the node cache with one of a different size
+
+      :param maxSize: The maximum number of cached nodes and missing metric
+                      names, least recently used entries are evicted first.
+                      `None` leaves the cache unbounded.
+      :param negativeTTL: How many seconds a metric name that is not a node
+                          is remembered as missing. `0` disables negative entries.
+    """
+    self.nodeCache = NodeCache(maxSize, negativeTTL)
+
+  def setSliceMapPoolSize(self, maxSize):
+    """Serve slice reads from a pool of memory-mapped slice files
+
+      :param maxSize: The maximum number of slice files kept mapped at once,
+                      least recently used files are unmapped first. `0` or
+                      `None` disables the pool.
+    """
+    if self.sliceMapPool is not None:
+      self.sliceMapPool.clear()
+
+    if maxSize:
+      self.sliceMapPool = SliceMapPool(maxSize)
+    else:
+      self.sliceMapPool = None
+
+  def setReadCacheSize(self, maxBytes):
+    """Cache the results of node reads, see :class:`ReadCache`
+
+      :param maxBytes: The approximate memory the cached results may take up,
+                       least recently used results are evicted first. `0` or
+                       `None` disables the cache.
+    """
+    if maxBytes:
+      self.readCache = ReadCache(maxBytes)
+    else:
+      self.readCache = None
+
+  def setMaxSlicePoints(self, maxPoints):
+    """Cap how many datapoints a slice spans in nodes whose `maxSlicePoints`
+    metadata doesn't set their own cap
+
+    Slices then end at multiples of `maxPoints` times their timeStep, and
+    :meth:`CeresNode.write` starts a new slice at each such boundary. Old
+    data can then mostly be dropped by unlinking whole slices rather than
+    rewriting them.
+
+      :param maxPoints: The most datapoints in a slice, `None` for no limit
+    """
+    self.maxSlicePoints = getMaxSlicePoints(maxPoints)
+
+  def setInstrumentation(self, enabled=True):
+    """Count filesystem operations and time tree and node operations, see
+    :class:`Instrumentation`. Worker processes, such as those of
+    :meth:`setStoreProcesses` and :meth:`mapNodes`, are not instrumented.
+
+      :param enabled: Whether to instrument the tree. Enabling it again
+                      starts the counts over.
+    """
+    if enabled:
+      self.instrumentation = Instrumentation()
+    else:
+      self.instrumentation = None
+
+  def stats(self):
+    """Returns a snapshot of the tree's instrumentation as described in
+    :meth:`Instrumentation.stats`, or `None` when it is not instrumented"""
+    if self.instrumentation is None:
+      return None
+    return self.instrumentation.stats()
+
+  def loadIndexes(self, force=True):
+    """Open the name index and extent catalog if they have been built, which
+    may have happened in another process since this tree was opened. Unless
+    `force` is set this looks on disk at most every
+    :const:`INDEX_RECHECK_INTERVAL` seconds."""
+    now = time.time()
+    if not force and now - self.indexesChecked < INDEX_RECHECK_INTERVAL:
+      return
+    self.indexesChecked = now
+
+    ceresDir = join(self.root, '.ceres-tree')
+    if self.nameIndex is None and exists(join(ceresDir, NAME_INDEX_FILE)):
+      self.nameIndex = MetricNameIndex(self)
+    if self.extentCatalog is None and exists(join(ceresDir, EXTENT_CATALOG_FILE)):
+      self.extentCatalog = ExtentCatalog(self)
+
+  def close(self):
+    """Write out the extent catalog's batched changes and shut down the
+    tree's thread and worker pools"""
+    if self.extentCatalog is not None:
+      self.extentCatalog.close()
+    for pool in (self.fetchPool, self.findPool):
+      if pool is not None:
+        pool.close()
+    self.fetchPool = self.findPool = None
+    if self.storePool is not None:
+      self.storePool.close()
+      self.storePool = None
+
+  def rebuildNameIndex(self):
+    """Build the persistent metric name index from the nodes on disk, after
+    which :meth:`find` resolves patterns against it. See :class:`MetricNameIndex`."""
+    if self.nameIndex is None:
+      self.nameIndex = MetricNameIndex(self)
+    self.nameIndex.rebuild()
+
+  def rebuildExtentCatalog(self):
+    """Build the catalog of each node's data extents from the slices on
+    disk, after which time-filtered :meth:`find` calls consult it. See
+    :class:`ExtentCatalog`."""
+    if self.extentCatalog is None:
+      self.extentCatalog = ExtentCatalog(self)
+    self.extentCatalog.rebuild()
+
+  def rollup(self, nodePattern=None, processes=1, checkpoint=None, now=None):
+    """Run :meth:`CeresNode.rollup` over the tree, or the nodes matching a
+    pattern, in a pool of worker processes
+
+      :param nodePattern: Optional pattern limiting the nodes rolled up
+      :param processes: How many nodes are rolled up at once
+      :param checkpoint: Optional file recording the nodes already rolled up.
+                         An interrupted run given the same file resumes where
+                         it stopped. The file is removed once the run completes.
+      :param now: The time retentions are measured back from, defaults to now
+
+      :returns: A dict of metric name to the number of datapoints rolled up,
+                or to the exception rolling it up raised, for the nodes
+                handled by this run
+    """
+    if now is None:
+      now = int(time.time())
+    return self.mapNodes('rollup', (now,), nodePattern, processes, checkpoint)
+
+  def defragment(self, nodePattern=None, processes=1, checkpoint=None,
+                 maxGap=DEFAULT_MERGE_MAX_GAP, includeLatest=False):
+    """Run :meth:`CeresNode.defragment` over the tree, or the nodes matching
+    a pattern, in a pool of worker processes. See :meth:`rollup` for the
+    `processes` and `checkpoint` parameters.
+
+      :returns: A dict of metric name to the number of slices merged away,
+                or to the exception defragmenting it raised
+    """
+    return self.mapNodes('defragment', (maxGap, includeLatest), nodePattern,
+                         processes, checkpoint)
+
+  def mapNodes(self, methodName, args, nodePattern=None, processes=1, checkpoint=None):
+    """Call a :class:`CeresNode` method on every node of the tree, or the
+    nodes matching a pattern, in a pool of worker processes
+
+      :param methodName: The name of the node method to call
+      :param args: Positional arguments passed to the method
+      :param nodePattern: Optional pattern limiting the nodes visited
+      :param processes: How many nodes are handled at once
+      :param checkpoint: Optional file recording the nodes already handled.
+                         An interrupted run given the same file resumes where
+                         it stopped. The file is removed once the run completes.
+
+      :returns: A dict of metric name to the method's return value, or to
+                the exception it raised, for the nodes handled by this run
+    """
+    if nodePattern is None:
+      nodePaths = (node.nodePath for node in self.walk())
+    else:
+      nodePaths = (node.nodePath for node in self.find(nodePattern))
+
+    return self.runWorkers(nodePaths, initNodeWorker,
+                           (self.root, treeSettings(self), methodName, args),
+                           nodeWorker, processes, checkpoint)
+
+  def importWhisper(self, whisperRoot, processes=1, checkpoint=None, now=None, delete=False):
+    """Import every whisper file beneath `whisperRoot` with
+    :func:`importWhisperFile`, in a pool of worker processes. A file's path
+    relative to `whisperRoot`, without its `.wsp` suffix, names its node.
+    See :meth:`rollup` for the `processes` and `checkpoint` parameters.
+
+      :param whisperRoot: The directory holding the whisper files
+      :param now: The time the whisper retentions are measured back from,
+                  defaults to now. Every file is imported as of the same time.
+      :param delete: Remove each whisper file once it has been imported
+
+      :returns: A dict of whisper file path, relative to `whisperRoot`, to the
+                number of datapoints imported, or to the exception importing
+                it raised, for the files handled by this run
+    """
+    requireWhisper()
+    if now is None:
+      now = int(time.time())
+    whisperRoot = abspath(whisperRoot)
+    return self.runWorkers(findWhisperFiles(whisperRoot), initWhisperWorker,
+                           (self.root, treeSettings(self), whisperRoot, now, delete), whisperWorker,
+                           processes, checkpoint)
+
+  def runWorkers(self, items, initializer, initargs, worker, processes=1, checkpoint=None):
+    """Call `worker` on each of `items` in a pool of worker processes, as
+    :meth:`mapNodes` and :meth:`importWhisper` do
+
+      :param items: Strings naming the work, those recorded in `checkpoint`
+                    are skipped
+      :param initializer: Sets up each worker process, called with `initargs`.
+                          When `processes` is 1 the work is done in this
+                          process and this tree is passed after `initargs`.
+      :param worker: A module level function returning `(item, outcome)`
+      :param processes: How many items are handled at once
+      :param checkpoint: Optional file recording the items already handled
+                         without error, removed once the run completes
+
+      :returns: A dict of item to outcome
+    """
+    done = set()
+    if checkpoint is not None and exists(checkpoint):
+      with open(checkpoint) as fh:
+        done.update(line.rstrip('\n') for line in fh)
+
+    items = (item for item in items if item not in done)
+
+    if processes > 1:
+      pool = multiprocessing.Pool(processes, initializer, initargs)
+      outcomes = pool.imap_unordered(worker, items)
+    else:
+      pool = None
+      initializer(*(initargs + (self,)))
+      outcomes = (worker(item) for item in items)
+
+    results = {}
+    checkpointFile = open(checkpoint, 'a') if checkpoint is not None else None
+    try:
+      for item, outcome in outcomes:
+        results[item] = outcome
+        # failed items are retried by a resumed run
+        if checkpointFile is not None and not isinstance(outcome, Exception):
+          checkpointFile.write(item + '\n')
+          checkpointFile.flush()
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+      if checkpointFile is not None:
+        checkpointFile.close()
+
+    if checkpoint is not None:
+      os.unlink(checkpoint)
+    return results
+
+  def setFetchThreads(self, count):
+    """Set how many threads :meth:`fetchMany` reads nodes with
+
+      :param count: The number of reader threads, `1` reads serially
+    """
+    if self.fetchPool is not None:
+      self.fetchPool.close()
+      self.fetchPool = None
+
+    self.fetchThreads = max(int(count), 1)
+
+  def setFindThreads(self, count):
+    """Set how many threads :meth:`find` lists wide directory levels with
+
+      :param count: The number of lister threads, `1` walks serially
+    """
+    if self.findPool is not None:
+      self.findPool.close()
+      self.findPool = None
+
+    self.findThreads = max(int(count), 1)
+
+  def setStoreProcesses(self, count):
+    """Set how many worker processes :meth:`storeMany` writes with
+
+      :param count: The number of writer processes. `0` or `None` writes in
+                    the calling process.
+    """
+    if self.storePool is not None:
+      self.storePool.close()
+      self.storePool = None
+
+    if count:
+      self.storePool = StoreWorkerPool(self.root, count)
+
   def walk(self, **kwargs):
     """Iterate through the nodes contained in this :class:`CeresTree`
 
@@ -117,34 +490,82 @@ class CeresTree:
 
       :returns: :class:`CeresNode` or `None`
     """
-    if nodePath not in self.nodeCache:
+    self.loadIndexes(force=False)
+    node = self.nodeCache.get(nodePath)
+    if node is NodeCache.MISSING:
+      return None
+
+    if node is None:
       fsPath = self.getFilesystemPath(nodePath)
+      if self.instrumentation is not None:
+        self.instrumentation.count('stat', 2)
       if CeresNode.isNodeDir(fsPath):
-        self.nodeCache[nodePath] = CeresNode(self, nodePath, fsPath)
+        node = CeresNode(self, nodePath, fsPath)
+        self.nodeCache.add(nodePath, node)
       else:
-        return None
+        self.nodeCache.addMissing(nodePath)
 
-    return self.nodeCache[nodePath]
+    return node
 
   def find(self, nodePattern, fromTime=None, untilTime=None):
     """Find nodes which match a wildcard pattern, optionally filtering on
     a time range
 
-      :keyword nodePattern: A glob-style metric wildcard
+      :keyword nodePattern: A graphite metric pattern, see :class:`MetricPattern`
       :keyword fromTime: Optional interval start time in unix-epoch.
       :keyword untilTime: Optional interval end time in unix-epoch.
 
       :returns: An iterator yielding :class:`CeresNode` objects
     """
-    for fsPath in glob(self.getFilesystemPath(nodePattern)):
-      if CeresNode.isNodeDir(fsPath):
-        nodePath = self.getNodePath(fsPath)
+    nodes = self._find(nodePattern, fromTime, untilTime)
+    if self.instrumentation is not None:
+      return self.instrumentation.timeIter('find', nodes)
+    return nodes
+
+  def _find(self, nodePattern, fromTime, untilTime):
+    self.loadIndexes(force=False)
+    catalog = self.extentCatalog
+    for nodePath in self.expandPattern(nodePattern):
+      if fromTime is None and untilTime is None:
         node = self.getNode(nodePath)
-
-        if fromTime is None and untilTime is None:
-          yield node
-        elif node.hasDataForInterval(fromTime, untilTime):
+        if node is not None:
           yield node
+        continue
+
+      if catalog is not None:
+        try:
+          extents = catalog.get(nodePath)
+        except sqlite3.Error:
+          extents = None
+        if extents is not None:
+          if intervalOverlaps(extents[0], extents[1], fromTime, untilTime):
+            node = self.getNode(nodePath)
+            if node is not None:
+              yield node
+          continue
+
+      # nodes missing from the catalog are checked on disk, only writers and
+      # rebuildExtentCatalog change it so readers need not be able to
+      node = self.getNode(nodePath)
+      if node is not None and node.hasDataForInterval(fromTime, untilTime):
+        yield node
+
+  def expandPattern(self, nodePattern):
+    """Yield the candidate metric names matching a pattern, from the name
+    index when the tree has one and by walking the tree otherwise. Names
+    are not guaranteed to be nodes, :meth:`find` checks them with :meth:`getNode`.
+
+      :param nodePattern: A pattern string or a compiled :class:`MetricPattern`
+    """
+    if not isinstance(nodePattern, MetricPattern):
+      nodePattern = MetricPattern(nodePattern)
+
+    if self.nameIndex is not None:
+      return self.nameIndex.match(nodePattern)
+
+    if self.findThreads > 1 and self.findPool is None:
+      self.findPool = ThreadPool(self.findThreads)
+    return nodePattern.expand(self.root, pool=self.findPool, stats=self.instrumentation)
 
   def createNode(self, nodePath, **properties):
     """Creates a new metric given a new metric name and optional per-node metadata
@@ -153,13 +574,22 @@ class CeresTree:
 
       :returns: :class:`CeresNode`
     """
-    return CeresNode.create(self, nodePath, **properties)
+    node = CeresNode.create(self, nodePath, **properties)
+    self.nodeCache.invalidate(nodePath)
+    self.loadIndexes()
+    if self.nameIndex is not None:
+      self.nameIndex.add(nodePath)
+    return node
 
   def store(self, nodePath, datapoints):
     """Store a list of datapoints associated with a metric
       :keyword nodePath: The metric name to write to
       :keyword datapoints: A list of datapoint tuples: (timestamp, value)
     """
+    stats = self.instrumentation
+    if stats is not None:
+      started = time.time()
+
     node = self.getNode(nodePath)
 
     if node is None:
@@ -167,28 +597,105 @@ class CeresTree:
 
     node.write(datapoints)
 
-  def fetch(self, nodePath, fromTime, untilTime):
+    if stats is not None:
+      stats.record('store', time.time() - started)
+
+  def storeMany(self, mapping):
+    """Store datapoints for many metrics at once. With worker processes
+    configured (see :meth:`setStoreProcesses`) the metrics are sharded across
+    them so that a given node is only ever written by one process.
+
+      :keyword mapping: A dict of metric name to a list of datapoint tuples
+      :returns: A dict of metric name to `None` on success or the exception
+                raised while storing that metric
+    """
+    if self.storePool is not None:
+      results = self.storePool.store(mapping, treeSettings(self))
+      # the workers' writes don't reach this process' caches
+      if self.readCache is not None:
+        for nodePath in mapping:
+          self.readCache.invalidate(nodePath)
+      return results
+
+    return storeDatapoints(self, mapping.iteritems())
+
+  def fetch(self, nodePath, fromTime, untilTime, asArray=False):
     """Fetch data within a given interval from the given metric
 
       :keyword nodePath: The metric name to fetch from
       :keyword fromTime: Requested interval start time in unix-epoch.
       :keyword untilTime: Requested interval end time in unix-epoch.
+      :keyword asArray: Return values as a numpy float64 array with NaN marking
+                        missing points instead of a list (requires numpy)
 
       :returns: :class:`TimeSeriesData`
       :raises: :class:`NodeNotFound`, :class:`InvalidRequest`, :class:`NoData`
     """
+    stats = self.instrumentation
+    if stats is not None:
+      started = time.time()
+
     node = self.getNode(nodePath)
 
     if not node:
       raise NodeNotFound("the node '%s' does not exist in this tree" % nodePath)
 
-    return node.read(fromTime, untilTime)
+    series = node.read(fromTime, untilTime, asArray=asArray)
+
+    if stats is not None:
+      stats.record('fetch', time.time() - started)
+    return series
+
+  def fetchMany(self, nodePaths, fromTime, untilTime, asArray=False):
+    """Fetch data within a given interval from several metrics at once
+
+    Nodes are read in parallel by up to :attr:`fetchThreads` threads (see
+    :meth:`setFetchThreads`), and every series is consolidated to the
+    largest timeStep among them so the results line up point for point.
+
+      :keyword nodePaths: The metric names to fetch from
+      :keyword fromTime: Requested interval start time in unix-epoch.
+      :keyword untilTime: Requested interval end time in unix-epoch.
+      :keyword asArray: See :meth:`fetch`
+
+      :returns: A dict of metric name to :class:`TimeSeriesData`, metrics
+                that do not exist in this tree are left out
+    """
+    nodes = []
+    for nodePath in OrderedDict.fromkeys(nodePaths):
+      node = self.getNode(nodePath)
+      if node is not None:
+        nodes.append(node)
+
+    if not nodes:
+      return {}
+
+    def read(node):
+      return node.read(fromTime, untilTime, asArray=asArray)
+
+    if self.fetchThreads > 1 and len(nodes) > 1:
+      if self.fetchPool is None:
+        self.fetchPool = ThreadPool(self.fetchThreads)
+      results = self.fetchPool.map(read, nodes)
+    else:
+      results = [read(fetchNode) for fetchNode in nodes]
+
+    timeStep = max(series.timeStep for series in results)
+    alignedFrom = int(fromTime - (fromTime % timeStep))
+    alignedUntil = int(untilTime - (untilTime % timeStep))
+
+    fetched = {}
+    for node, series in izip(nodes, results):
+      fetched[node.nodePath] = alignSeries(series, alignedFrom, alignedUntil, timeStep,
+                                           node.aggregationMethod or DEFAULT_AGGREGATION_METHOD)
+
+    return fetched
 
 
 class CeresNode(object):
   __slots__ = ('tree', 'nodePath', 'fsPath',
-               'metadataFile', 'timeStep',
-               'sliceCache', 'sliceCachingBehavior')
+               'metadataFile', 'timeStep', 'dataType', 'aggregationMethod', 'maxSlicePoints',
+               'sliceCache', 'sliceCachingBehavior', 'sliceIndex')
 
   def __init__(self, tree, nodePath, fsPath):
     self.tree = tree
@@ -196,7 +703,11 @@ class CeresNode(object):
     self.fsPath = fsPath
     self.metadataFile = join(fsPath, '.ceres-node')
     self.timeStep = None
+    self.dataType = None
+    self.aggregationMethod = None
+    self.maxSlicePoints = None
     self.sliceCache = None
+    self.sliceIndex = None
     self.sliceCachingBehavior = DEFAULT_SLICE_CACHING_BEHAVIOR
 
   def __repr__(self):
@@ -205,6 +716,16 @@ class CeresNode(object):
 
   @classmethod
   def create(cls, tree, nodePath, **properties):
+    """Create a node, `properties` become its metadata. Besides `timeStep`,
+    a `dataType` from :data:`DATA_TYPES` selects how datapoints are stored,
+    it must not change once the node has slices. An `aggregationMethod` from
+    :data:`AGGREGATION_METHODS` sets how datapoints are consolidated to
+    coarser resolutions. `maxSlicePoints` caps how many datapoints a slice
+    spans, see :meth:`CeresTree.setMaxSlicePoints`."""
+    getDataType(properties.get('dataType', DEFAULT_DATA_TYPE))
+    getAggregationMethod(properties.get('aggregationMethod', DEFAULT_AGGREGATION_METHOD))
+    getMaxSlicePoints(properties.get('maxSlicePoints'))
+
     # Create the node directory
     fsPath = tree.getFilesystemPath(nodePath)
     os.makedirs(fsPath, DIR_PERMS)
@@ -246,12 +767,23 @@ class CeresNode(object):
     return [(slice.startTime, slice.endTime, slice.timeStep) for slice in self.slices]
 
   def readMetadata(self):
+    stats = getattr(self.tree, 'instrumentation', None)
+    if stats is not None:
+      stats.count('open')
     metadata = json.load(open(self.metadataFile, 'r'))
     self.timeStep = int(metadata['timeStep'])
+    self.dataType = getDataType(metadata.get('dataType', DEFAULT_DATA_TYPE))
+    self.aggregationMethod = getAggregationMethod(
+      metadata.get('aggregationMethod', DEFAULT_AGGREGATION_METHOD))
+    self.maxSlicePoints = getMaxSlicePoints(metadata.get('maxSlicePoints'))
     return metadata
 
   def writeMetadata(self, metadata):
     self.timeStep = int(metadata['timeStep'])
+    self.dataType = getDataType(metadata.get('dataType', DEFAULT_DATA_TYPE))
+    self.aggregationMethod = getAggregationMethod(
+      metadata.get('aggregationMethod', DEFAULT_AGGREGATION_METHOD))
+    self.maxSlicePoints = getMaxSlicePoints(metadata.get('maxSlicePoints'))
 
     f = open(self.metadataFile, 'w')
     json.dump(metadata, f)
@@ -259,6 +791,11 @@ class CeresNode(object):
 
   @property
   def slices(self):
+    if self.sliceCachingBehavior == 'index':
+      for slice in self.getSliceIndex().slices[::-1]:
+        yield slice
+      return
+
     if self.sliceCache:
       if self.sliceCachingBehavior == 'all':
         for slice in self.sliceCache:
@@ -268,53 +805,290 @@ class CeresNode(object):
         yield self.sliceCache
         infos = self.readSlices()
         for info in infos[1:]:
-          yield CeresSlice(self, *info)
+          yield self.sliceFromInfo(info)
 
     else:
       if self.sliceCachingBehavior == 'all':
-        self.sliceCache = [CeresSlice(self, *info) for info in self.readSlices()]
+        self.sliceCache = [self.sliceFromInfo(info) for info in self.readSlices()]
         for slice in self.sliceCache:
           yield slice
 
       elif self.sliceCachingBehavior == 'latest':
         infos = self.readSlices()
         if infos:
-          self.sliceCache = CeresSlice(self, *infos[0])
+          self.sliceCache = self.sliceFromInfo(infos[0])
           yield self.sliceCache
 
         for info in infos[1:]:
-          yield CeresSlice(self, *info)
+          yield self.sliceFromInfo(info)
 
       elif self.sliceCachingBehavior == 'none':
         for info in self.readSlices():
-          yield CeresSlice(self, *info)
+          yield self.sliceFromInfo(info)
 
       else:
         raise ValueError("invalid caching behavior configured '%s'" % self.sliceCachingBehavior)
 
   def readSlices(self):
+    stats = getattr(self.tree, 'instrumentation', None)
+    if stats is not None:
+      stats.count('stat')
+      stats.count('listdir')
+
     if not exists(self.fsPath):
       raise NodeDeleted()
 
     slice_info = []
     for filename in os.listdir(self.fsPath):
-      if filename.endswith('.slice'):
-        startTime, timeStep = filename[:-6].split('@')
+      if filename.endswith(SLICE_SUFFIX):
+        startTime, timeStep = filename[:-len(SLICE_SUFFIX)].split('@')
         slice_info.append((int(startTime), int(timeStep)))
+      elif filename.endswith(COMPRESSED_SLICE_SUFFIX):
+        startTime, timeStep = filename[:-len(COMPRESSED_SLICE_SUFFIX)].split('@')
+        slice_info.append((int(startTime), int(timeStep), CompressedSlice))
 
     slice_info.sort(reverse=True)
     return slice_info
 
+  def sliceFromInfo(self, info):
+    """Instantiate a slice from a :meth:`readSlices` entry, which is
+    `(startTime, timeStep)` or `(startTime, timeStep, sliceClass)`"""
+    if len(info) > 2:
+      return info[2](self, info[0], info[1])
+    return CeresSlice(self, *info)
+
+  def compressSlices(self, includeLatest=False):
+    """Convert this node's slices to the compressed format, see
+    :class:`CompressedSlice`. The latest slice, which receives appends, is
+    left alone unless `includeLatest` is set.
+
+      :returns: The number of slices converted
+    """
+    converted = 0
+    for i, slice in enumerate(list(self.slices)):
+      if isinstance(slice, CompressedSlice) or (i == 0 and not includeLatest):
+        continue
+      try:
+        slice.compress()
+        converted += 1
+      except SliceDeleted:
+        pass
+    self.clearSliceCache()
+    return converted
+
+  def decompressSlices(self):
+    """Convert this node's compressed slices back to the raw format"""
+    converted = 0
+    for slice in list(self.slices):
+      if isinstance(slice, CompressedSlice):
+        try:
+          slice.decompress()
+          converted += 1
+        except SliceDeleted:
+          pass
+    self.clearSliceCache()
+    return converted
+
+  def defragment(self, maxGap=DEFAULT_MERGE_MAX_GAP, includeLatest=False):
+    """Merge runs of adjacent raw slices of the same timeStep into one slice
+    each, padding the gaps between them with missing datapoints. Slices
+    further apart than `maxGap` points are left separate, as are runs some
+    slice of another timeStep starts within, since merging would change
+    which data reads prefer. The latest slice, which receives appends, is
+    left alone unless `includeLatest` is set.
+
+    Each merged slice is written to a temporary file and renamed over the
+    first slice of its run before the rest are removed, so concurrent
+    readers always see the same data.
+
+      :returns: The number of slices merged away
+    """
+    allSlices = sorted(self.slices, key=lambda slice: (slice.startTime, slice.timeStep))
+    slices = list(allSlices)
+    if slices and not includeLatest:
+      slices.remove(max(slices, key=lambda slice: slice.startTime))
+
+    merged = 0
+    for timeStep in set(slice.timeStep for slice in slices):
+      others = [slice.startTime for slice in allSlices if slice.timeStep != timeStep]
+      run = []
+      for slice in slices:
+        if slice.timeStep != timeStep:
+          continue
+        if isinstance(slice, CompressedSlice):
+          merged += self.mergeSlices(run)
+          run = []
+          continue
+
+        if run:
+          first = run[0]
+          end = max(s.endTime for s in run)
+          gap = (slice.startTime - end) / timeStep
+          interleaved = any(first.startTime < t < max(end, slice.endTime) for t in others)
+          if gap > maxGap or interleaved:
+            merged += self.mergeSlices(run)
+            run = []
+        run.append(slice)
+      merged += self.mergeSlices(run)
+
+    self.clearSliceCache()
+    return merged
+
+  def mergeSlices(self, run):
+    """Replace a run of raw slices of one timeStep, ordered by startTime, with
+    a single slice, see :meth:`defragment`
+
+      :returns: The number of slices merged away
+    """
+    if len(run) < 2:
+      return 0
+
+    first = run[0]
+    dataType = first.dataType
+    timeStep = first.timeStep
+    try:
+      before = [(getsize(slice.fsPath), getmtime(slice.fsPath)) for slice in run]
+    except OSError:
+      return 0  # deleted meanwhile
+
+    merged = bytearray()
+    for slice, (size, mtime) in izip(run, before):
+      with open(slice.fsPath, 'rb') as fh:
+        packedValues = fh.read(size)
+
+      offset = ((slice.startTime - first.startTime) / timeStep) * dataType.size
+      if offset > len(merged):
+        merged.extend(dataType.packedNull * ((offset - len(merged)) / dataType.size))
+
+      # points of the later slice win, the earlier one fills its gaps
+      overlap = min(len(merged) - offset, len(packedValues))
+      if overlap > 0:
+        newer = dataType.unpack(packedValues[:overlap])
+        older = dataType.unpack(str(merged[offset:offset + overlap]))
+        values = [n if n is not None else o for n, o in izip(newer, older)]
+        merged[offset:offset + overlap] = dataType.pack(
+          [dataType.null if v is None else v for v in values])
+      if len(packedValues) > overlap:
+        merged[offset + max(overlap, 0):] = packedValues[max(overlap, 0):]
+
+    tmpPath = first.fsPath + '.merging'
+    with open(tmpPath, 'wb') as fh:
+      fh.write(merged)
+    os.chmod(tmpPath, SLICE_PERMS)
+
+    try:
+      after = [(getsize(slice.fsPath), getmtime(slice.fsPath)) for slice in run]
+    except OSError:
+      after = None
+    if after != before:  # written to while merging, leave it for the next run
+      os.unlink(tmpPath)
+      return 0
+
+    os.rename(tmpPath, first.fsPath)
+    if first.mapPool is not None:
+      first.mapPool.invalidate(first.fsPath)
+    for slice in run[1:]:
+      try:
+        slice.remove()
+      except SliceDeleted:
+        pass
+
+    self.clearSliceCache()
+    return len(run) - 1
+
+  def getSliceIndex(self, fromTime=None, untilTime=None):
+    """Return the :class:`SliceIndex` of this node, rebuilding it only when
+    the node directory's mtime shows slices were added, renamed or removed
+    by someone else. The sizes of the slices a read of [`fromTime`,
+    `untilTime`) may find appended to are checked, or of the latest slice
+    without an interval."""
+    stats = getattr(self.tree, 'instrumentation', None)
+    if stats is not None:
+      stats.count('stat')
+
+    try:
+      mtime = getmtime(self.fsPath)
+    except OSError:
+      raise NodeDeleted()
+
+    index = self.sliceIndex
+    if index is None or index.mtime != mtime:
+      slices = []
+      for info in reversed(self.readSlices()):
+        slice = self.sliceFromInfo(info)
+        try:
+          slice.knownSize = slice.size
+        except (OSError, SliceDeleted):
+          continue
+        slices.append(slice)
+
+      index = self.sliceIndex = SliceIndex(mtime, slices)
+
+    elif index.slices:
+      # other processes append to slices, and fill gaps in older ones,
+      # without touching the directory
+      if fromTime is None:
+        candidates = [len(index.slices) - 1]
+      else:
+        candidates = index.writable(fromTime, untilTime)
+
+      for i in candidates:
+        slice = index.slices[i]
+        try:
+          size = slice.size
+        except (OSError, SliceDeleted):
+          self.sliceIndex = None
+          return self.getSliceIndex(fromTime, untilTime)
+
+        if size != slice.knownSize:
+          slice.knownSize = size
+          index.sizeChanged(i)
+
+    return index
+
+  def sliceCreated(self, slice):
+    """Record a slice created by this process in the slice index"""
+    if self.sliceIndex is not None:
+      stats = getattr(self.tree, 'instrumentation', None)
+      if stats is not None:
+        stats.count('stat')
+
+      try:
+        mtime = getmtime(self.fsPath)
+      except OSError:
+        raise NodeDeleted()
+
+      slice.knownSize = 0
+      self.sliceIndex.add(slice)
+      self.sliceIndex.mtime = mtime
+
+  def slicesForInterval(self, fromTime, untilTime):
+    """Return the slices that overlap [`fromTime`, `untilTime`), most recent first"""
+    if self.sliceCachingBehavior == 'index':
+      return self.getSliceIndex(fromTime, untilTime).between(fromTime, untilTime)
+
+    selected = []
+    for slice in self.slices:
+      if slice.startTime >= untilTime:
+        continue
+
+      if slice.startTime > fromTime or slice.endTime > fromTime:
+        selected.append(slice)
+
+    return selected
+
   def setSliceCachingBehavior(self, behavior):
     behavior = behavior.lower()
-    if behavior not in ('none', 'all', 'latest'):
+    if behavior not in SLICE_CACHING_BEHAVIORS:
       raise ValueError("invalid caching behavior '%s'" % behavior)
 
     self.sliceCachingBehavior = behavior
     self.sliceCache = None
+    self.sliceIndex = None
 
   def clearSliceCache(self):
     self.sliceCache = None
+    self.sliceIndex = None
 
   def hasDataForInterval(self, fromTime, untilTime):
     slices = list(self.slices)
@@ -324,11 +1098,14 @@ class CeresNode(object):
     earliestData = slices[-1].startTime
     latestData = slices[0].endTime
 
-    return ((fromTime is 0) or (fromTime is None) or (fromTime < latestData)) and \
-           ((untilTime is 0) or (untilTime is None) or (untilTime > earliestData))
+    return intervalOverlaps(earliestData, latestData, fromTime, untilTime)
 
-  def read(self, fromTime, untilTime):
-    # get biggest timeStep 
+  def planRead(self, fromTime, untilTime):
+    """Work out which slices, and which part of each, make up the interval
+    [`fromTime`, `untilTime`) without reading any data
+
+      :returns: :class:`ReadPlan`
+    """
     metadata = None
     if self.timeStep is None:
       metadata = self.readMetadata()
@@ -337,124 +1114,205 @@ class CeresNode(object):
     fromTime = int(fromTime - (fromTime % self.timeStep))
     untilTime = int(untilTime - (untilTime % self.timeStep))
 
-    sliceBoundary = None  # to know when to split up queries across slices
-    resultValues = []
-    earliestData = None
-
-    # calculate biggest timeStep in slices with data in requested period
-    biggest_timeStep = 1
-    slices_map = {}
-    for slice_tmp in self.slices:
-      slices_map[slice_tmp.fsPath] = [slice_tmp.startTime, slice_tmp.endTime, slice_tmp.timeStep]
-      if fromTime >= slice_tmp.startTime:
-        if biggest_timeStep < slice_tmp.timeStep: biggest_timeStep = slice_tmp.timeStep
+    # most recent first, ending with the latest slice that starts at or before fromTime
+    candidates = self.slicesForInterval(fromTime, untilTime)
+    aggregationMethod = self.aggregationMethod or DEFAULT_AGGREGATION_METHOD
+    if not candidates:
+      timeStep = self.fallbackTimeStep(untilTime, metadata)
+      fromTime = int(fromTime - (fromTime % timeStep))
+      untilTime = int(untilTime - (untilTime % timeStep))
+      return ReadPlan(fromTime, untilTime, timeStep, [], aggregationMethod)
+
+    timeStep = max(slice.timeStep for slice in candidates)
+    while fromTime % timeStep or untilTime % timeStep:
+      # the series steps by the coarsest timeStep read, so its bounds must
+      # fit that instead, and the earlier start may take in older slices
+      fromTime = int(fromTime - (fromTime % timeStep))
+      untilTime = int(untilTime - (untilTime % timeStep))
+      candidates = self.slicesForInterval(fromTime, untilTime)
+      timeStep = max([timeStep] + [slice.timeStep for slice in candidates])
+
+    # Each datapoint comes from the most recent slice starting at or before
+    # it. Older slices that reach past the start of a more recent one only
+    # fill the gaps the more recent slices leave there.
+    regions = []
+    gapRegions = []
+    boundary = untilTime  # start of the more recent slices' coverage
+    for slice in candidates:
+      endTime = slice.endTime
+      regionFrom = max(fromTime, slice.startTime)
+      regionUntil = min(boundary, endTime)
+      if regionFrom < regionUntil:
+        regions.append((slice, regionFrom, regionUntil, False))
+
+      gapFrom = max(regionFrom, boundary)
+      gapUntil = min(untilTime, endTime)
+      if gapFrom < gapUntil:
+        gapRegions.append((slice, gapFrom, gapUntil, True))
+
+      boundary = min(boundary, regionFrom)
+
+    regions.extend(gapRegions)
+    return ReadPlan(fromTime, untilTime, timeStep, regions, aggregationMethod)
+
+  def fallbackTimeStep(self, untilTime, metadata=None):
+    """The resolution to report an interval no slice covers at, guessed from
+    the node's retentions"""
+    if metadata is None:
+      metadata = self.readMetadata()
+
+    timeStep = self.timeStep
+    now = int(time.time())
+    elapsed = 0
+    for retention in metadata.get('retentions') or ():
+      elapsed += retention[0] * retention[1]
+      if untilTime > now - elapsed:
         break
-      elif untilTime >= slice_tmp.startTime:
-        if biggest_timeStep < slice_tmp.timeStep: biggest_timeStep = slice_tmp.timeStep
-
-    resultValues = None
-    result_length = 0
-
-    slices_arr = []
-    for slice_tmp in self.slices:
-      bogus = 0
-      for item in slices_map.values():
-        if (slice_tmp.startTime > item[0] and slice_tmp.endTime < item[1]) or (slice_tmp.startTime > untilTime or slice_tmp.endTime < fromTime):
-          bogus = 1
-      if not bogus:
-        slices_arr.append(slice_tmp)
-
-      for slice in slices_arr:
-        # print("slice timestep=%s start=%s end=%s" % (slice.timeStep, slice.startTime, slice.endTime))
-        # if the requested interval starts after the start of this slice
-        is_last = False
-        if fromTime >= slice.startTime:
-          requestUntilTime = untilTime
-          requestFromTime = fromTime
-          is_last = True
-        elif untilTime >= slice.startTime:
-          # Or if slice contains data for part of the requested interval...
-          # Split the request up if it straddles a slice boundary
-          if (sliceBoundary is not None) and untilTime > sliceBoundary:
-            requestUntilTime = sliceBoundary
-          else:
-            requestUntilTime = untilTime
-          requestFromTime = slice.startTime
-          sliceBoundary = slice.startTime
-        else:
-          # this is the right-side boundary on the next iteration
-          sliceBoundary = slice.startTime
-          continue
+      timeStep = retention[0]
+
+    return timeStep
 
+  def rollup(self, now=None):
+    """Enforce the node's `retentions` metadata, a list of
+    `[timeStep, points]` pairs from finest to coarsest. Data a resolution no
+    longer retains is aggregated into slices of the next coarser resolution
+    and then deleted, and data older than the coarsest retention is dropped.
+    Running it again over the same data gives the same result.
+
+      :param now: The time retentions are measured back from, defaults to now
+
+      :returns: The number of datapoints written to coarser slices
+    """
+    metadata = self.readMetadata()
+    retentions = sorted((int(timeStep), int(points))
+                        for timeStep, points in metadata.get('retentions') or ())
+    if not retentions:
+      return 0
+
+    if now is None:
+      now = time.time()
+    now = int(now)
+
+    rolledUp = 0
+    for (timeStep, points), (coarseStep, coarsePoints) in izip(retentions, retentions[1:]):
+      cutoff = now - (timeStep * points)
+      cutoff -= cutoff % coarseStep
+
+      expired = [slice for slice in self.slices
+                 if slice.timeStep == timeStep and slice.startTime < cutoff]
+      if not expired:
+        continue
+
+      buckets = {}
+      for slice in expired:
         try:
-          series = slice.read(requestFromTime, requestUntilTime)
-          if slice.timeStep < biggest_timeStep:
-            series.values = recalculateSeries(series.values, slice.timeStep, biggest_timeStep)
-            series.timeStep = biggest_timeStep
-          # print("0 slice_len=%s, calculated_len=%s" % (len(series.values), (series.endTime - series.startTime)/biggest_timeStep))
-        except NoData:
-          break
+          series = slice.read(slice.startTime, min(slice.endTime, cutoff))
+        except (NoData, InvalidRequest):
+          continue
+        for t, value in series:
+          if value is not None:
+            buckets.setdefault(t - (t % coarseStep), []).append(value)
+
+      datapoints = [(t, aggregate(values, self.aggregationMethod))
+                    for t, values in sorted(buckets.items())]
+      self.write(datapoints, coarseStep)
+      rolledUp += len(datapoints)
+
+      self.deleteBefore(cutoff, timeStep)
+
+    coarseStep, coarsePoints = retentions[-1]
+    self.deleteBefore(now - (coarseStep * coarsePoints))
+    return rolledUp
+
+  def deleteBefore(self, t, timeStep=None):
+    """Delete the data before `t` from every slice, or only from the slices
+    of one `timeStep`"""
+    stats = getattr(self.tree, 'instrumentation', None)
+    if stats is not None:
+      started = time.time()
+
+    for slice in list(self.slices):
+      if timeStep is not None and slice.timeStep != timeStep:
+        continue
+      try:
+        slice.deleteBefore(t)
+      except SliceDeleted:
+        pass
+    self.clearSliceCache()
+
+    catalog = getattr(self.tree, 'extentCatalog', None)
+    if catalog is not None:
+      slices = list(self.slices)
+      if slices:
+        catalog.trim(self.nodePath, min(slice.startTime for slice in slices))
+      else:
+        catalog.drop(self.nodePath)
 
-        earliestData = series.startTime
+    cache = getattr(self.tree, 'readCache', None)
+    if cache is not None:
+      cache.invalidate(self.nodePath, untilTime=t)
 
-        rightMissing = (requestUntilTime - series.endTime) / biggest_timeStep
+    if stats is not None:
+      stats.record('deleteBefore', time.time() - started)
 
-        if resultValues is None:
-          result_length = 0
+  def read(self, fromTime, untilTime, asArray=False):
+    if asArray:
+      requireNumpy()
 
-        rightNulls = TimeSeriesData(series.endTime,
-                                    series.endTime + rightMissing,
-                                    biggest_timeStep,
-                                    [None for i in range(rightMissing - result_length)])
-        series += rightNulls
-        if resultValues is None:
-          resultValues = series
-        else:
-          if resultValues.startTime > series.startTime:
-            series.merge(resultValues)
-            resultValues = series
-          else:
-            resultValues.merge(series)
-        result_length = len(resultValues)
-        if is_last:
-          break
+    cache = getattr(self.tree, 'readCache', None)
+    if cache is not None:
+      return cache.read(self, fromTime, untilTime, asArray=asArray)
+    return self.planRead(fromTime, untilTime).execute(asArray=asArray)
 
-    # The end of the requested interval predates all slices
-    if earliestData is None:
-      if biggest_timeStep is 1:
-        now = int(time.time())
-        try:
-          biggest_timeStep = metadata["timeStep"]
-          tmp = 0
-          for ts in metadata["retentions"]:
-            tmp += ts[0] * ts[1]
-            if untilTime > now - tmp:
-              break
-            biggest_timeStep = ts[0]
-        except TypeError:
-          biggest_timeStep = DEFAULT_TIMESTEP
-      missing = int(untilTime - fromTime) / biggest_timeStep
-      resultValues = TimeSeriesData(fromTime, untilTime, biggest_timeStep, [None for i in range(missing)])
-
-    # Left pad nulls if the start of the requested interval predates all slices
-    else:
-      leftMissing = (earliestData - fromTime) / biggest_timeStep
-      leftNulls = TimeSeriesData(fromTime,
-                                 fromTime + leftMissing,
-                                 biggest_timeStep,
-                                 [None for i in range(leftMissing)])
-      resultValues = leftNulls + resultValues
-    # print("vals=%s, computed_vals=%s" % (len(resultValues.values), (untilTime - fromTime)/biggest_timeStep))
-    return resultValues
-
-  def write(self, datapoints):
+  def readIter(self, fromTime, untilTime, chunkPoints=DEFAULT_READ_CHUNK_POINTS, asArray=False):
+    """Read [`fromTime`, `untilTime`) in consecutive chunks of up to
+    `chunkPoints` datapoints, so only one chunk is held in memory at a time.
+    Joined together the chunks hold the same datapoints :meth:`read` returns.
+    Chunks bypass the tree's read cache.
+
+      :returns: A generator of :class:`TimeSeriesData`
+    """
+    if asArray:
+      requireNumpy()
+
+    plan = self.planRead(fromTime, untilTime)
+    chunkPoints = max(int(chunkPoints), 1)
+    length = len(plan)
+    for first in xrange(0, max(length, 1), chunkPoints):
+      yield plan.execute(asArray=asArray, first=first, last=first + chunkPoints)
+
+  def write(self, datapoints, timeStep=None):
+    """Write datapoints to the slices of the node's timeStep, or of another
+    `timeStep` such as the coarser resolutions produced by :meth:`rollup`"""
+    stats = getattr(self.tree, 'instrumentation', None)
+    if stats is None:
+      return self._write(datapoints, timeStep)
+
+    started = time.time()
+    self._write(datapoints, timeStep)
+    stats.record('write', time.time() - started)
+
+  def _write(self, datapoints, timeStep=None):
     if self.timeStep is None:
       self.readMetadata()
 
     if not datapoints:
       return
 
-    sequences = self.compact(datapoints)
+    if timeStep is None:
+      timeStep = self.timeStep
+
+    sequences = self.compact(datapoints, timeStep)
+    if not sequences:
+      return
+
+    maxPoints = self.maxSlicePoints or getattr(self.tree, 'maxSlicePoints', None)
+    sliceSpan = maxPoints * timeStep if maxPoints else None
+    if sliceSpan:
+      sequences = splitSequences(sequences, sliceSpan)
+
+    earliestWritten = sequences[0][0][0]
+    latestWritten = sequences[-1][-1][0] + timeStep
     needsEarlierSlice = []  # keep track of sequences that precede all existing slices
 
     while sequences:
@@ -466,7 +1324,7 @@ class CeresNode(object):
       slicesExist = False
 
       for slice in self.slices:
-        if slice.timeStep != self.timeStep:
+        if slice.timeStep != timeStep:
           continue
 
         slicesExist = True
@@ -480,6 +1338,14 @@ class CeresNode(object):
             boundaryIndex = bisect_left(timestamps, sliceBoundary)
             sequenceWithinSlice = sequence[:boundaryIndex]
 
+          # appending past the slice span boundary the slice ends at
+          if (sliceSpan and slice.startTime < beginningTime - (beginningTime % sliceSpan)
+              and beginningTime >= slice.endTime):
+            newSlice = CeresSlice.create(self, beginningTime, slice.timeStep)
+            newSlice.write(sequenceWithinSlice)
+            self.sliceCache = None
+            break
+
           try:
             slice.write(sequenceWithinSlice)
           except SliceGapTooLarge:
@@ -488,7 +1354,7 @@ class CeresNode(object):
             self.sliceCache = None
           except SliceDeleted:
             self.sliceCache = None
-            self.write(datapoints)  # recurse to retry
+            self._write(datapoints, timeStep)  # recurse to retry
             return
 
           break
@@ -503,23 +1369,38 @@ class CeresNode(object):
           slice.write(sequenceWithinSlice)
           break
 
-        else:
-          needsEarlierSlice.append(sequence)
-
         sliceBoundary = slice.startTime
 
+      else:
+        if slicesExist:  # precedes every slice of this timeStep
+          needsEarlierSlice.append(sequence)
+
       if not slicesExist:
         sequences.append(sequence)
         needsEarlierSlice = sequences
         break
 
     for sequence in needsEarlierSlice:
-      slice = CeresSlice.create(self, int(sequence[0][0]), self.timeStep)
+      slice = CeresSlice.create(self, int(sequence[0][0]), timeStep)
       slice.write(sequence)
       self.sliceCache = None
 
-  def compact(self, datapoints):
-    datapoints = sorted((int(timestamp), float(value))
+    catalog = getattr(self.tree, 'extentCatalog', None)
+    if catalog is not None:
+      catalog.extend(self.nodePath, earliestWritten, latestWritten, timeStep)
+
+    cache = getattr(self.tree, 'readCache', None)
+    if cache is not None:
+      cache.invalidate(self.nodePath, earliestWritten, latestWritten)
+
+  def compact(self, datapoints, timeStep=None):
+    if timeStep is None:
+      timeStep = self.timeStep
+    if self.dataType is not None and self.dataType.isInteger:
+      convert = lambda value: value if isinstance(value, (int, long)) else float(value)
+    else:
+      convert = float
+    datapoints = sorted((int(timestamp), convert(value))
                          for timestamp, value in datapoints
                          if value is not None)
     sequences = []
@@ -527,7 +1408,7 @@ class CeresNode(object):
     minimumTimestamp = 0  # used to avoid duplicate intervals
 
     for timestamp, value in datapoints:
-      timestamp -= timestamp % self.timeStep  # round it down to a proper interval
+      timestamp -= timestamp % timeStep  # round it down to a proper interval
 
       if not sequence:
         sequence.append((timestamp, value))
@@ -536,7 +1417,7 @@ class CeresNode(object):
         if not timestamp > minimumTimestamp:  # drop duplicate intervals
           continue
 
-        if timestamp == sequence[-1][0] + self.timeStep:  # append contiguous datapoints
+        if timestamp == sequence[-1][0] + timeStep:  # append contiguous datapoints
           sequence.append((timestamp, value))
 
         else:  # start a new sequence if not contiguous
@@ -552,62 +1433,93 @@ class CeresNode(object):
 
 
 class CeresSlice(object):
-  __slots__ = ('node', 'startTime', 'timeStep', 'fsPath')
+  __slots__ = ('node', 'startTime', 'timeStep', 'fsPath', 'knownSize')
 
   def __init__(self, node, startTime, timeStep):
     self.node = node
     self.startTime = startTime
     self.timeStep = timeStep
-    self.fsPath = join(node.fsPath, '%d@%d.slice' % (startTime, timeStep))
+    self.fsPath = join(node.fsPath, '%d@%d%s' % (startTime, timeStep, SLICE_SUFFIX))
+    self.knownSize = None  # kept current by the slice index, None means stat the file
 
   def __repr__(self):
     return "<CeresSlice[0x%x]: %s>" % (id(self), self.fsPath)
   __str__ = __repr__
 
+  @property
+  def mapPool(self):
+    return getattr(self.node.tree, 'sliceMapPool', None)
+
+  @property
+  def stats(self):
+    return getattr(self.node.tree, 'instrumentation', None)
+
+  @property
+  def dataType(self):
+    if self.node.dataType is None:
+      try:
+        self.node.readMetadata()
+      except IOError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        self.node.dataType = getDataType(DEFAULT_DATA_TYPE)  # slices predating node metadata
+    return self.node.dataType
+
+  @property
+  def size(self):
+    pool = self.mapPool
+    if pool is not None:
+      return pool.size(self.fsPath)
+    stats = self.stats
+    if stats is not None:
+      stats.count('stat')
+    return getsize(self.fsPath)
+
   @property
   def isEmpty(self):
-    return getsize(self.fsPath) == 0
+    return self.size == 0
 
   @property
   def endTime(self):
-    return self.startTime + ((getsize(self.fsPath) / DATAPOINT_SIZE) * self.timeStep)
+    size = self.knownSize
+    if size is None:
+      size = self.size
+    return self.startTime + ((size / self.dataType.size) * self.timeStep)
 
   @property
   def mtime(self):
+    stats = self.stats
+    if stats is not None:
+      stats.count('stat')
     return getmtime(self.fsPath)
 
   @classmethod
   def create(cls, node, startTime, timeStep):
     slice = cls(node, startTime, timeStep)
+    stats = slice.stats
+    if stats is not None:
+      stats.count('open')
     fileHandle = open(slice.fsPath, 'wb')
     fileHandle.close()
     os.chmod(slice.fsPath, SLICE_PERMS)
+    node.sliceCreated(slice)
     return slice
 
-  def read(self, fromTime, untilTime):
+  def read(self, fromTime, untilTime, asArray=False):
     timeOffset = int(fromTime) - self.startTime
 
     if timeOffset < 0:
       raise InvalidRequest("requested time range (%d, %d) preceeds this slice: %d" % (fromTime, untilTime, self.startTime))
 
     pointOffset = timeOffset / self.timeStep
-    byteOffset = pointOffset * DATAPOINT_SIZE
-
-    if byteOffset >= getsize(self.fsPath):
-      raise NoData()
-
-    fileHandle = open(self.fsPath, 'rb')
-    fileHandle.seek(byteOffset)
-
     timeRange = int(untilTime - fromTime)
     pointRange = timeRange / self.timeStep
-    byteRange = pointRange * DATAPOINT_SIZE
-    packedValues = fileHandle.read(byteRange)
+    packedValues = self.readPacked(pointOffset, pointRange)
 
-    pointsReturned = len(packedValues) / DATAPOINT_SIZE
-    format = '!' + ('d' * pointsReturned)
-    values = struct.unpack(format, packedValues)
-    values = [v if not isnan(v) else None for v in values]
+    if asArray:
+      values = self.dataType.unpackArray(packedValues)
+    else:
+      values = self.dataType.unpack(packedValues)
 
     endTime = fromTime + (len(values) * self.timeStep)
     #print '[DEBUG slice.read] startTime=%s fromTime=%s untilTime=%s' % (self.startTime, fromTime, untilTime)
@@ -615,16 +1527,100 @@ class CeresSlice(object):
     #print '[DEBUG slice.read] values = %s' % str(values)
     return TimeSeriesData(fromTime, endTime, self.timeStep, values)
 
+  def readPacked(self, pointOffset, pointRange):
+    """Return the packed values of up to `pointRange` points starting
+    `pointOffset` points into the slice, or raise :class:`NoData` if the slice
+    ends first. A negative `pointRange` reads to the end of the slice."""
+    datapointSize = self.dataType.size
+    byteOffset = pointOffset * datapointSize
+    byteRange = pointRange * datapointSize
+
+    stats = self.stats
+    pool = self.mapPool
+    if pool is not None:
+      try:
+        packedValues = pool.read(self.fsPath, byteOffset, byteRange)
+      except SliceDeleted:
+        raise NoData()
+
+      if packedValues is None:
+        raise NoData()
+
+    else:
+      if stats is not None:
+        stats.count('stat')
+      if byteOffset >= getsize(self.fsPath):
+        raise NoData()
+
+      if stats is not None:
+        stats.count('open')
+      fileHandle = open(self.fsPath, 'rb')
+      fileHandle.seek(byteOffset)
+      packedValues = fileHandle.read(byteRange)
+      fileHandle.close()
+
+    if stats is not None:
+      stats.count('bytesRead', len(packedValues))
+    return packedValues
+
+  def readInto(self, pointOffset, buffer):
+    """Read packed datapoints starting `pointOffset` points into the slice
+    straight into `buffer`, a writable :class:`memoryview`, or raise
+    :class:`NoData` if the slice ends first. Datapoints past the end of the
+    slice are left untouched.
+
+      :returns: The number of datapoints read
+    """
+    datapointSize = self.dataType.size
+    byteOffset = pointOffset * datapointSize
+
+    if self.mapPool is not None:
+      return self.copyInto(pointOffset, buffer)
+
+    stats = self.stats
+    if stats is not None:
+      stats.count('open')
+    try:
+      fileHandle = open(self.fsPath, 'rb')
+    except IOError, e:
+      if e.errno == errno.ENOENT:
+        raise NoData()
+      raise
+
+    with fileHandle:
+      fileHandle.seek(byteOffset)
+      bytesRead = fileHandle.readinto(buffer)
+
+    if stats is not None:
+      stats.count('bytesRead', bytesRead)
+    if not bytesRead:
+      raise NoData()
+    partial = bytesRead % datapointSize
+    if partial:  # a datapoint still being written
+      buffer[bytesRead - partial:bytesRead] = self.dataType.packedNull[:partial]
+    return bytesRead / datapointSize
+
+  def copyInto(self, pointOffset, buffer):
+    """:meth:`readInto` by way of :meth:`readPacked`"""
+    datapointSize = self.dataType.size
+    packedValues = self.readPacked(pointOffset, len(buffer) / datapointSize)
+    count = len(packedValues) / datapointSize
+    buffer[:count * datapointSize] = packedValues[:count * datapointSize]
+    return count
+
   def write(self, sequence):
     beginningTime = sequence[0][0]
     timeOffset = beginningTime - self.startTime
     pointOffset = timeOffset / self.timeStep
-    byteOffset = pointOffset * DATAPOINT_SIZE
+    dataType = self.dataType
+    byteOffset = pointOffset * dataType.size
 
     values = [v for t,v in sequence]
-    format = '!' + ('d' * len(values))
-    packedValues = struct.pack(format, *values)
+    packedValues = dataType.pack(values)
 
+    stats = self.stats
+    if stats is not None:
+      stats.count('stat')
     try:
       filesize = getsize(self.fsPath)
     except OSError, e:
@@ -635,14 +1631,17 @@ class CeresSlice(object):
 
     byteGap = byteOffset - filesize
     if byteGap > 0:  # pad the allowable gap with nan's
-      pointGap = byteGap / DATAPOINT_SIZE
+      pointGap = byteGap / dataType.size
       if pointGap > MAX_SLICE_GAP:
         raise SliceGapTooLarge()
       else:
-        packedGap = PACKED_NAN * pointGap
+        packedGap = dataType.packedNull * pointGap
         packedValues = packedGap + packedValues
         byteOffset -= byteGap
 
+    if stats is not None:
+      stats.count('open')
+      stats.count('bytesWritten', len(packedValues))
     with file(self.fsPath, 'r+b') as fileHandle:
       try:
         fileHandle.seek(byteOffset)
@@ -651,7 +1650,15 @@ class CeresSlice(object):
         raise
       fileHandle.write(packedValues)
 
+    if self.knownSize is not None:
+      self.knownSize = max(filesize, byteOffset + len(packedValues))
+      if self.node.sliceIndex is not None:
+        self.node.sliceIndex.sizeChanged()
+
   def deleteBefore(self, t):
+    stats = self.stats
+    if stats is not None:
+      stats.count('stat')
     if not exists(self.fsPath):
       raise SliceDeleted()
 
@@ -662,75 +1669,972 @@ class CeresSlice(object):
       return
 
     pointOffset = timeOffset / self.timeStep
-    byteOffset = pointOffset * DATAPOINT_SIZE
+    byteOffset = pointOffset * self.dataType.size
     if not byteOffset:
       return
 
     self.node.clearSliceCache()
+    if self.mapPool is not None:
+      self.mapPool.invalidate(self.fsPath)
+
+    if stats is not None:
+      stats.count('open')
     with file(self.fsPath, 'r+b') as fileHandle:
-      fileHandle.seek(byteOffset)
-      fileData = fileHandle.read()
-      if fileData:
-        fileHandle.seek(0)
-        fileHandle.write(fileData)
-        fileHandle.truncate()
-        fileHandle.close()
-        newFsPath = join(dirname(self.fsPath), "%d@%d.slice" % (t, self.timeStep))
-        os.rename(self.fsPath, newFsPath)
-      else:
-        os.unlink(self.fsPath)
+      kept = trimFile(fileHandle, byteOffset, self.dataType.size, self.dataType.packedNull,
+                      self.mapPool)
+    if kept is None:
+      os.unlink(self.fsPath)
+      raise SliceDeleted()
+
+    # trimFile may keep a few null datapoints before t
+    t -= (kept / self.dataType.size) * self.timeStep
+    newFsPath = join(dirname(self.fsPath), "%d@%d%s" % (t, self.timeStep, SLICE_SUFFIX))
+    os.rename(self.fsPath, newFsPath)
+    if self.mapPool is not None:
+      self.mapPool.invalidate(newFsPath)
+
+  def compress(self):
+    """Replace this slice with a :class:`CompressedSlice` of the same data
+
+      :returns: :class:`CompressedSlice`
+    """
+    try:
+      packedValues = self.readPacked(0, -1)
+    except NoData:
+      packedValues = ''
+
+    compressed = CompressedSlice(self.node, self.startTime, self.timeStep)
+    compressed.writePacked(packedValues)
+    # a write that landed while converting would be lost, keep the raw slice
+    if getsize(self.fsPath) != len(packedValues):
+      os.unlink(compressed.fsPath)
+      return self.compress()
+
+    self.remove()
+    return compressed
+
+  def remove(self):
+    """Delete the slice file"""
+    if self.mapPool is not None:
+      self.mapPool.invalidate(self.fsPath)
+    try:
+      os.unlink(self.fsPath)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
         raise SliceDeleted()
+      raise
+    self.node.clearSliceCache()
 
   def __cmp__(self, other):
     return cmp(self.startTime, other.startTime)
 
 
-class TimeSeriesData(object):
-  __slots__ = ('startTime', 'endTime', 'timeStep', 'values')
+class CompressedSlice(CeresSlice):
+  """A slice stored with Gorilla-style XOR compression, in files named
+  `<startTime>@<timeStep>.cslice`
 
-  def __init__(self, startTime, endTime, timeStep, values):
-    self.startTime = startTime
-    self.endTime = endTime
-    self.timeStep = timeStep
-    self.values = values
+  Timestamps are implicit in a slice, so only values are encoded. Each value
+  is XORed with the one before it and stored as a control byte holding the
+  number of leading zero bytes and significant bytes of the result, followed
+  by the significant bytes. Unchanged values, including runs of NaN padding,
+  take a single byte. Byte rather than bit alignment keeps decoding
+  affordable in Python.
+
+  Points are grouped in blocks of :const:`COMPRESSED_BLOCK_POINTS`, each
+  starting with a raw value, and a block index after the header gives the
+  offset of every block so reads only decode the blocks they need.
+
+  Compressed slices are rewritten as a whole when written to, they are meant
+  for slices that no longer receive appends. See :meth:`CeresNode.compressSlices`.
+  """
+  __slots__ = ()
+
+  def __init__(self, node, startTime, timeStep):
+    CeresSlice.__init__(self, node, startTime, timeStep)
+    self.fsPath = join(node.fsPath, '%d@%d%s' % (startTime, timeStep, COMPRESSED_SLICE_SUFFIX))
 
   @property
-  def timestamps(self):
-    return xrange(self.startTime, self.endTime, self.timeStep)
+  def pointCount(self):
+    return self.readHeader(self.readBytes)[0]
 
-  def __iter__(self):
-    return izip(self.timestamps, self.values)
+  @property
+  def isEmpty(self):
+    return self.pointCount == 0
 
-  def __len__(self):
-    return len(self.values)
+  @property
+  def endTime(self):
+    return self.startTime + (self.pointCount * self.timeStep)
 
-  def __add__(self, other):
-    if self.timeStep != other.timeStep:
-      raise ValueError("Can't sum data with different timestamps. Mine is %s, other's is %s" %
-                         (self.timeStep, other.timeStep))
-    new_data = TimeSeriesData(self.startTime, other.endTime, self.timeStep, self.values + other.values)
-    return new_data
+  def readBytes(self, byteOffset, byteRange):
+    stats = self.stats
+    pool = self.mapPool
+    if pool is not None:
+      data = pool.read(self.fsPath, byteOffset, byteRange) or ''
+    else:
+      if stats is not None:
+        stats.count('open')
+      try:
+        fileHandle = open(self.fsPath, 'rb')
+      except IOError, e:
+        if e.errno == errno.ENOENT:
+          raise SliceDeleted()
+        raise
+      with fileHandle:
+        fileHandle.seek(byteOffset)
+        data = fileHandle.read(byteRange)
 
-  def merge(self, other):
-    """
-    Merge two TimeSeriesData objects together
+    if stats is not None:
+      stats.count('bytesRead', len(data))
+    return data
 
-    :param other: another TimeSeriesData object, that'll be merged. Note, other.startTime must be greater than self's.
-    :return: Nothing
-    """
-    if self.timeStep != other.timeStep:
-        raise ValueError("Can't merge data with different timestamps. Mine is %s, other's is %s" %
-                           (self.timeStep, other.timeStep))
-    # Align timestamp
-    ts = other.startTime - (other.startTime % self.timeStep)
-    index = int((ts - self.startTime) / self.timeStep)
-    for value in other.values:
-      # Adjust timestamp to be aligned on timeStep boundary.
-      if ts > self.endTime:
-        self.values.append(value)
-      else:
-        try:
-          self.values[index] = value
+  def readHeader(self, readBytes):
+    header = readBytes(0, COMPRESSED_HEADER_SIZE)
+    if len(header) < COMPRESSED_HEADER_SIZE:
+      raise CorruptNode(self.node, "truncated compressed slice %s" % self.fsPath)
+
+    magic, pointCount, blockPoints, blockCount = struct.unpack(COMPRESSED_HEADER_FORMAT, header)
+    if magic != COMPRESSED_SLICE_MAGIC:
+      raise CorruptNode(self.node, "bad compressed slice header in %s" % self.fsPath)
+    return pointCount, blockPoints, blockCount
+
+  def readInto(self, pointOffset, buffer):
+    return self.copyInto(pointOffset, buffer)
+
+  def readPacked(self, pointOffset, pointRange):
+    try:
+      if self.mapPool is not None:
+        return self.decode(self.readBytes, pointOffset, pointRange)
+
+      stats = self.stats
+      if stats is not None:
+        stats.count('open')
+      try:
+        fileHandle = open(self.fsPath, 'rb')
+      except IOError, e:
+        if e.errno == errno.ENOENT:
+          raise SliceDeleted()
+        raise
+
+      def readBytes(byteOffset, byteRange):
+        fileHandle.seek(byteOffset)
+        data = fileHandle.read(byteRange)
+        if stats is not None:
+          stats.count('bytesRead', len(data))
+        return data
+
+      with fileHandle:
+        return self.decode(readBytes, pointOffset, pointRange)
+    except SliceDeleted:
+      raise NoData()
+
+  def decode(self, readBytes, pointOffset, pointRange):
+    pointCount, blockPoints, blockCount = self.readHeader(readBytes)
+    if pointOffset >= pointCount:
+      raise NoData()
+
+    if pointRange < 0:
+      endPoint = pointCount
+    else:
+      endPoint = min(pointCount, pointOffset + pointRange)
+    if endPoint <= pointOffset:
+      return ''
+
+    firstBlock = pointOffset // blockPoints
+    lastBlock = (endPoint - 1) // blockPoints
+    indexSize = (blockCount + 1) * COMPRESSED_OFFSET_SIZE
+    blockOffsets = struct.unpack('!%dL' % (lastBlock - firstBlock + 2),
+                                 readBytes(COMPRESSED_HEADER_SIZE + firstBlock * COMPRESSED_OFFSET_SIZE,
+                                           (lastBlock - firstBlock + 2) * COMPRESSED_OFFSET_SIZE))
+    dataStart = COMPRESSED_HEADER_SIZE + indexSize
+    data = readBytes(dataStart + blockOffsets[0], blockOffsets[-1] - blockOffsets[0])
+
+    wordSize = self.dataType.size
+    words = []
+    for block in xrange(firstBlock, lastBlock + 1):
+      count = min(blockPoints, pointCount - block * blockPoints)
+      words.extend(decodeBlock(data, blockOffsets[block - firstBlock] - blockOffsets[0], count, wordSize))
+
+    skip = pointOffset - firstBlock * blockPoints
+    words = words[skip:skip + endPoint - pointOffset]
+    return struct.pack('!%d%s' % (len(words), WORD_FORMATS[wordSize]), *words)
+
+  def writePacked(self, packedValues, fsPath=None):
+    """Atomically replace the slice file with the given packed values"""
+    fsPath = fsPath or self.fsPath
+    tmpPath = fsPath + '.tmp'
+    data = compressValues(packedValues, wordSize=self.dataType.size)
+    stats = self.stats
+    if stats is not None:
+      stats.count('open')
+      stats.count('bytesWritten', len(data))
+    with open(tmpPath, 'wb') as fileHandle:
+      fileHandle.write(data)
+    os.chmod(tmpPath, SLICE_PERMS)
+    os.rename(tmpPath, fsPath)
+    if self.mapPool is not None:
+      self.mapPool.invalidate(fsPath)
+
+  def write(self, sequence):
+    try:
+      packedValues = self.readPacked(0, -1)
+    except NoData:
+      if not exists(self.fsPath):
+        raise SliceDeleted()
+      packedValues = ''
+
+    dataType = self.dataType
+    beginningTime = sequence[0][0]
+    pointOffset = (beginningTime - self.startTime) / self.timeStep
+    packedSequence = dataType.pack([v for t,v in sequence])
+
+    pointGap = pointOffset - (len(packedValues) / dataType.size)
+    if pointGap > MAX_SLICE_GAP:
+      raise SliceGapTooLarge()
+    elif pointGap > 0:
+      packedValues += dataType.packedNull * pointGap
+
+    byteOffset = pointOffset * dataType.size
+    packedValues = packedValues[:byteOffset] + packedSequence + \
+                   packedValues[byteOffset + len(packedSequence):]
+    self.writePacked(packedValues)
+    self.node.clearSliceCache()
+
+  def deleteBefore(self, t):
+    stats = self.stats
+    if stats is not None:
+      stats.count('stat')
+    if not exists(self.fsPath):
+      raise SliceDeleted()
+
+    if t % self.timeStep != 0:
+      t = t - (t % self.timeStep) + self.timeStep
+    timeOffset = t - self.startTime
+    if timeOffset < 0:
+      return
+
+    pointOffset = timeOffset / self.timeStep
+    if not pointOffset:
+      return
+
+
+    try:
+      packedValues = self.readPacked(pointOffset, -1)
+    except NoData:
+      packedValues = ''
+
+    if packedValues:
+      newFsPath = join(dirname(self.fsPath), "%d@%d%s" % (t, self.timeStep, COMPRESSED_SLICE_SUFFIX))
+      self.writePacked(packedValues, newFsPath)
+      self.remove()
+    else:
+      self.remove()
+      raise SliceDeleted()
+
+  def compress(self):
+    return self
+
+  def decompress(self):
+    """Replace this slice with a raw :class:`CeresSlice` of the same data
+
+      :returns: :class:`CeresSlice`
+    """
+    try:
+      packedValues = self.readPacked(0, -1)
+    except NoData:
+      if not exists(self.fsPath):
+        raise SliceDeleted()
+      packedValues = ''
+
+    raw = CeresSlice(self.node, self.startTime, self.timeStep)
+    tmpPath = raw.fsPath + '.tmp'
+    with open(tmpPath, 'wb') as fileHandle:
+      fileHandle.write(packedValues)
+    os.chmod(tmpPath, SLICE_PERMS)
+    os.rename(tmpPath, raw.fsPath)
+    self.remove()
+    return raw
+
+
+class ReadPlan(object):
+  """The slice regions that make up a read of [`fromTime`, `untilTime`) at
+  `timeStep` resolution, as computed by :meth:`CeresNode.planRead`
+
+  :param regions: (slice, regionFrom, regionUntil, fillGaps) tuples in the
+                  order they are to be read. A region with `fillGaps` set only
+                  supplies datapoints still missing from earlier regions.
+  :param aggregationMethod: How finer slices are consolidated to `timeStep`,
+                            see :func:`consolidate`
+  """
+  __slots__ = ('fromTime', 'untilTime', 'timeStep', 'regions', 'aggregationMethod')
+
+  def __init__(self, fromTime, untilTime, timeStep, regions,
+               aggregationMethod=DEFAULT_AGGREGATION_METHOD):
+    self.fromTime = fromTime
+    self.untilTime = untilTime
+    self.timeStep = timeStep
+    self.regions = regions
+    self.aggregationMethod = aggregationMethod
+
+  def __len__(self):
+    return max(int(self.untilTime - self.fromTime) / self.timeStep, 0)
+
+  def execute(self, asArray=False, cancelled=None, first=0, last=None):
+    """Read every planned region into a single result
+
+      :keyword asArray: See :meth:`CeresTree.fetch`
+      :keyword cancelled: Optional callable checked before each slice read,
+                          the read stops with :class:`ReadCancelled` once it
+                          returns True
+      :keyword first: Index of the first datapoint of the result to read
+      :keyword last: Index past the last datapoint to read, by default the
+                     end of the interval. Reading part of the interval
+                     gives the same datapoints as reading all of it.
+
+      :returns: :class:`TimeSeriesData`
+    """
+    length = len(self)
+    if last is None or last > length:
+      last = length
+    first = min(first, last)
+
+    if not self.regions:
+      values = nullValues(last - first, asArray)
+    elif asArray and self.regions[0][0].dataType.format == 'd':
+      values = self.readArray(first, last, cancelled)
+    else:
+      values = self.readValues(first, last, asArray, cancelled)
+
+    fromTime = self.fromTime + first * self.timeStep
+    if not self.regions and last == length:
+      return TimeSeriesData(fromTime, self.untilTime, self.timeStep, values)
+
+    return TimeSeriesData(fromTime, self.fromTime + last * self.timeStep, self.timeStep, values)
+
+  def readArray(self, first, last, cancelled):
+    # float64 slices are read straight into their place in one preallocated
+    # NaN-filled array and byte-swapped there, only regions that need
+    # consolidating or only fill gaps go through intermediate values
+    values = nullValues(last - first, True)
+    for slice, fillGaps, offset, count, readFrom, readUntil in self.windows(first, last, cancelled):
+      if slice.timeStep == self.timeStep and not fillGaps and readFrom >= slice.startTime:
+        count = min(count, (readUntil - readFrom) / slice.timeStep)
+        if count <= 0:
+          continue
+        target = values[offset:offset + count]
+        # the first datapoint at or after readFrom, for slices starting between intervals
+        pointOffset = -((slice.startTime - readFrom) / slice.timeStep)
+        try:
+          read = slice.readInto(pointOffset, memoryview(target.view(numpy.uint8)))
+        except NoData:
+          continue
+        target[read:read + 1] = NAN  # clears a partially read datapoint
+        if numpy.little_endian:
+          target[:read].byteswap(True)
+        continue
+
+      regionValues = self.readRegion(slice, readFrom, readUntil, count, True)
+      if regionValues is None:
+        continue
+
+      target = values[offset:offset + len(regionValues)]
+      if fillGaps:
+        missing = numpy.isnan(target)
+        target[missing] = regionValues[missing]
+      else:
+        target[:] = regionValues
+    return values
+
+  def readValues(self, first, last, asArray, cancelled):
+    # each region is unpacked into its place in one preallocated result
+    values = nullValues(last - first, asArray)
+    for slice, fillGaps, offset, count, readFrom, readUntil in self.windows(first, last, cancelled):
+      regionValues = self.readRegion(slice, readFrom, readUntil, count, asArray)
+      if regionValues is None:
+        continue
+
+      count = len(regionValues)
+      if not fillGaps:
+        values[offset:offset + count] = regionValues
+      elif asArray:
+        target = values[offset:offset + count]
+        missing = numpy.isnan(target)
+        target[missing] = regionValues[missing]
+      else:
+        for i in xrange(count):
+          if values[offset + i] is None:
+            values[offset + i] = regionValues[i]
+    return values
+
+  def windows(self, first, last, cancelled=None):
+    """Yield `(slice, fillGaps, offset, count, readFrom, readUntil)` for each
+    region supplying result datapoints [`first`, `last`): the slice interval
+    [`readFrom`, `readUntil`) supplies up to `count` datapoints placed
+    `offset` datapoints into the result. `readFrom` is on an interval
+    boundary of the plan, so it may precede the slice."""
+    length = len(self)
+    for slice, regionFrom, regionUntil, fillGaps in self.regions:
+      if cancelled is not None and cancelled():
+        raise ReadCancelled()
+
+      # the region fills result datapoints [start, end), each consolidated
+      # from `factor` datapoints of the slice
+      start = (regionFrom - self.fromTime) / self.timeStep
+      end = min((regionUntil - self.fromTime) / self.timeStep, length)
+      factor = max(int(self.timeStep / slice.timeStep), 1)
+      readFirst = max(first - start, 0)
+      readLast = min(end, last) - start
+      if readLast <= readFirst:
+        continue
+
+      # finer datapoints are grouped on the plan's interval boundaries, a
+      # region starting between them is read from the boundary before
+      groupSpan = factor * slice.timeStep
+      groupFrom = regionFrom - ((regionFrom - self.fromTime) % self.timeStep)
+      readFrom = groupFrom + readFirst * groupSpan
+      readUntil = min(regionUntil, groupFrom + readLast * groupSpan)
+      yield slice, fillGaps, start + readFirst - first, readLast - readFirst, readFrom, readUntil
+
+  def readRegion(self, slice, readFrom, readUntil, count, asArray):
+    # up to `count` datapoints of a slice consolidated to the plan's timeStep,
+    # the slots before the slice starts are nulls at the slice's timeStep and
+    # a slice starting between them is read into the slot its start falls in
+    lead = max((slice.startTime - readFrom) / slice.timeStep, 0)
+    sliceFrom = max(slice.startTime, readFrom + (slice.startTime - readFrom) % slice.timeStep)
+    sliceUntil = readUntil + (sliceFrom - readUntil) % slice.timeStep
+    try:
+      series = slice.read(sliceFrom, sliceUntil, asArray=asArray)
+    except NoData:
+      return None
+
+    regionValues = series.values
+    if lead:
+      if asArray:
+        regionValues = numpy.concatenate((nullValues(lead, asArray), regionValues))
+      else:
+        regionValues = nullValues(lead) + regionValues
+    if slice.timeStep < self.timeStep:
+      regionValues = recalculateSeries(regionValues, slice.timeStep, self.timeStep,
+                                       self.aggregationMethod)
+    if not len(regionValues):
+      return None
+    return regionValues[:count]
+
+
+class SliceIndex(object):
+  """The slices of a node sorted by (startTime, timeStep), with their sizes
+  cached so ranges can be located by bisection without listing the node
+  directory or stat-ing slice files.
+
+  :param mtime: The node directory mtime the index was built from
+  :param slices: :class:`CeresSlice` objects in ascending order
+  """
+  __slots__ = ('mtime', 'slices', 'startTimes', 'reachEnds')
+
+  def __init__(self, mtime, slices):
+    self.mtime = mtime
+    self.slices = slices
+    self.startTimes = [slice.startTime for slice in slices]
+    self.reachEnds = None  # furthest endTime among slices[:i + 1], built lazily
+
+  def __len__(self):
+    return len(self.slices)
+
+  def add(self, slice):
+    i = bisect_left(self.startTimes, slice.startTime)
+    while i < len(self.slices) and self.startTimes[i] == slice.startTime:
+      if self.slices[i].timeStep == slice.timeStep:
+        self.slices[i] = slice
+        return
+      if self.slices[i].timeStep > slice.timeStep:
+        break
+      i += 1
+
+    self.slices.insert(i, slice)
+    self.startTimes.insert(i, slice.startTime)
+    self.reachEnds = None
+
+  def sizeChanged(self, i=None):
+    """Note that the size of `slices[i]` changed, `None` meaning any slice"""
+    reachEnds = self.reachEnds
+    if reachEnds is None:
+      return
+
+    if i == len(reachEnds) - 1:
+      endTime = self.slices[i].endTime
+      reachEnds[i] = max(reachEnds[i - 1], endTime) if i else endTime
+    else:
+      self.reachEnds = None
+
+  def writable(self, fromTime, untilTime):
+    """Positions of the slices that writes to [`fromTime`, `untilTime`) go
+    to, those starting within it and the latest starting before it"""
+    hi = bisect_left(self.startTimes, untilTime)
+    lo = max(min(bisect_right(self.startTimes, fromTime), hi) - 1, 0)
+    return xrange(lo, hi)
+
+  def between(self, fromTime, untilTime):
+    """See :meth:`CeresNode.slicesForInterval`"""
+    if self.reachEnds is None:
+      reachEnds = []
+      reach = None
+      for slice in self.slices:
+        reach = max(reach, slice.endTime)
+        reachEnds.append(reach)
+      self.reachEnds = reachEnds
+
+    hi = bisect_left(self.startTimes, untilTime)
+    lo = min(bisect_right(self.startTimes, fromTime), hi)
+    selected = self.slices[lo:hi][::-1]
+
+    # slices starting at or before fromTime, only while some of them reach it
+    i = lo - 1
+    while i >= 0 and self.reachEnds[i] > fromTime:
+      if self.slices[i].endTime > fromTime:
+        selected.append(self.slices[i])
+      i -= 1
+
+    return selected
+
+
+class NodeCache(object):
+  """A bounded cache of :class:`CeresNode` objects, evicted least recently
+  used first
+
+  Metric names found not to be nodes are remembered for `negativeTTL` seconds,
+  so repeated lookups of metrics that do not exist yet skip the filesystem.
+  :meth:`CeresTree.createNode` drops the negative entry of the node it
+  creates, nodes created by other processes are seen once the entry expires.
+
+  :param maxSize: The maximum number of entries, `None` for no limit
+  :param negativeTTL: Seconds to remember a missing metric name
+  """
+  MISSING = object()
+
+  def __init__(self, maxSize, negativeTTL):
+    self.maxSize = maxSize
+    self.negativeTTL = negativeTTL
+    self.entries = OrderedDict()  # nodePath -> CeresNode, or expiry time of a missing name
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.negativeHits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, nodePath):
+    """Returns the cached node, :attr:`MISSING` for a name known not to be
+    a node, or `None` when the name is not cached"""
+    with self.lock:
+      entry = self.entries.pop(nodePath, None)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      if isinstance(entry, float):
+        if entry <= time.time():  # expired
+          self.misses += 1
+          return None
+        self.negativeHits += 1
+        result = self.MISSING
+      else:
+        self.hits += 1
+        result = entry
+
+      self.entries[nodePath] = entry  # reinsert as most recently used
+      return result
+
+  def add(self, nodePath, node):
+    with self.lock:
+      self._insert(nodePath, node)
+
+  def addMissing(self, nodePath):
+    if self.negativeTTL:
+      with self.lock:
+        self._insert(nodePath, time.time() + self.negativeTTL)
+
+  def invalidate(self, nodePath):
+    with self.lock:
+      self.entries.pop(nodePath, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    """Returns a dict of the cache's size and hit, miss and eviction counts"""
+    return {
+      'size': len(self.entries),
+      'hits': self.hits,
+      'negativeHits': self.negativeHits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
+
+  def _insert(self, nodePath, entry):
+    self.entries.pop(nodePath, None)
+    if self.maxSize is not None:
+      while self.entries and len(self.entries) >= self.maxSize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+    if self.maxSize != 0:
+      self.entries[nodePath] = entry
+
+
+class ReadCache(object):
+  """A cache of :meth:`CeresNode.read` results keyed on the node and the
+  aligned interval and timeStep of the read, bounded by the approximate
+  memory the results take up and evicted least recently used first.
+
+  :meth:`CeresNode.write` and :meth:`CeresNode.deleteBefore` drop the cached
+  reads of the interval they change. Changes made by other processes are
+  caught by checking, on each hit, the size and mtime of the node directory
+  and of the slices the read covered, along with the slice before them that
+  appends could extend into the interval. Entries covering a file modified
+  within :const:`MTIME_GRANULARITY` seconds of caching them are not trusted,
+  as a later change in the same mtime tick would go unnoticed.
+
+  :param maxBytes: The approximate size limit of the cached results
+  """
+  def __init__(self, maxBytes):
+    self.maxBytes = maxBytes
+    self.entries = OrderedDict()  # key -> [series, paths, stamps, bytes]
+    self.nodeKeys = {}  # nodePath -> set of keys
+    self.generations = {}  # nodePath -> invalidation count
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.stale = 0
+    self.invalidations = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def read(self, node, fromTime, untilTime, asArray=False):
+    """Return the result of reading [`fromTime`, `untilTime`) from `node`
+    from the cache, reading and caching it on a miss
+
+      :returns: :class:`TimeSeriesData`, a copy the caller may modify
+    """
+    # stamped before planning so that slices added meanwhile are noticed
+    dirStamp = fileStamps([node.fsPath])
+    plan = node.planRead(fromTime, untilTime)
+    key = (node.nodePath, plan.fromTime, plan.untilTime, plan.timeStep)
+    with self.lock:
+      generation = self.generations.get(node.nodePath, 0)
+      entry = self.entries.pop(key, None)
+      if entry is not None:
+        self.entries[key] = entry  # reinsert as most recently used
+
+    if entry is not None and entry[2] is not None and fileStamps(entry[1]) == entry[2]:
+      with self.lock:
+        self.hits += 1
+      return self._copy(entry[0], asArray)
+
+    with self.lock:
+      if entry is not None:
+        self.stale += 1
+      self.misses += 1
+
+    paths = [node.fsPath] + self._slicePaths(node, plan)
+    stamps = fileStamps(paths[1:])
+    if dirStamp is None or stamps is None or self._racy(dirStamp + stamps):
+      stamps = None
+    else:
+      stamps = dirStamp + stamps
+
+    series = plan.execute(asArray=asArray)
+    self._store(key, generation, series, paths, stamps)
+    return self._copy(series, asArray)
+
+  def invalidate(self, nodePath, fromTime=None, untilTime=None):
+    """Drop the cached reads of a node overlapping [`fromTime`, `untilTime`),
+    either bound may be `None` to leave that side open"""
+    with self.lock:
+      self.generations[nodePath] = self.generations.get(nodePath, 0) + 1
+      keys = self.nodeKeys.get(nodePath)
+      if not keys:
+        return
+
+      for key in list(keys):
+        if fromTime is not None and key[2] <= fromTime:
+          continue
+        if untilTime is not None and key[1] >= untilTime:
+          continue
+        self._remove(key)
+        self.invalidations += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nodeKeys.clear()
+      self.bytes = 0
+
+  def stats(self):
+    """Returns a dict of the cache's size, hit rate and hit, miss, stale
+    entry, invalidation and eviction counts"""
+    lookups = self.hits + self.misses
+    return {
+      'size': len(self.entries),
+      'bytes': self.bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hitRate': float(self.hits) / lookups if lookups else 0.0,
+      'stale': self.stale,
+      'invalidations': self.invalidations,
+      'evictions': self.evictions,
+    }
+
+  @staticmethod
+  def _slicePaths(node, plan):
+    # the slices the plan reads, and for each timeStep the latest slice
+    # starting before the interval, which an append could extend into it
+    paths = []
+    seen = set()
+    for region in plan.regions:
+      if region[0].fsPath not in seen:
+        seen.add(region[0].fsPath)
+        paths.append(region[0].fsPath)
+
+    preceding = {}
+    for slice in node.slices:
+      if slice.startTime < plan.fromTime and slice.timeStep not in preceding:
+        preceding[slice.timeStep] = slice
+    for slice in preceding.values():
+      if slice.fsPath not in seen:
+        paths.append(slice.fsPath)
+    return paths
+
+  @staticmethod
+  def _racy(stamps):
+    recent = time.time() - MTIME_GRANULARITY
+    return any(mtime >= recent for size, mtime in stamps)
+
+  def _store(self, key, generation, series, paths, stamps):
+    if series.isArray:
+      size = READ_CACHE_ENTRY_OVERHEAD + series.values.nbytes
+    else:
+      size = READ_CACHE_ENTRY_OVERHEAD + len(series.values) * 32  # pointer and float object
+    if size > self.maxBytes:
+      return
+
+    nodePath = key[0]
+    with self.lock:
+      if self.generations.get(nodePath, 0) != generation:
+        return  # written to while this was being read
+
+      self._remove(key)
+      while self.entries and self.bytes + size > self.maxBytes:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+
+      self.entries[key] = [series, paths, stamps, size]
+      self.nodeKeys.setdefault(nodePath, set()).add(key)
+      self.bytes += size
+
+  def _remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return
+    self.bytes -= entry[3]
+    keys = self.nodeKeys[key[0]]
+    keys.discard(key)
+    if not keys:
+      del self.nodeKeys[key[0]]
+
+  @staticmethod
+  def _copy(series, asArray):
+    values = series.values
+    if asArray:
+      values = values.copy() if series.isArray else toArray(values)
+    elif series.isArray:
+      values = [None if isnan(v) else v for v in values]
+    else:
+      values = list(values)
+    return TimeSeriesData(series.startTime, series.endTime, series.timeStep, values)
+
+
+class SliceMapPool(object):
+  """A bounded pool of read-only memory-mapped slice files, evicted least
+  recently used first.
+
+  Each access costs a single `fstat` on the pooled descriptor instead of an
+  open/stat/seek/read/close sequence. The mapping is redone when the file has
+  grown (or shrunk) since it was mapped, so appends made by other processes
+  are picked up and a truncated file is never read past its end.
+
+  Slices this process trims are kept out of the pool while they shrink, see
+  :meth:`unmapped`. Another process shrinking a slice between that `fstat`
+  and the copy out of the mapping kills this one with SIGBUS, so trimming
+  slices in place with :func:`trimFile`, by collapsing or copying, is unsafe
+  while other processes read them through a pool.
+
+  :param maxSize: The maximum number of slice files kept mapped
+  """
+  def __init__(self, maxSize):
+    self.maxSize = maxSize
+    self.entries = OrderedDict()  # fsPath -> [fd, mmap, mappedSize]
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def size(self, fsPath):
+    """Return the current size of a slice file in bytes"""
+    with self.lock:
+      return self._refresh(fsPath, self._acquire(fsPath))
+
+  def read(self, fsPath, byteOffset, byteRange):
+    """Return up to `byteRange` bytes of a slice file starting at `byteOffset`,
+    or `None` if the file ends before `byteOffset`. Like `file.read`, a
+    negative `byteRange` reads to the end of the file."""
+    with self.lock:
+      entry = self._acquire(fsPath)
+      size = self._refresh(fsPath, entry)
+      if byteOffset >= size:
+        return None
+
+      if byteRange < 0:
+        return entry[1][byteOffset:size]
+      return entry[1][byteOffset:byteOffset + byteRange]
+
+  def invalidate(self, fsPath):
+    """Drop the mapping of a slice file that is being rewritten, renamed or removed"""
+    with self.lock:
+      entry = self.entries.pop(fsPath, None)
+      if entry is not None:
+        self._close(entry)
+
+  @contextmanager
+  def unmapped(self, fsPath):
+    """Keep a slice file unmapped, and reads of any slice waiting, while it
+    is shrunk in place"""
+    with self.lock:
+      entry = self.entries.pop(fsPath, None)
+      if entry is not None:
+        self._close(entry)
+      yield
+
+  def clear(self):
+    with self.lock:
+      while self.entries:
+        self._close(self.entries.popitem()[1])
+
+  def _acquire(self, fsPath):
+    entry = self.entries.pop(fsPath, None)
+    if entry is None:
+      try:
+        fd = os.open(fsPath, os.O_RDONLY)
+      except OSError, e:
+        if e.errno == errno.ENOENT:
+          raise SliceDeleted()
+        raise
+
+      entry = [fd, None, 0]
+      while len(self.entries) >= self.maxSize:
+        self._close(self.entries.popitem(last=False)[1])
+
+    self.entries[fsPath] = entry  # (re)insert as most recently used
+    return entry
+
+  def _refresh(self, fsPath, entry):
+    stat = os.fstat(entry[0])
+    if stat.st_nlink == 0:
+      del self.entries[fsPath]
+      self._close(entry)
+      raise SliceDeleted()
+
+    if stat.st_size != entry[2]:
+      if entry[1] is not None:
+        entry[1].close()
+        entry[1] = None
+      if stat.st_size:
+        entry[1] = mmap.mmap(entry[0], stat.st_size, access=mmap.ACCESS_READ)
+      entry[2] = stat.st_size
+
+    return entry[2]
+
+  @staticmethod
+  def _close(entry):
+    if entry[1] is not None:
+      entry[1].close()
+    os.close(entry[0])
+
+
+class TimeSeriesData(object):
+  """A run of evenly spaced datapoints
+
+  ``values`` is either a list using `None` for missing points, or a numpy
+  float64 array using NaN for missing points when read with ``asArray``.
+  Iterating always yields `None` for missing points.
+  """
+  __slots__ = ('startTime', 'endTime', 'timeStep', 'values')
+
+  def __init__(self, startTime, endTime, timeStep, values):
+    self.startTime = startTime
+    self.endTime = endTime
+    self.timeStep = timeStep
+    self.values = values
+
+  @property
+  def timestamps(self):
+    return xrange(self.startTime, self.endTime, self.timeStep)
+
+  @property
+  def isArray(self):
+    return isArray(self.values)
+
+  def __iter__(self):
+    if self.isArray:
+      return izip(self.timestamps, (None if isnan(v) else v for v in self.values))
+    return izip(self.timestamps, self.values)
+
+  def __len__(self):
+    return len(self.values)
+
+  def __add__(self, other):
+    if self.timeStep != other.timeStep:
+      raise ValueError("Can't sum data with different timestamps. Mine is %s, other's is %s" %
+                         (self.timeStep, other.timeStep))
+    if self.isArray or other.isArray:
+      values = numpy.concatenate((toArray(self.values), toArray(other.values)))
+    else:
+      values = self.values + other.values
+    new_data = TimeSeriesData(self.startTime, other.endTime, self.timeStep, values)
+    return new_data
+
+  def merge(self, other):
+    """
+    Merge two TimeSeriesData objects together
+
+    :param other: another TimeSeriesData object, that'll be merged. Note, other.startTime must be greater than self's.
+    :return: Nothing
+    """
+    if self.timeStep != other.timeStep:
+        raise ValueError("Can't merge data with different timestamps. Mine is %s, other's is %s" %
+                           (self.timeStep, other.timeStep))
+    # Align timestamp
+    ts = other.startTime - (other.startTime % self.timeStep)
+    index = int((ts - self.startTime) / self.timeStep)
+    if self.isArray:
+      otherValues = toArray(other.values)
+      overlap = max(0, min(len(otherValues), len(self.values) - index))
+      self.values[index:index + overlap] = otherValues[:overlap]
+      if overlap < len(otherValues):
+        self.values = numpy.concatenate((self.values, otherValues[overlap:]))
+      if other.endTime > self.endTime:
+        self.endTime = other.endTime
+      return
+    for value in other.values:
+      # Adjust timestamp to be aligned on timeStep boundary.
+      if ts > self.endTime:
+        self.values.append(value)
+      else:
+        try:
+          self.values[index] = value
         except IndexError:
           self.values.append(value)
         index += 1
@@ -739,6 +2643,1279 @@ class TimeSeriesData(object):
       self.endTime = other.endTime
 
 
+class DataType(object):
+  """How a node's datapoints are encoded in its slices, selected by the
+  `dataType` node metadata. See :data:`DATA_TYPES`.
+
+  :param name: The metadata name of the type
+  :param format: The :mod:`struct` format character of one datapoint
+  :param dtype: The equivalent big-endian numpy dtype
+  :param null: The value stored for a missing datapoint
+  """
+  __slots__ = ('name', 'format', 'size', 'dtype', 'null', 'packedNull', 'isInteger')
+
+  def __init__(self, name, format, dtype, null):
+    self.name = name
+    self.format = format
+    self.size = struct.calcsize('!' + format)
+    self.dtype = dtype
+    self.null = null
+    self.packedNull = struct.pack('!' + format, null)
+    self.isInteger = format == 'q'
+
+  def __repr__(self):
+    return "<DataType: %s>" % self.name
+  __str__ = __repr__
+
+  def pack(self, values):
+    """Pack a list of numbers, values that cannot be represented are stored as missing"""
+    if self.isInteger:
+      values = [int(v) if not (isnan(v) or isinf(v)) else self.null for v in values]
+    try:
+      return struct.pack('!%d%s' % (len(values), self.format), *values)
+    except (OverflowError, struct.error):
+      return ''.join(self.packOne(v) for v in values)
+
+  def packOne(self, value):
+    try:
+      return struct.pack('!' + self.format, value)
+    except (OverflowError, struct.error):
+      if self.isInteger:
+        return self.packedNull
+      return struct.pack('!' + self.format, INF if value > 0 else -INF)
+
+  def unpack(self, packedValues):
+    """Unpack datapoints to a list using `None` for missing points"""
+    count = len(packedValues) / self.size
+    if len(packedValues) != count * self.size:
+      packedValues = packedValues[:count * self.size]
+    values = struct.unpack('!%d%s' % (count, self.format), packedValues)
+    if self.isInteger:
+      return [v if v != self.null else None for v in values]
+    return [v if not isnan(v) else None for v in values]
+
+  def unpackArray(self, packedValues):
+    """Unpack datapoints to a native float64 array, NaN marks missing points"""
+    requireNumpy()
+    count = len(packedValues) / self.size
+    raw = numpy.frombuffer(packedValues, dtype=self.dtype, count=count)
+    values = raw.astype(numpy.float64)
+    if self.isInteger:
+      values[raw == self.null] = NAN
+    return values
+
+
+DATA_TYPES = {
+  'float64': DataType('float64', 'd', DATAPOINT_DTYPE, NAN),
+  'float32': DataType('float32', 'f', '>f4', NAN),
+  'int64': DataType('int64', 'q', '>i8', INT64_NULL),
+}
+WORD_FORMATS = {4: 'L', 8: 'Q'}
+
+
+class CeresWriteBuffer(object):
+  """Accumulates datapoints per node in memory and writes each node's
+  points in a single :meth:`CeresNode.write` call, so a node receiving a few
+  points per flush costs one slice lookup and one file write per batch
+  instead of per point.
+
+  :param tree: The :class:`CeresTree` to write to
+  :keyword maxPoints: Write a node once it has this many points buffered
+  :keyword maxAge: Write a node once its oldest buffered point has waited this
+                   many seconds. Ages are checked on every :meth:`store` and by
+                   :meth:`flushExpired`.
+  :keyword maxBufferedPoints: Optional cap on points buffered across all nodes,
+                              nodes are written in `order` until back under it
+  :keyword order: Which nodes to write first when flushing several:
+                  `'oldest'` buffered first or `'largest'` batch first
+  """
+  def __init__(self, tree, maxPoints=DEFAULT_WRITE_BUFFER_POINTS, maxAge=DEFAULT_WRITE_BUFFER_AGE,
+               maxBufferedPoints=None, order='oldest'):
+    if order not in WRITE_BUFFER_FLUSH_ORDERS:
+      raise ValueError("invalid flush order '%s'" % order)
+
+    self.tree = tree
+    self.maxPoints = maxPoints
+    self.maxAge = maxAge
+    self.maxBufferedPoints = maxBufferedPoints
+    self.order = order
+    self.buffers = OrderedDict()  # nodePath -> (bufferedSince, datapoints), oldest first
+    self.bufferedPoints = 0
+    self.lock = threading.RLock()
+
+  def __repr__(self):
+    return "<CeresWriteBuffer[0x%x]: %s>" % (id(self), self.tree.root)
+  __str__ = __repr__
+
+  def __len__(self):
+    return self.bufferedPoints
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def store(self, nodePath, datapoints):
+    """Buffer datapoints for a metric, writing any batches that are due
+
+      :keyword nodePath: The metric name to write to
+      :keyword datapoints: A list of datapoint tuples: (timestamp, value)
+      :raises: :class:`NodeNotFound`
+    """
+    if not datapoints:
+      return
+
+    with self.lock:
+      entry = self.buffers.get(nodePath)
+      if entry is None:
+        if self.tree.getNode(nodePath) is None:
+          raise NodeNotFound("The node '%s' does not exist in this tree" % nodePath)
+        entry = self.buffers[nodePath] = (time.time(), [])
+
+      entry[1].extend(datapoints)
+      self.bufferedPoints += len(datapoints)
+
+      if len(entry[1]) >= self.maxPoints:
+        self.flushNode(nodePath)
+
+      self.flushExpired()
+
+      if self.maxBufferedPoints is not None:
+        for bufferedPath in self.flushOrder():
+          if self.bufferedPoints <= self.maxBufferedPoints:
+            break
+          self.flushNode(bufferedPath)
+
+  def flushOrder(self):
+    """Buffered metric names in the order they are written"""
+    if self.order == 'largest':
+      return sorted(self.buffers, key=lambda nodePath: len(self.buffers[nodePath][1]), reverse=True)
+    return list(self.buffers)
+
+  def flushNode(self, nodePath):
+    """Write the points buffered for one metric. If the write fails the
+    points are dropped and the error is raised."""
+    with self.lock:
+      entry = self.buffers.pop(nodePath, None)
+      if entry is None:
+        return
+
+      self.bufferedPoints -= len(entry[1])
+      node = self.tree.getNode(nodePath)
+      if node is None:
+        raise NodeNotFound("The node '%s' does not exist in this tree" % nodePath)
+      node.write(entry[1])
+
+  def flushExpired(self, now=None):
+    """Write every metric whose oldest buffered point is older than `maxAge`"""
+    if now is None:
+      now = time.time()
+
+    with self.lock:
+      expired = []
+      for nodePath, (bufferedSince, datapoints) in self.buffers.iteritems():
+        if now - bufferedSince < self.maxAge:
+          break  # buffers are kept oldest first
+        expired.append(nodePath)
+
+      if self.order == 'largest':
+        expired.sort(key=lambda nodePath: len(self.buffers[nodePath][1]), reverse=True)
+
+      for nodePath in expired:
+        self.flushNode(nodePath)
+
+  def flush(self):
+    """Write everything buffered"""
+    with self.lock:
+      for nodePath in self.flushOrder():
+        self.flushNode(nodePath)
+
+  def close(self):
+    self.flush()
+
+
+class MetricPattern(object):
+  """A graphite metric pattern compiled for matching against metric names
+  and for walking a tree
+
+  Each dot-separated component may use `*`, `?`, character classes such as
+  `[0-9]` or `[!a]`, and `{a,b,c}` alternation, which can nest and contain
+  wildcards. The tree is walked one component at a time: literal components
+  (including braces of literals) are joined on without listing their parent
+  and other components list only the directories that matched so far. Levels
+  wider than :const:`FIND_PARALLEL_WIDTH` directories are listed in parallel.
+
+  :param pattern: The pattern string, e.g. `servers.{web,db}[0-9].cpu.*`
+  """
+  __slots__ = ('pattern', 'components', 'regex')
+
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self.components = [PatternComponent(component) for component in pattern.split('.')]
+    self.regex = re.compile(r'\.'.join(component.regex.pattern[:-2]
+                                       for component in self.components) + r'\Z')
+
+  def __repr__(self):
+    return "<MetricPattern[0x%x]: %s>" % (id(self), self.pattern)
+  __str__ = __repr__
+
+  def matches(self, nodePath):
+    """Returns whether a metric name matches this pattern"""
+    return self.regex.match(nodePath) is not None
+
+  def expand(self, root, pool=None, stats=None):
+    """Yield the metric names under `root` whose directories match this
+    pattern. Matches are candidates, they are not checked for being nodes.
+
+      :param root: The tree root directory
+      :param pool: An optional :class:`multiprocessing.pool.ThreadPool` to
+                   list wide levels with
+      :param stats: An optional :class:`Instrumentation` to count listings in
+    """
+    frontier = [(root, [])]
+    for depth, component in enumerate(self.components):
+      if not frontier:
+        return
+
+      if component.literals is not None:
+        frontier = [(join(fsPath, name), parts + [name])
+                    for fsPath, parts in frontier for name in component.literals]
+        continue
+
+      fsPaths = [fsPath for fsPath, parts in frontier]
+      if stats is not None:
+        stats.count('listdir', len(fsPaths))
+      if pool is not None and len(fsPaths) >= FIND_PARALLEL_WIDTH:
+        listings = pool.map(component.children, fsPaths)
+      else:
+        listings = [component.children(fsPath) for fsPath in fsPaths]
+
+      frontier = [(join(fsPath, name), parts + [name])
+                  for (fsPath, parts), names in izip(frontier, listings) for name in names]
+
+    for fsPath, parts in frontier:
+      yield '.'.join(parts)
+
+
+class PatternComponent(object):
+  """One dot-separated component of a :class:`MetricPattern`"""
+  __slots__ = ('literals', 'regex')
+
+  def __init__(self, component):
+    alternatives = expandBraces(component)
+    if any(re.search(r'[*?\[]', alternative) for alternative in alternatives):
+      self.literals = None
+    else:
+      self.literals = sorted(set(alternatives))
+    self.regex = re.compile(r'(?:%s)\Z' % '|'.join(globToRegex(alternative)
+                                                  for alternative in alternatives))
+
+  def children(self, fsPath):
+    """The entries of a directory this component matches, hidden entries
+    and ones that cannot be metric names are skipped"""
+    try:
+      names = os.listdir(fsPath)
+    except OSError:  # missing, or not a directory
+      return []
+    return sorted(name for name in names
+                  if '.' not in name and self.regex.match(name))
+
+
+def expandBraces(pattern):
+  """Expand graphite `{a,b}` alternation, returning the list of patterns"""
+  start = pattern.find('{')
+  if start == -1:
+    return [pattern]
+
+  depth = 0
+  alternatives = []
+  last = start + 1
+  for i in xrange(start, len(pattern)):
+    char = pattern[i]
+    if char == '{':
+      depth += 1
+    elif char == '}':
+      depth -= 1
+      if depth == 0:
+        alternatives.append(pattern[last:i])
+        break
+    elif char == ',' and depth == 1:
+      alternatives.append(pattern[last:i])
+      last = i + 1
+  else:  # unbalanced, the brace is literal
+    return [pattern[:start + 1] + rest for rest in expandBraces(pattern[start + 1:])]
+
+  head, tail = pattern[:start], pattern[i + 1:]
+  return [head + expanded + rest
+          for alternative in alternatives
+          for expanded in expandBraces(alternative)
+          for rest in expandBraces(tail)]
+
+
+def globToRegex(pattern):
+  """Translate a brace-free glob pattern into a regular expression"""
+  regex = []
+  i = 0
+  while i < len(pattern):
+    char = pattern[i]
+    i += 1
+    if char == '*':
+      regex.append('[^.]*')
+    elif char == '?':
+      regex.append('[^.]')
+    elif char == '[':
+      end = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', '^') else i)
+      if end == -1 or end == i:
+        regex.append('\\[')
+        continue
+      charClass = pattern[i:end]
+      if charClass[0] in ('!', '^'):
+        charClass = '^.' + charClass[1:]
+      regex.append('[%s]' % charClass.replace('\\', '\\\\'))
+      i = end + 1
+    else:
+      regex.append(re.escape(char))
+  return ''.join(regex)
+
+
+class MetricNameIndex(object):
+  """A persistent index of the metric names in a tree, kept under
+  `.ceres-tree` so :meth:`CeresTree.find` can resolve patterns without
+  walking the directory hierarchy
+
+  The index is a file of sorted, newline separated metric names which is
+  memory-mapped and searched by bisection, plus an append-only log of names
+  created since it was last rebuilt. :meth:`match` resolves patterns one
+  component at a time, as :meth:`MetricPattern.expand` walks the tree:
+  literal components are looked up directly and wildcard components step
+  through the distinct children of each matched prefix, skipping the names
+  below each child with one bisection.
+
+  :param tree: The :class:`CeresTree` being indexed
+  """
+  def __init__(self, tree):
+    self.tree = tree
+    self.path = join(tree.root, '.ceres-tree', NAME_INDEX_FILE)
+    self.logPath = self.path + '.log'
+    self.lock = threading.Lock()
+    self.base = None
+    self.baseStat = None
+    self.logNames = set()
+    self.logSize = 0
+    self.logStat = None
+
+  def __repr__(self):
+    return "<MetricNameIndex[0x%x]: %s>" % (id(self), self.path)
+  __str__ = __repr__
+
+  def add(self, nodePath):
+    """Record a newly created metric"""
+    fd = os.open(self.logPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, SLICE_PERMS)
+    try:
+      os.write(fd, nodePath + '\n')
+    finally:
+      os.close(fd)
+
+  def rebuild(self):
+    """Rewrite the index from the nodes on disk and empty the log"""
+    # names created while walking land in a fresh log and are not lost
+    pendingLog = self.logPath + '.rebuilding'
+    try:
+      os.rename(self.logPath, pendingLog)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+    names = sorted(node.nodePath for node in self.tree.walk())
+    if not isdir(dirname(self.path)):
+      os.makedirs(dirname(self.path), DIR_PERMS)
+    tmpPath = self.path + '.tmp'
+    with open(tmpPath, 'wb') as fh:
+      for name in names:
+        fh.write(name + '\n')
+    os.chmod(tmpPath, SLICE_PERMS)
+    os.rename(tmpPath, self.path)
+
+    if exists(pendingLog):
+      os.unlink(pendingLog)
+
+  def names(self, prefix=''):
+    """Yield the indexed metric names starting with `prefix`"""
+    with self.lock:
+      self._refresh()
+      base = self.base
+      logNames = [name for name in self.logNames if name.startswith(prefix)]
+
+    seen = set()
+    if base is not None:
+      offset = self._seek(base, prefix)
+      size = len(base)
+      while offset < size:
+        end = base.find('\n', offset)
+        if end == -1:
+          end = size
+        name = base[offset:end]
+        if not name.startswith(prefix):
+          break
+        seen.add(name)
+        yield name
+        offset = end + 1
+
+    for name in sorted(logNames):
+      if name not in seen:
+        yield name
+
+  def match(self, nodePattern):
+    """Yield the indexed metric names matching a pattern
+
+      :param nodePattern: A pattern string or a compiled :class:`MetricPattern`
+    """
+    if not isinstance(nodePattern, MetricPattern):
+      nodePattern = MetricPattern(nodePattern)
+
+    with self.lock:
+      self._refresh()
+      base = self.base
+      logNames = [name for name in self.logNames if nodePattern.matches(name)]
+
+    # prefixes of the indexed names matched so far, each ending in a dot
+    frontier = [''] if base is not None else []
+    last = len(nodePattern.components) - 1
+    matched = []
+    for depth, component in enumerate(nodePattern.components):
+      if not frontier:
+        break
+      isLast = depth == last
+      nextFrontier = []
+      for prefix in frontier:
+        if component.literals is not None:
+          children = component.literals
+        else:
+          children = [name for name in self._children(base, prefix, isLast)
+                      if component.regex.match(name)]
+
+        for name in children:
+          if isLast:
+            if self._line(base, self._seek(base, prefix + name))[0] == prefix + name:
+              matched.append(prefix + name)
+          else:
+            childPrefix = prefix + name + '.'
+            if self._line(base, self._seek(base, childPrefix))[0].startswith(childPrefix):
+              nextFrontier.append(childPrefix)
+      frontier = nextFrontier
+
+    seen = set(matched)
+    for name in matched:
+      yield name
+
+    for name in sorted(logNames):
+      if name not in seen:
+        yield name
+
+  @classmethod
+  def _children(cls, base, prefix, isLast):
+    """The distinct components following `prefix` in the indexed names,
+    those ending a name when `isLast` and those with names below otherwise"""
+    children = set()
+    offset = cls._seek(base, prefix)
+    while offset < len(base):
+      line, nextOffset = cls._line(base, offset)
+      if not line.startswith(prefix):
+        break
+      rest = line[len(prefix):]
+      dot = rest.find('.')
+      if dot == -1:
+        if isLast:
+          children.add(rest)
+        offset = nextOffset
+      else:
+        child = rest[:dot]
+        if not isLast:
+          children.add(child)
+        # '/' sorts right after '.', past every name below the child
+        offset = cls._seek(base, prefix + child + '/')
+    return sorted(children)
+
+  @staticmethod
+  def _line(base, offset):
+    """The line at `offset` and the offset of the next one"""
+    end = base.find('\n', offset)
+    if end == -1:
+      end = len(base)
+    return base[offset:end], end + 1
+
+  @staticmethod
+  def _seek(base, prefix):
+    """Offset of the first line not sorting before `prefix`"""
+    lo, hi = 0, len(base)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = base.rfind('\n', 0, mid) + 1
+      end = base.find('\n', start)
+      if end == -1:
+        end = len(base)
+      if base[start:end] < prefix:
+        lo = end + 1
+      else:
+        hi = start
+    return lo
+
+  def _refresh(self):
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      stat = None
+
+    if stat is None or self.baseStat is None or \
+       (stat.st_ino, stat.st_size, stat.st_mtime) != self.baseStat:
+      if self.base is not None:
+        self.base.close()
+        self.base = None
+      self.baseStat = None
+      if stat is not None and stat.st_size:
+        with open(self.path, 'rb') as fh:
+          self.base = mmap.mmap(fh.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+      if stat is not None:
+        self.baseStat = (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    try:
+      logStat = os.stat(self.logPath)
+    except OSError:
+      self.logNames, self.logSize, self.logStat = set(), 0, None
+      return
+
+    if self.logStat is None or logStat.st_ino != self.logStat.st_ino or logStat.st_size < self.logSize:
+      self.logNames, self.logSize = set(), 0  # log was replaced by a rebuild
+
+    if logStat.st_size > self.logSize:
+      with open(self.logPath, 'rb') as fh:
+        fh.seek(self.logSize)
+        data = fh.read(logStat.st_size - self.logSize)
+      complete = data.rfind('\n') + 1  # leave a partially written line for later
+      self.logNames.update(name for name in data[:complete].split('\n') if name)
+      self.logSize += complete
+
+    self.logStat = logStat
+
+
+class ExtentCatalog(object):
+  """A SQLite catalog under `.ceres-tree` of each node's earliest and latest
+  data timestamps and timeStep, which lets time-filtered :meth:`CeresTree.find`
+  calls skip the nodes without data in the interval without listing their slices
+
+  Writes widen a node's extents, cataloging it if it was not, and
+  :meth:`CeresNode.deleteBefore` moves its earliest extent up to the data
+  left. These changes are batched in memory, and are written out every
+  :const:`DEFAULT_EXTENT_FLUSH_INTERVAL` seconds or
+  :const:`DEFAULT_EXTENT_FLUSH_SIZE` nodes, on :meth:`CeresTree.close` and at
+  exit, so other processes see them after a short delay. Nodes missing from
+  the catalog are looked up on disk.
+
+  :param tree: The :class:`CeresTree` being cataloged
+  """
+  def __init__(self, tree, flushInterval=DEFAULT_EXTENT_FLUSH_INTERVAL,
+               flushSize=DEFAULT_EXTENT_FLUSH_SIZE):
+    self.tree = tree
+    self.path = join(tree.root, '.ceres-tree', EXTENT_CATALOG_FILE)
+    self.flushInterval = flushInterval
+    self.flushSize = flushSize
+    # nodePath -> (earliest, latest, timeStep) written, all None without
+    # writes, and the earliest extent the data before was trimmed to or None
+    self.pending = {}
+    self.lastFlush = time.time()
+    self.lock = threading.RLock()
+    self.connection = None
+    openCatalogs.add(self)
+
+  def __repr__(self):
+    return "<ExtentCatalog[0x%x]: %s>" % (id(self), self.path)
+  __str__ = __repr__
+
+  def get(self, nodePath):
+    """Returns a node's (earliest, latest, timeStep), or `None` if it is not
+    cataloged. `latest` is the end of the last datapoint."""
+    with self.lock:
+      row = self.db.execute('SELECT earliest, latest, timeStep FROM extents WHERE nodePath = ?',
+                            (nodePath,)).fetchone()
+      if row is not None:
+        row = tuple(row)
+      change = self.pending.get(nodePath)
+      if change is None:
+        return row
+      return self._apply(row, change)
+
+  def extend(self, nodePath, earliest, latest, timeStep):
+    """Note that a node has been written to between `earliest` and `latest`
+    at `timeStep`"""
+    with self.lock:
+      trimmedTo = None
+      change = self.pending.get(nodePath)
+      if change is not None:
+        trimmedTo = change[3]
+        if change[0] is not None:
+          if latest < change[1]:
+            timeStep = change[2]
+          earliest, latest = min(earliest, change[0]), max(latest, change[1])
+      self.pending[nodePath] = (earliest, latest, timeStep, trimmedTo)
+      self._maybeFlush()
+
+  def trim(self, nodePath, earliest):
+    """Note that a node's data before `earliest` has been deleted"""
+    with self.lock:
+      writtenFrom, writtenUntil, timeStep, trimmedTo = self.pending.get(nodePath, (None,) * 4)
+      if writtenFrom is not None:
+        writtenFrom = max(writtenFrom, earliest)
+        if writtenFrom >= writtenUntil:
+          writtenFrom = writtenUntil = timeStep = None
+      if trimmedTo is not None:
+        earliest = max(earliest, trimmedTo)
+      self.pending[nodePath] = (writtenFrom, writtenUntil, timeStep, earliest)
+      self._maybeFlush()
+
+  def drop(self, nodePath):
+    """Forget a node's extents after all of its data has been deleted"""
+    self.trim(nodePath, INF)
+
+  def flush(self):
+    """Write the batched changes to the catalog"""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+      self.lastFlush = time.time()
+      if not pending:
+        return
+
+      with self.db:
+        for nodePath, change in pending.items():
+          row = self.db.execute('SELECT earliest, latest, timeStep FROM extents WHERE nodePath = ?',
+                                (nodePath,)).fetchone()
+          row = self._apply(row, change)
+          if row is None:
+            self.db.execute('DELETE FROM extents WHERE nodePath = ?', (nodePath,))
+          else:
+            self.db.execute('INSERT OR REPLACE INTO extents VALUES (?, ?, ?, ?)', (nodePath,) + row)
+
+  def rebuild(self):
+    """Recatalog every node in the tree"""
+    rows = []
+    for node in self.tree.walk():
+      slices = list(node.slices)
+      if slices:
+        rows.append((node.nodePath, slices[-1].startTime, slices[0].endTime, slices[0].timeStep))
+
+    with self.lock:
+      self.pending = {}
+      with self.db:
+        self.db.execute('DELETE FROM extents')
+        self.db.executemany('INSERT INTO extents VALUES (?, ?, ?, ?)', rows)
+
+  def close(self):
+    self.flush()
+    with self.lock:
+      if self.connection is not None:
+        self.connection.close()
+        self.connection = None
+
+  @property
+  def db(self):
+    if self.connection is None:
+      if not isdir(dirname(self.path)):
+        os.makedirs(dirname(self.path), DIR_PERMS)
+      self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+      self.connection.execute('CREATE TABLE IF NOT EXISTS extents (nodePath TEXT PRIMARY KEY, '
+                              'earliest INTEGER, latest INTEGER, timeStep INTEGER)')
+      self.connection.commit()
+    return self.connection
+
+  def _apply(self, row, change):
+    # a cataloged (earliest, latest, timeStep) row, or None, after a pending change
+    earliest, latest, timeStep, trimmedTo = change
+    if row is not None and trimmedTo is not None:
+      row = (max(row[0], trimmedTo), row[1], row[2])
+      if row[0] >= row[1]:
+        row = None
+
+    if earliest is None:
+      return row
+    if row is None:
+      return (earliest, latest, timeStep)
+    if latest < row[1]:  # the timeStep of the latest data
+      timeStep = row[2]
+    return (min(row[0], earliest), max(row[1], latest), timeStep)
+
+  def _maybeFlush(self):
+    if len(self.pending) >= self.flushSize or time.time() - self.lastFlush >= self.flushInterval:
+      self.flush()
+
+
+openCatalogs = weakref.WeakSet()
+
+
+@atexit.register
+def flushCatalogs():
+  """Write out the changes still batched in the open extent catalogs"""
+  for catalog in list(openCatalogs):
+    # a catalog whose tree has since been removed is not recreated
+    if catalog.pending and exists(catalog.path):
+      try:
+        catalog.flush()
+      except sqlite3.Error:
+        pass
+
+
+class Instrumentation(object):
+  """Counters of the filesystem operations a :class:`CeresTree` makes, and
+  latency histograms of its operations. See :meth:`CeresTree.setInstrumentation`.
+
+  The counters are `listdir`, `stat`, `open`, `bytesRead` and `bytesWritten`.
+  Reads served from a :class:`SliceMapPool` count their bytes but not the
+  `fstat` that checks the mapping is current.
+
+  The timed operations are `fetch`, `find` and `store` of the tree and
+  `write` and `deleteBefore` of its nodes. A `find` is timed while producing
+  its results, not while the caller handles them.
+
+  :param buckets: The upper bounds in seconds of the latency histogram
+                  buckets, an unbounded bucket follows the last
+  """
+  COUNTERS = ('listdir', 'stat', 'open', 'bytesRead', 'bytesWritten')
+  OPERATIONS = ('fetch', 'find', 'store', 'write', 'deleteBefore')
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    """Zero the counters and histograms"""
+    with self.lock:
+      self.counters = dict.fromkeys(self.COUNTERS, 0)
+      # operation -> [count, total seconds, max seconds, bucket counts]
+      self.latencies = dict((operation, [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)])
+                            for operation in self.OPERATIONS)
+
+  def count(self, name, amount=1):
+    """Add to a counter"""
+    with self.lock:
+      self.counters[name] += amount
+
+  def record(self, operation, seconds):
+    """Add an operation's duration to its histogram"""
+    bucket = bisect_left(self.buckets, seconds)
+    with self.lock:
+      latency = self.latencies[operation]
+      latency[0] += 1
+      latency[1] += seconds
+      if seconds > latency[2]:
+        latency[2] = seconds
+      latency[3][bucket] += 1
+
+  def timeIter(self, operation, iterator):
+    """Yield the items of `iterator`, recording the time spent producing them"""
+    elapsed = 0.0
+    try:
+      while True:
+        started = time.time()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+        finally:
+          elapsed += time.time() - started
+        yield item
+    finally:
+      self.record(operation, elapsed)
+
+  def stats(self):
+    """Returns a snapshot of the counters and histograms, as a dict with
+    `counters` mapping each counter to its value and `latencies` mapping each
+    operation to a dict of its `count`, `total` and `max` seconds and its
+    `buckets`, a list of `(upperBound, count)` ending with a `None` bound"""
+    with self.lock:
+      counters = dict(self.counters)
+      latencies = dict((operation, (latency[0], latency[1], latency[2], list(latency[3])))
+                       for operation, latency in self.latencies.items())
+
+    bounds = self.buckets + (None,)
+    return {
+      'counters': counters,
+      'latencies': dict((operation, {
+        'count': count,
+        'total': total,
+        'max': maximum,
+        'buckets': zip(bounds, buckets),
+      }) for operation, (count, total, maximum, buckets) in latencies.items()),
+    }
+
+
+class StatsEmitter(object):
+  """A thread sending the activity recorded by an :class:`Instrumentation`
+  to a sink every `interval` seconds, as carbon plaintext lines:
+
+    <prefix>.<counter> <increase over the interval> <timestamp>
+    <prefix>.latency.<operation>.count <operations finished in the interval> <timestamp>
+    <prefix>.latency.<operation>.mean <seconds> <timestamp>
+    <prefix>.latency.<operation>.p<N> <histogram bucket bound of percentile N> <timestamp>
+
+  Latency lines are left out for operations that did not run in the interval.
+
+  :param instrumentation: The :class:`Instrumentation` to report on
+  :param sink: An object with a `send(data)` method taking a string of
+               lines, such as :class:`CarbonSink` or :class:`FileSink`, and
+               optionally a `close()` method
+  :param interval: Seconds between reports
+  :param prefix: The metric name prefix, e.g. `ceres.<hostname>`
+  """
+  def __init__(self, instrumentation, sink, interval=DEFAULT_STATS_INTERVAL,
+               prefix=DEFAULT_STATS_PREFIX):
+    self.instrumentation = instrumentation
+    self.sink = sink
+    self.interval = interval
+    self.prefix = prefix
+    self.previous = instrumentation.stats()
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def __repr__(self):
+    return "<StatsEmitter[0x%x]: %s every %ss>" % (id(self), self.prefix, self.interval)
+  __str__ = __repr__
+
+  def start(self):
+    """Start reporting in a daemon thread"""
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, name='ceres-stats-emitter')
+      self.thread.daemon = True
+      self.thread.start()
+    return self
+
+  def stop(self, flush=True):
+    """Stop the reporting thread, sending the activity since the last
+    report first when `flush` is set, and close the sink"""
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if flush:
+      self.emit()
+    close = getattr(self.sink, 'close', None)
+    if close is not None:
+      close()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.emit()
+      except Exception:  # a sink that is down should not stop the reports
+        pass
+
+  def emit(self, now=None):
+    """Send the activity since the previous report to the sink
+
+      :returns: The lines sent
+    """
+    if now is None:
+      now = int(time.time())
+    current = self.instrumentation.stats()
+    lines = self.format(current, self.previous, now)
+    self.previous = current
+    data = ''.join(line + '\n' for line in lines)
+    if data:
+      self.sink.send(data)
+    return lines
+
+  def format(self, current, previous, now):
+    lines = []
+    for name, value in sorted(current['counters'].items()):
+      lines.append('%s.%s %d %d' % (self.prefix, name, value - previous['counters'][name], now))
+
+    for operation, latency in sorted(current['latencies'].items()):
+      before = previous['latencies'][operation]
+      count = latency['count'] - before['count']
+      if count <= 0:
+        continue
+
+      metric = '%s.latency.%s' % (self.prefix, operation)
+      lines.append('%s.count %d %d' % (metric, count, now))
+      lines.append('%s.mean %.6f %d' % (metric, (latency['total'] - before['total']) / count, now))
+      counts = [(bound, n - m) for (bound, n), (_, m) in izip(latency['buckets'], before['buckets'])]
+      for percentile in LATENCY_PERCENTILES:
+        bound = histogramPercentile(counts, percentile)
+        if bound is None:  # the unbounded bucket
+          bound = latency['max']
+        lines.append('%s.p%d %.6f %d' % (metric, percentile, bound, now))
+    return lines
+
+
+class CarbonSink(object):
+  """A :class:`StatsEmitter` sink sending to a carbon plaintext listener
+  over TCP, reconnecting on the next report after a failure
+
+  :param host: The listener's host, or a unix socket path when `port` is `None`
+  :param port: The listener's port
+  :param timeout: Socket timeout in seconds
+  """
+  def __init__(self, host='127.0.0.1', port=2003, timeout=5):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.sock = None
+
+  def send(self, data):
+    if self.sock is None:
+      if self.port is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = self.host
+      else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (self.host, self.port)
+      sock.settimeout(self.timeout)
+      try:
+        sock.connect(address)
+      except socket.error:
+        sock.close()
+        raise
+      self.sock = sock
+
+    try:
+      self.sock.sendall(data)
+    except socket.error:
+      self.close()
+      raise
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+
+class FileSink(object):
+  """A :class:`StatsEmitter` sink appending to a file
+
+  :param path: The file to append the lines to
+  """
+  def __init__(self, path):
+    self.path = path
+
+  def send(self, data):
+    with open(self.path, 'a') as fh:
+      fh.write(data)
+
+
+class ConsistentHashRing(object):
+  """Maps keys onto a fixed set of nodes so that each key always lands on
+  the same node, and adding or removing a node only moves the keys of that
+  node
+
+  :param nodes: The nodes keys are spread over
+  :keyword replicas: Points each node gets on the ring, more even out the spread
+  """
+  def __init__(self, nodes, replicas=100):
+    ring = []
+    for node in nodes:
+      for replica in xrange(replicas):
+        ring.append((self.hash('%s:%d' % (node, replica)), node))
+    ring.sort()
+    self.positions = [position for position, node in ring]
+    self.nodes = [node for position, node in ring]
+
+  @staticmethod
+  def hash(key):
+    return int(md5(key).hexdigest()[:8], 16)
+
+  def getNode(self, key):
+    i = bisect_left(self.positions, self.hash(key)) % len(self.positions)
+    return self.nodes[i]
+
+
+class StoreWorkerPool(object):
+  """Dedicated writer processes behind :meth:`CeresTree.storeMany`
+
+  Metric names are assigned to workers on a :class:`ConsistentHashRing`, so
+  every write to a given node goes through the same process and workers
+  never race on a slice.
+
+  :param root: The root directory of the Ceres tree the workers write to
+  :param processes: The number of worker processes
+  """
+  def __init__(self, root, processes):
+    self.ring = ConsistentHashRing(range(processes))
+    self.results = multiprocessing.Queue()
+    self.inboxes = []
+    self.workers = []
+    self.lock = threading.Lock()
+
+    for i in xrange(processes):
+      inbox = multiprocessing.Queue()
+      worker = multiprocessing.Process(target=storeWorker, args=(root, inbox, self.results))
+      worker.daemon = True
+      worker.start()
+      self.inboxes.append(inbox)
+      self.workers.append(worker)
+
+  def __len__(self):
+    return len(self.workers)
+
+  def shard(self, mapping):
+    shards = {}
+    for nodePath, datapoints in mapping.iteritems():
+      shards.setdefault(self.ring.getNode(nodePath), []).append((nodePath, datapoints))
+    return shards
+
+  def store(self, mapping, settings):
+    """See :meth:`CeresTree.storeMany`, the workers write with the tree
+    settings from :func:`treeSettings`"""
+    shards = self.shard(mapping)
+    results = {}
+
+    with self.lock:
+      for worker, items in shards.iteritems():
+        self.inboxes[worker].put((settings, items))
+
+      for i in xrange(len(shards)):
+        while True:
+          try:
+            results.update(self.results.get(timeout=1))
+            break
+          except Empty:
+            if not all(worker.is_alive() for worker in self.workers):
+              raise RuntimeError("a ceres store worker exited unexpectedly")
+
+    return results
+
+  def close(self):
+    for inbox in self.inboxes:
+      inbox.put(None)
+    for worker in self.workers:
+      worker.join()
+
+
+class AsyncCeresTree(object):
+  """A non-blocking facade over a :class:`CeresTree` for event-loop based
+  callers. Every call runs on a bounded thread pool and immediately returns a
+  :class:`CeresFuture`, a `concurrent.futures` future that can be waited on
+  with `wait` or `as_completed`, or handed back to an event loop through
+  `add_done_callback`.
+
+  Cancelling a future that is already running stops its outstanding slice
+  reads; the future then fails with `CancelledError`.
+
+  Requires `concurrent.futures` (the `futures` backport on Python 2).
+
+  :param tree: The :class:`CeresTree` to operate on
+  :keyword maxWorkers: Threads shared by all calls
+  :keyword maxConcurrency: Default limit on the nodes one :meth:`fetchMany`
+                           call reads at the same time
+  """
+  def __init__(self, tree, maxWorkers=DEFAULT_FETCH_THREADS, maxConcurrency=None):
+    if futures is None:
+      raise ImportError("concurrent.futures is required for AsyncCeresTree")
+
+    self.tree = tree
+    self.maxConcurrency = maxConcurrency or maxWorkers
+    self.executor = futures.ThreadPoolExecutor(maxWorkers)
+
+  def __repr__(self):
+    return "<AsyncCeresTree[0x%x]: %s>" % (id(self), self.tree.root)
+  __str__ = __repr__
+
+  def close(self, wait=True):
+    """Shut down the worker threads"""
+    self.executor.shutdown(wait)
+
+  def fetch(self, nodePath, fromTime, untilTime, asArray=False):
+    """See :meth:`CeresTree.fetch`
+
+      :returns: :class:`CeresFuture` resolving to :class:`TimeSeriesData`
+    """
+    call = CeresFuture()
+
+    def fetch():
+      started = time.time()
+      node = self.tree.getNode(nodePath)
+      if not node:
+        raise NodeNotFound("the node '%s' does not exist in this tree" % nodePath)
+      series = self._read(node, fromTime, untilTime, asArray, call)
+      stats = self.tree.instrumentation
+      if stats is not None:
+        stats.record('fetch', time.time() - started)
+      return series
+
+    self._submit(call, fetch)
+    return call
+
+  def fetchMany(self, nodePaths, fromTime, untilTime, asArray=False, concurrency=None):
+    """See :meth:`CeresTree.fetchMany`
+
+      :keyword concurrency: The most nodes this call reads at the same time,
+                            defaults to `maxConcurrency`
+
+      :returns: :class:`CeresFuture` resolving to a dict of metric name to
+                :class:`TimeSeriesData`
+    """
+    call = CeresFuture()
+    limit = concurrency or self.maxConcurrency
+    pending = deque(OrderedDict.fromkeys(nodePaths))
+    results = OrderedDict()
+    lock = threading.RLock()  # done callbacks may run inside launch()
+    state = dict(running=0)
+
+    def read(nodePath):
+      node = self.tree.getNode(nodePath)
+      if node is None:
+        return None
+      return node, self._read(node, fromTime, untilTime, asArray, call)
+
+    def finish():
+      found = [result for result in results.values() if result is not None]
+      if not found:
+        return {}
+
+      timeStep = max(series.timeStep for node, series in found)
+      alignedFrom = int(fromTime - (fromTime % timeStep))
+      alignedUntil = int(untilTime - (untilTime % timeStep))
+      return dict((node.nodePath, alignSeries(series, alignedFrom, alignedUntil, timeStep,
+                                              node.aggregationMethod or DEFAULT_AGGREGATION_METHOD))
+                  for node, series in found)
+
+    def launch():
+      # called with lock held
+      while pending and state['running'] < limit and not call.done():
+        nodePath = pending.popleft()
+        state['running'] += 1
+        try:
+          task = self.executor.submit(read, nodePath)
+        except RuntimeError, e:  # executor shut down
+          state['running'] -= 1
+          call.fail(e)
+          return
+        task.add_done_callback(lambda task, nodePath=nodePath: done(nodePath, task))
+
+    def done(nodePath, task):
+      with lock:
+        state['running'] -= 1
+        if call.done():
+          return
+
+        error = task.exception()
+        if error is not None:
+          call.fail(error)
+          return
+
+        results[nodePath] = task.result()
+        if pending:
+          launch()
+          return
+        if state['running']:
+          return
+
+      try:
+        call.succeed(finish())
+      except Exception, e:
+        call.fail(e)
+
+    if not call.set_running_or_notify_cancel():
+      return call
+
+    for nodePath in list(pending):
+      results[nodePath] = None
+
+    if not pending:
+      call.succeed({})
+      return call
+
+    with lock:
+      launch()
+    return call
+
+  def find(self, nodePattern, fromTime=None, untilTime=None):
+    """See :meth:`CeresTree.find`
+
+      :returns: :class:`CeresFuture` resolving to a list of :class:`CeresNode`
+    """
+    call = CeresFuture()
+
+    def find():
+      nodes = []
+      for node in self.tree.find(nodePattern, fromTime, untilTime):
+        if call.stopRequested:
+          raise ReadCancelled()
+        nodes.append(node)
+      return nodes
+
+    self._submit(call, find)
+    return call
+
+  def store(self, nodePath, datapoints):
+    """See :meth:`CeresTree.store`. A store that has started is not
+    interrupted by cancellation.
+
+      :returns: :class:`CeresFuture` resolving to `None`
+    """
+    call = CeresFuture()
+    self._submit(call, lambda: self.tree.store(nodePath, datapoints))
+    return call
+
+  def _read(self, node, fromTime, untilTime, asArray, call):
+    if asArray:
+      requireNumpy()
+    cache = self.tree.readCache
+    if cache is not None:
+      return cache.read(node, fromTime, untilTime, asArray=asArray)
+    plan = node.planRead(fromTime, untilTime)
+    return plan.execute(asArray=asArray, cancelled=lambda: call.stopRequested)
+
+  def _submit(self, call, function):
+    def run():
+      if not call.set_running_or_notify_cancel():
+        return
+      try:
+        result = function()
+      except Exception, e:
+        call.fail(e)
+      else:
+        call.succeed(result)
+
+    try:
+      self.executor.submit(run)
+    except RuntimeError, e:  # executor shut down
+      if call.set_running_or_notify_cancel():
+        call.fail(e)
+
+
+class CeresFuture(futures.Future if futures is not None else object):
+  """A `concurrent.futures.Future` whose cancellation also reaches calls
+  that are already running, see :class:`AsyncCeresTree`"""
+  def __init__(self):
+    super(CeresFuture, self).__init__()
+    self.stopRequested = False
+    self.outcomeLock = threading.Lock()
+
+  def cancel(self):
+    self.stopRequested = True
+    if super(CeresFuture, self).cancel():
+      return True
+
+    # Already running: the worker stops at its next slice read, report the
+    # cancellation to waiters right away
+    self.fail(futures.CancelledError())
+    return False
+
+  def succeed(self, result):
+    """Resolve with `result` unless the future already has an outcome"""
+    with self.outcomeLock:
+      if self.running():
+        self.set_result(result)
+
+  def fail(self, error):
+    """Resolve with `error` unless the future already has an outcome"""
+    if isinstance(error, ReadCancelled):
+      error = futures.CancelledError()
+
+    with self.outcomeLock:
+      if self.running():
+        self.set_exception(error)
+
+
 class CorruptNode(Exception):
   def __init__(self, node, problem):
     Exception.__init__(self, problem)
@@ -769,6 +3946,10 @@ class SliceGapTooLarge(Exception):
 class SliceDeleted(Exception):
   pass
 
+
+class ReadCancelled(Exception):
+  pass
+
 def aggregate_avg(values):
     """
     Compute AVG for list of points.
@@ -792,31 +3973,614 @@ def aggregate_avg(values):
     agg = float(s) / length
     return agg
 
-def recalculateSeries(values, old_timeStep, new_timeStep):
+def aggregate(values, method=DEFAULT_AGGREGATION_METHOD):
+    """
+    Aggregate a list of points, where more missing than present points
+    aggregates to None, as :func:`aggregate_avg` does.
+    :param values: list of values, None for missing points
+    :param method: one of AGGREGATION_METHODS
+    :return: the aggregated value or None
+    """
+    method = getAggregationMethod(method)
+    present = [v for v in values if v is not None]
+    if not present or len(values) - len(present) > len(present):
+        return None
+
+    if method == 'avg':
+        return float(sum(present)) / len(present)
+    elif method == 'sum':
+        return sum(present)
+    elif method == 'min':
+        return min(present)
+    elif method == 'max':
+        return max(present)
+    elif method == 'last':
+        return present[-1]
+    return len(present)
+
+def recalculateSeries(values, old_timeStep, new_timeStep, method=DEFAULT_AGGREGATION_METHOD):
     """
     Recalculate values to the new timeStep.
-    :param values: list of the values
+    :param values: list of the values, or a NaN-padded float64 array
     :param old_timeStep: previous timestep
     :param new_timeStep: new timeStep value
-    :return: list of recalculated values
+    :param method: how points are aggregated, one of AGGREGATION_METHODS
+    :return: list (or array) of recalculated values
     """
     factor = int(new_timeStep/old_timeStep)
+    return consolidate(values, factor, method)
+
+
+def consolidate(values, factor, method=DEFAULT_AGGREGATION_METHOD):
+    """
+    Fold every `factor` consecutive points into one with an aggregation
+    method, which is one of:
+
+    * avg - the mean of the present points
+    * sum - their total
+    * min, max - their minimum or maximum
+    * last - the last present point
+    * count - how many points are present
+
+    A point is missing when more of its source points are missing than
+    present. A trailing partial group is kept when it has more than a
+    quarter of `factor` points. Lists are consolidated with numpy when it
+    is installed.
+    :param values: list of values using None for missing points, or a
+                   NaN-padded float64 array
+    :param factor: number of old points folded into each new point
+    :param method: the aggregation method
+    :return: list (or array) of consolidated values
+    """
+    method = getAggregationMethod(method)
+    if isArray(values):
+        return consolidateArray(values, factor, method)
+
+    if numpy is not None and len(values) >= factor:
+        return [None if isnan(v) else v
+                for v in consolidateArray(toArray(values), factor, method).tolist()]
+
+    new_values = [aggregate(values[i:i + factor], method)
+                  for i in xrange(0, len(values) - factor + 1, factor)]
+    tail = values[len(new_values) * factor:]
+    if len(tail) > int(factor/4):
+        new_values.append(aggregate(tail, method))
+    return new_values
+
 
-    new_values = list()
-    sub_arr = list()
-    cnt = 0
-    for i in range(0, len(values)):
-        sub_arr.append(values[i])
-        cnt += 1
-        if cnt == factor:
-                new_values.append(aggregate_avg(sub_arr))
-                sub_arr = list()
-                cnt = 0
-    if len(sub_arr) > int(factor/4):
-        new_values.append(aggregate_avg(sub_arr))
+def consolidateArray(values, factor, method=DEFAULT_AGGREGATION_METHOD):
+    """
+    Vectorized :func:`consolidate` for NaN-padded float64 arrays.
+    """
+    def reduce(blocks):
+        present = ~numpy.isnan(blocks)
+        counts = present.sum(axis=1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            if method == 'avg':
+                result = numpy.where(present, blocks, 0.0).sum(axis=1) / counts
+            elif method == 'sum':
+                result = numpy.where(present, blocks, 0.0).sum(axis=1)
+            elif method == 'min':
+                result = numpy.fmin.reduce(blocks, axis=1)
+            elif method == 'max':
+                result = numpy.fmax.reduce(blocks, axis=1)
+            elif method == 'last':
+                lastPresent = blocks.shape[1] - 1 - present[:, ::-1].argmax(axis=1)
+                result = blocks[numpy.arange(len(blocks)), lastPresent]
+            else:
+                result = counts.astype(numpy.float64)
+        # same rule as aggregate_avg: more missing than present points is missing
+        result[((blocks.shape[1] - counts) > counts) | (counts == 0)] = NAN
+        return result
+
+    full = (len(values) // factor) * factor
+    new_values = reduce(values[:full].reshape(-1, factor))
+    tail = values[full:]
+    if len(tail) > int(factor/4):
+        new_values = numpy.append(new_values, reduce(tail.reshape(1, -1)))
     return new_values
 
 
+def getAggregationMethod(name):
+    """Return the canonical name of an aggregation method, see :func:`consolidate`"""
+    method = AGGREGATION_METHOD_ALIASES.get(name, name)
+    if method not in AGGREGATION_METHODS:
+        raise ValueError("invalid aggregationMethod '%s', expected one of %s" %
+                         (name, ', '.join(AGGREGATION_METHODS)))
+    return method
+
+
+def storeDatapoints(tree, items):
+  """Store (nodePath, datapoints) pairs, collecting per-node outcomes as
+  described in :meth:`CeresTree.storeMany`"""
+  results = {}
+  for nodePath, datapoints in items:
+    try:
+      tree.store(nodePath, datapoints)
+      results[nodePath] = None
+    except Exception, e:
+      results[nodePath] = e
+  return results
+
+
+def storeWorker(root, inbox, results):
+  """Main loop of a :class:`StoreWorkerPool` process"""
+  tree = workerTree(root)
+  while True:
+    message = inbox.get()
+    if message is None:
+      break
+
+    settings, items = message
+    applyTreeSettings(tree, settings)
+    outcome = storeDatapoints(tree, items)
+    for nodePath, error in outcome.items():
+      try:
+        pickle.dumps(error)
+      except Exception:
+        outcome[nodePath] = RuntimeError(repr(error))
+    if tree.extentCatalog is not None:
+      tree.extentCatalog.flush()
+    results.put(outcome)
+
+
+def treeSettings(tree):
+  """The settings made on a tree that worker processes opening it anew need
+  to write to it the same way"""
+  return {
+    'maxSlicePoints': tree.maxSlicePoints,
+    'sliceCachingBehavior': DEFAULT_SLICE_CACHING_BEHAVIOR,
+  }
+
+
+def applyTreeSettings(tree, settings):
+  """Make the settings returned by :func:`treeSettings` on a worker's tree"""
+  tree.maxSlicePoints = settings['maxSlicePoints']
+  setDefaultSliceCachingBehavior(settings['sliceCachingBehavior'])
+
+
+def workerTree(root, settings=None):
+  """Open the tree a worker process works on, closing it as the worker
+  exits since the interpreter's exit handlers don't run there"""
+  tree = CeresTree(root)
+  if settings is not None:
+    applyTreeSettings(tree, settings)
+  Finalize(tree, tree.close, exitpriority=0)
+  return tree
+
+
+nodeWorkerState = {}
+
+
+def initNodeWorker(root, settings, methodName, args, tree=None):
+  """Set up a :meth:`CeresTree.mapNodes` worker process"""
+  nodeWorkerState['tree'] = tree or workerTree(root, settings)
+  nodeWorkerState['methodName'] = methodName
+  nodeWorkerState['args'] = args
+
+
+def nodeWorker(nodePath):
+  """Handle one node in a :meth:`CeresTree.mapNodes` worker, returning the
+  metric name and the outcome"""
+  node = nodeWorkerState['tree'].getNode(nodePath)
+  if node is None:
+    return nodePath, NodeNotFound("the node '%s' does not exist in this tree" % nodePath)
+
+  try:
+    return nodePath, getattr(node, nodeWorkerState['methodName'])(*nodeWorkerState['args'])
+  except Exception, e:
+    return nodePath, picklableError(e)
+
+
+whisperWorkerState = {}
+
+
+def initWhisperWorker(root, settings, whisperRoot, now, delete, tree=None):
+  """Set up a :meth:`CeresTree.importWhisper` worker process"""
+  whisperWorkerState['tree'] = tree or workerTree(root, settings)
+  whisperWorkerState['whisperRoot'] = whisperRoot
+  whisperWorkerState['now'] = now
+  whisperWorkerState['delete'] = delete
+
+
+def whisperWorker(relativePath):
+  """Import one whisper file in a :meth:`CeresTree.importWhisper` worker,
+  returning its relative path and the outcome"""
+  wspPath = join(whisperWorkerState['whisperRoot'], relativePath)
+  nodePath = relativePath[:-len(WHISPER_SUFFIX)].replace(os.sep, '.')
+  try:
+    imported = importWhisperFile(whisperWorkerState['tree'], wspPath, nodePath,
+                                 whisperWorkerState['now'])
+    if whisperWorkerState['delete']:
+      os.unlink(wspPath)
+    return relativePath, imported
+  except Exception, e:
+    return relativePath, picklableError(e)
+
+
+def picklableError(e):
+  """An exception a worker process can send back, `e` itself if it pickles"""
+  try:
+    pickle.dumps(e)
+  except Exception:
+    e = RuntimeError(repr(e))
+  return e
+
+
+def findWhisperFiles(root):
+  """Yield the paths relative to `root` of the whisper files beneath it"""
+  for dirPath, dirNames, fileNames in os.walk(root):
+    dirNames.sort()
+    for fileName in sorted(fileNames):
+      if fileName.endswith(WHISPER_SUFFIX):
+        yield os.path.relpath(join(dirPath, fileName), root)
+
+
+def importWhisperFile(tree, wspPath, nodePath, now=None):
+  """Import a whisper file into a node, creating the node or updating the
+  metadata of an existing one
+
+  Each archive is written to slices of its own timeStep, covering its
+  retention up to where the next finer archive's begins, much as
+  :meth:`CeresNode.rollup` would have left the node. The archives become the
+  node's `retentions` and the file's aggregation method its
+  `aggregationMethod`, see :const:`WHISPER_AGGREGATION_METHODS`. Importing a
+  file again writes the same datapoints again.
+
+    :param now: The time the retentions are measured back from, defaults to now
+
+    :returns: The number of datapoints imported
+  """
+  requireWhisper()
+  if now is None:
+    now = time.time()
+  now = int(now)
+
+  info = whisper.info(wspPath)
+  archives = sorted(info['archives'], key=lambda archive: archive['secondsPerPoint'])
+  method = info['aggregationMethod']
+  properties = {
+    'timeStep': archives[0]['secondsPerPoint'],
+    'retentions': [[archive['secondsPerPoint'], archive['points']] for archive in archives],
+    'aggregationMethod': WHISPER_AGGREGATION_METHODS.get(method, method),
+    'xFilesFactor': info['xFilesFactor'],
+  }
+
+  node = tree.getNode(nodePath)
+  if node is None:
+    node = tree.createNode(nodePath, **properties)
+  else:
+    metadata = node.readMetadata()
+    metadata.update(properties)
+    node.writeMetadata(metadata)
+
+  # the intervals whisper.fetch considers current in each archive
+  windows = []
+  for archive in archives:
+    timeStep = archive['secondsPerPoint']
+    fromTime = now - archive['retention']
+    fromTime += timeStep - (fromTime % timeStep)
+    windows.append([fromTime, now - (now % timeStep) + timeStep])
+
+  # where a finer archive's retention begins the coarser archive hands over
+  # to it, at an interval boundary of both
+  for finer, coarser, archive in izip(windows, windows[1:], archives[1:]):
+    boundary = finer[0] + (-finer[0] % archive['secondsPerPoint'])
+    finer[0] = boundary
+    coarser[1] = min(coarser[1], boundary)
+
+  imported = 0
+  with open(wspPath, 'rb') as fh:
+    for archive, (fromTime, untilTime) in izip(archives, windows):
+      timeStep = archive['secondsPerPoint']
+      fh.seek(archive['offset'])
+      data = fh.read(archive['size'])
+      if len(data) != archive['size']:
+        raise ValueError("truncated whisper archive in %s" % wspPath)
+      points = struct.unpack('!' + 'Ld' * archive['points'], data)
+
+      datapoints = [(t, v) for t, v in izip(points[::2], points[1::2])
+                    if fromTime <= t < untilTime and t % timeStep == 0]
+      if datapoints:
+        node.write(datapoints, timeStep)
+        imported += len(datapoints)
+
+  return imported
+
+
+def alignSeries(series, fromTime, untilTime, timeStep, method=DEFAULT_AGGREGATION_METHOD):
+  """Consolidate a series to `timeStep` and pad or trim it to span exactly
+  [`fromTime`, `untilTime`), both multiples of `timeStep`
+
+  :param series: :class:`TimeSeriesData` with a timeStep no larger than `timeStep`
+  :param method: The aggregation method, see :func:`consolidate`
+  :returns: :class:`TimeSeriesData`
+  """
+  asArray = series.isArray
+  values = series.values
+
+  # shift the values so they start at fromTime, in the series' own resolution
+  lead = (series.startTime - fromTime) / series.timeStep
+  if lead > 0:
+    if asArray:
+      values = numpy.concatenate((nullValues(lead, asArray), values))
+    else:
+      values = nullValues(lead) + values
+  elif lead < 0:
+    values = values[-lead:]
+
+  if series.timeStep != timeStep:
+    values = recalculateSeries(values, series.timeStep, timeStep, method)
+
+  length = max((untilTime - fromTime) / timeStep, 0)
+  values = values[:length]
+  if len(values) < length:
+    if asArray:
+      values = numpy.concatenate((values, nullValues(length - len(values), asArray)))
+    else:
+      values = values + nullValues(length - len(values))
+
+  return TimeSeriesData(fromTime, fromTime + length * timeStep, timeStep, values)
+
+
+def fileStamps(paths):
+  """Returns a (size, mtime) tuple for each path, or `None` if one is missing"""
+  stamps = []
+  for path in paths:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    stamps.append((stat.st_size, stat.st_mtime))
+  return tuple(stamps)
+
+
+def intervalOverlaps(earliestData, latestData, fromTime, untilTime):
+  """Returns whether data spanning [`earliestData`, `latestData`) overlaps
+  the interval, where a `None` or `0` bound is open"""
+  return ((fromTime is 0) or (fromTime is None) or (fromTime < latestData)) and \
+         ((untilTime is 0) or (untilTime is None) or (untilTime > earliestData))
+
+
+def histogramPercentile(buckets, percentile):
+  """Returns the upper bound of the histogram bucket holding a percentile,
+  given `(upperBound, count)` buckets as in :meth:`Instrumentation.stats`"""
+  total = sum(count for bound, count in buckets)
+  rank = total * percentile / 100.0
+  seen = 0
+  for bound, count in buckets:
+    seen += count
+    if count and seen >= rank:
+      return bound
+  return buckets[-1][0]
+
+
+def compressValues(packedValues, blockPoints=COMPRESSED_BLOCK_POINTS, wordSize=DATAPOINT_SIZE):
+  """Encode packed datapoints of `wordSize` bytes each in the
+  :class:`CompressedSlice` file format"""
+  pointCount = len(packedValues) / wordSize
+  words = struct.unpack('!%d%s' % (pointCount, WORD_FORMATS[wordSize]),
+                        packedValues[:pointCount * wordSize])
+  blocks = [encodeBlock(words[i:i + blockPoints], wordSize)
+            for i in xrange(0, pointCount, blockPoints)]
+
+  offsets = [0]
+  for block in blocks:
+    offsets.append(offsets[-1] + len(block))
+
+  header = struct.pack(COMPRESSED_HEADER_FORMAT, COMPRESSED_SLICE_MAGIC,
+                       pointCount, blockPoints, len(blocks))
+  return header + struct.pack('!%dL' % len(offsets), *offsets) + ''.join(blocks)
+
+
+def decompressValues(data, wordSize=DATAPOINT_SIZE):
+  """Decode a whole :class:`CompressedSlice` file into packed datapoints"""
+  magic, pointCount, blockPoints, blockCount = struct.unpack_from(COMPRESSED_HEADER_FORMAT, data)
+  if magic != COMPRESSED_SLICE_MAGIC:
+    raise ValueError("not a compressed slice")
+
+  offsets = struct.unpack_from('!%dL' % (blockCount + 1), data, COMPRESSED_HEADER_SIZE)
+  dataStart = COMPRESSED_HEADER_SIZE + (blockCount + 1) * COMPRESSED_OFFSET_SIZE
+  words = []
+  for block in xrange(blockCount):
+    count = min(blockPoints, pointCount - block * blockPoints)
+    words.extend(decodeBlock(data, dataStart + offsets[block], count, wordSize))
+  return struct.pack('!%d%s' % (len(words), WORD_FORMATS[wordSize]), *words)
+
+
+def encodeBlock(words, wordSize=DATAPOINT_SIZE):
+  """XOR-encode the words of a block of datapoints"""
+  format = '!' + WORD_FORMATS[wordSize]
+  previous = words[0]
+  encoded = [struct.pack(format, previous)]
+  for word in words[1:]:
+    xor = word ^ previous
+    previous = word
+    if not xor:
+      encoded.append('\x00')
+      continue
+
+    packed = struct.pack(format, xor)
+    significant = packed.lstrip('\x00')
+    leading = wordSize - len(significant)
+    significant = significant.rstrip('\x00')
+    encoded.append(chr((leading << 4) | len(significant)) + significant)
+  return ''.join(encoded)
+
+
+def decodeBlock(data, offset, count, wordSize=DATAPOINT_SIZE):
+  """Decode `count` words of a block written by :func:`encodeBlock`"""
+  format = '!' + WORD_FORMATS[wordSize]
+  previous, = struct.unpack_from(format, data, offset)
+  offset += wordSize
+  words = [previous]
+  unpack = struct.unpack
+  for i in xrange(count - 1):
+    control = ord(data[offset])
+    offset += 1
+    length = control & 0x0f
+    if length:
+      leading = control >> 4
+      previous ^= unpack(format, ('\x00' * leading) + data[offset:offset + length] +
+                                 ('\x00' * (wordSize - leading - length)))[0]
+      offset += length
+    words.append(previous)
+  return words
+
+
+def splitSequences(sequences, span):
+  """Split the sequences of datapoints :meth:`CeresNode.compact` returns
+  wherever they cross a multiple of `span`"""
+  split = []
+  for sequence in sequences:
+    start = 0
+    for i in xrange(1, len(sequence)):
+      if sequence[i][0] // span != sequence[i - 1][0] // span:
+        split.append(sequence[start:i])
+        start = i
+    split.append(sequence[start:])
+  return split
+
+
+def getMaxSlicePoints(maxPoints):
+  """Validate a `maxSlicePoints` setting, returning it as an int or `None`"""
+  if maxPoints is None:
+    return None
+  if int(maxPoints) <= 0:
+    raise ValueError("invalid maxSlicePoints %r, expected a positive number" % (maxPoints,))
+  return int(maxPoints)
+
+
+def trimFile(fileHandle, byteOffset, recordSize=DATAPOINT_SIZE, packedNull=PACKED_NAN, mapPool=None):
+  """Remove the first `byteOffset` bytes of a file in place
+
+  Where the filesystem supports it the bytes are collapsed out of the file
+  with `fallocate`, which costs the same however much data follows. As that
+  works in whole filesystem blocks, the last partial block before
+  `byteOffset` is kept and overwritten with `packedNull` records instead,
+  the whole of `byteOffset` when it is less than a block.
+  Elsewhere the remainder of the file is copied down in chunks of
+  :data:`TRIM_CHUNK_SIZE` bytes.
+
+  Either way the file shrinks in place, which raises SIGBUS in processes
+  reading it through a memory mapping, see :class:`SliceMapPool`.
+
+    :param fileHandle: The file, open for reading and writing
+    :param byteOffset: The number of bytes to remove, a multiple of `recordSize`
+    :param recordSize: The size of one record in the file
+    :param packedNull: One record marking a missing value
+    :param mapPool: The :class:`SliceMapPool` of this process, if any, the
+                    file is kept out of it while it shrinks
+
+    :returns: The number of bytes kept before `byteOffset`, all `packedNull`
+              records, or `None` when nothing follows `byteOffset`
+  """
+  fileHandle.flush()
+  fd = fileHandle.fileno()
+  fileSize = os.fstat(fd).st_size
+  if byteOffset >= fileSize:
+    return None
+
+  if fallocate is not None:
+    blockSize = os.fstatvfs(fd).f_bsize
+    collapse = byteOffset - (byteOffset % blockSize)
+    if collapse:
+      with unmapped(mapPool, fileHandle.name):
+        collapsed = fallocate(fd, FALLOC_FL_COLLAPSE_RANGE, 0, collapse) == 0
+      if collapsed:
+        kept = byteOffset - collapse
+        if kept:
+          fileHandle.seek(0)
+          fileHandle.write(packedNull * (kept / recordSize))
+        return kept
+
+    # less than a block, nulled now and collapsed by a later trim
+    elif canCollapse(fileHandle, blockSize):
+      fileHandle.seek(0)
+      fileHandle.write(packedNull * (byteOffset / recordSize))
+      return byteOffset
+
+  readOffset = byteOffset
+  writeOffset = 0
+  while True:
+    fileHandle.seek(readOffset)
+    chunk = fileHandle.read(TRIM_CHUNK_SIZE)
+    if not chunk:
+      break
+    fileHandle.seek(writeOffset)
+    fileHandle.write(chunk)
+    readOffset += len(chunk)
+    writeOffset += len(chunk)
+  with unmapped(mapPool, fileHandle.name):
+    fileHandle.truncate(writeOffset)
+  return 0
+
+
+@contextmanager
+def unmapped(mapPool, fsPath):
+  """:meth:`SliceMapPool.unmapped` when there is a pool"""
+  if mapPool is None:
+    yield
+  else:
+    with mapPool.unmapped(fsPath):
+      yield
+
+
+def canCollapse(fileHandle, blockSize):
+  """Returns whether `fallocate` can collapse ranges out of files on the
+  filesystem of `fileHandle`, probed once per filesystem with a scratch file
+  next to it"""
+  device = os.fstat(fileHandle.fileno()).st_dev
+  if device not in collapseSupport:
+    fd, path = tempfile.mkstemp(dir=dirname(abspath(fileHandle.name)))
+    try:
+      os.write(fd, '\0' * (blockSize * 2))
+      collapseSupport[device] = fallocate(fd, FALLOC_FL_COLLAPSE_RANGE, 0, blockSize) == 0
+    finally:
+      os.close(fd)
+      os.unlink(path)
+  return collapseSupport[device]
+
+
+collapseSupport = {}  # st_dev -> whether fallocate can collapse ranges there
+
+
+def getDataType(name):
+  """Return the :class:`DataType` named by a node's `dataType` metadata"""
+  try:
+    return DATA_TYPES[name]
+  except KeyError:
+    raise ValueError("invalid dataType '%s', expected one of %s" % (name, ', '.join(sorted(DATA_TYPES))))
+
+
+def requireNumpy():
+  if numpy is None:
+    raise ImportError("numpy is required for array-backed reads")
+
+
+def requireWhisper():
+  if whisper is None:
+    raise ImportError("whisper is required to import whisper files")
+
+
+def isArray(values):
+  return numpy is not None and isinstance(values, numpy.ndarray)
+
+
+def toArray(values):
+  """Convert a list of values using `None` for missing points to a float64 array"""
+  if isArray(values):
+    return values
+  return numpy.array([NAN if v is None else v for v in values], dtype=numpy.float64)
+
+
+def nullValues(count, asArray=False):
+  count = max(count, 0)
+  if asArray:
+    return numpy.full(count, NAN)
+  return [None] * count
+
+
 def getTree(path):
   while path not in (os.sep, ''):
     if isdir(join(path, '.ceres-tree')):
@@ -829,7 +4593,7 @@ def setDefaultSliceCachingBehavior(behavior):
   global DEFAULT_SLICE_CACHING_BEHAVIOR
 
   behavior = behavior.lower()
-  if behavior not in ('none', 'all', 'latest'):
+  if behavior not in SLICE_CACHING_BEHAVIORS:
     raise ValueError("invalid caching behavior '%s'" % behavior)
 
   DEFAULT_SLICE_CACHING_BEHAVIOR = behavior
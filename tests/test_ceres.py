@@ -1,6 +1,15 @@
 from unittest import TestCase
 from mock import ANY, Mock, call, mock_open, patch
 
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from math import isnan
+
 from ceres import *
 
 
@@ -8,6 +17,28 @@ def fetch_mock_open_writes(open_mock):
   handle = open_mock()
   return ''.join([ c[0][0] for c in handle.write.call_args_list])
 
+def make_slice(node, startTime, values, timeStep=60):
+  path = os.path.join(node.fsPath, '%d@%d.slice' % (startTime, timeStep))
+  with open(path, 'wb') as fh:
+    fh.write(''.join(PACKED_NAN if v is None else struct.pack('!d', v) for v in values))
+
+
+class TempTreeTestCase(TestCase):
+  """Gives each test a `ceres_tree` in a fresh temporary directory `tmpdir`,
+  removed after the test"""
+  create_tree = False  # create the tree's metadata rather than use a bare directory
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmpdir)
+    self.ceres_tree = self.make_tree(self.tmpdir)
+
+  def make_tree(self, root):
+    if self.create_tree:
+      return CeresTree.createTree(root)
+    return CeresTree(root)
+
+
 class ModuleFunctionsTest(TestCase):
   @patch('ceres.isdir', new=Mock(return_value=False))
   @patch('ceres.CeresTree', new=Mock(spec=CeresTree))
@@ -63,6 +94,24 @@ class TimeSeriesDataTest(TestCase):
     new_series.merge(self.time_series)
     self.assertEqual(list(self.time_series), list(new_series))
 
+  def test_iter_array_values_maps_nan_to_none(self):
+    series = TimeSeriesData(0, 15, 5, toArray([1.0, None, 3.0]))
+    self.assertEqual([(0, 1.0), (5, None), (10, 3.0)], list(series))
+
+  def test_add_array_keeps_array(self):
+    series = TimeSeriesData(0, 10, 5, toArray([1.0, 2.0]))
+    nulls = TimeSeriesData(10, 20, 5, nullValues(2, asArray=True))
+    result = series + nulls
+    self.assertTrue(result.isArray)
+    self.assertEqual([1.0, 2.0, None, None], [v for t, v in result])
+
+  def test_merge_array_overwrites_and_extends(self):
+    series = TimeSeriesData(0, 15, 5, toArray([1.0, 2.0, 3.0]))
+    series.merge(TimeSeriesData(10, 25, 5, toArray([30.0, None, 50.0])))
+    self.assertTrue(series.isArray)
+    self.assertEqual(25, series.endTime)
+    self.assertEqual([1.0, 2.0, 30.0, None, 50.0], [v for t, v in series])
+
 
 class CeresTreeTest(TestCase):
   def setUp(self):
@@ -142,7 +191,7 @@ class CeresTreeTest(TestCase):
 
   @patch('ceres.CeresNode', spec=CeresNode)
   @patch('ceres.abspath', new=Mock(side_effect=lambda x: x))
-  @patch('ceres.glob', new=Mock(side_effect=lambda x: [x]))
+  @patch('ceres.CeresTree.expandPattern', new=Mock(side_effect=lambda x: [x]))
   def test_find_explicit_metric(self, ceres_node_mock):
     ceres_node_mock.isNodeDir.return_value = True
     result = list(self.ceres_tree.find('metrics.foo'))
@@ -151,10 +200,10 @@ class CeresTreeTest(TestCase):
 
   @patch('ceres.CeresNode', spec=CeresNode)
   @patch('ceres.abspath', new=Mock(side_effect=lambda x: x))
-  @patch('ceres.glob')
-  def test_find_wildcard(self, glob_mock, ceres_node_mock):
+  @patch('ceres.CeresTree.expandPattern')
+  def test_find_wildcard(self, expand_mock, ceres_node_mock):
     matches = ['foo', 'bar', 'baz']
-    glob_mock.side_effect = lambda x: [x.replace('*', m) for m in matches]
+    expand_mock.side_effect = lambda x: [x.replace('*', m) for m in matches]
     ceres_node_mock.isNodeDir.return_value = True
     result = list(self.ceres_tree.find('metrics.*'))
     self.assertEqual(3, len(result))
@@ -164,7 +213,7 @@ class CeresTreeTest(TestCase):
 
   @patch('ceres.CeresNode', spec=CeresNode)
   @patch('ceres.abspath', new=Mock(side_effect=lambda x: x))
-  @patch('ceres.glob', new=Mock(return_value=[]))
+  @patch('ceres.CeresTree.expandPattern', new=Mock(return_value=[]))
   def test_find_wildcard_no_matches(self, ceres_node_mock):
     ceres_node_mock.isNodeDir.return_value = False
     result = list(self.ceres_tree.find('metrics.*'))
@@ -173,7 +222,7 @@ class CeresTreeTest(TestCase):
 
   @patch('ceres.CeresNode', spec=CeresNode)
   @patch('ceres.abspath', new=Mock(side_effect=lambda x: x))
-  @patch('ceres.glob', new=Mock(side_effect=lambda x: [x]))
+  @patch('ceres.CeresTree.expandPattern', new=Mock(side_effect=lambda x: [x]))
   def test_find_metric_with_interval(self, ceres_node_mock):
     ceres_node_mock.isNodeDir.return_value = True
     ceres_node_mock.return_value.hasDataForInterval.return_value = False
@@ -183,7 +232,7 @@ class CeresTreeTest(TestCase):
 
   @patch('ceres.CeresNode', spec=CeresNode)
   @patch('ceres.abspath', new=Mock(side_effect=lambda x: x))
-  @patch('ceres.glob', new=Mock(side_effect=lambda x: [x]))
+  @patch('ceres.CeresTree.expandPattern', new=Mock(side_effect=lambda x: [x]))
   def test_find_metric_with_interval_not_found(self, ceres_node_mock):
     ceres_node_mock.isNodeDir.return_value = True
     ceres_node_mock.return_value.hasDataForInterval.return_value = True
@@ -246,7 +295,7 @@ class CeresNodeTest(TestCase):
   @patch('ceres.os.makedirs', new=Mock())
   @patch('ceres.CeresNode.writeMetadata')
   def test_create_sets_a_default_timestep(self, write_metadata_mock):
-    ceres_node = CeresNode.create(self.ceres_tree, 'sample_metric')
+    CeresNode.create(self.ceres_tree, 'sample_metric')
     write_metadata_mock.assert_called_with(dict(timeStep=DEFAULT_TIMESTEP))
 
   @patch('ceres.os.makedirs', new=Mock())
@@ -282,6 +331,9 @@ class CeresNodeTest(TestCase):
     self.assertEquals('all', self.ceres_node.sliceCachingBehavior)
     self.ceres_node.setSliceCachingBehavior('latest')
     self.assertEquals('latest', self.ceres_node.sliceCachingBehavior)
+    self.ceres_node.setSliceCachingBehavior('index')
+    self.assertEquals('index', self.ceres_node.sliceCachingBehavior)
+    self.ceres_node.setSliceCachingBehavior('latest')
     self.assertRaises(ValueError, self.ceres_node.setSliceCachingBehavior, 'foo')
     # Assert unchanged
     self.assertEquals('latest', self.ceres_node.sliceCachingBehavior)
@@ -521,9 +573,1389 @@ class CeresSliceTest(TestCase):
       with patch('ceres.exists', new=Mock(return_value=True)):
         self.ceres_tree = CeresTree('/graphite/storage/ceres')
         self.ceres_node = CeresNode(self.ceres_tree, 'sample_metric', '/graphite/storage/ceres/sample_metric')
+        self.ceres_node.dataType = DATA_TYPES['float64']
 
   def test_init_sets_fspath_name(self):
     ceres_slice = CeresSlice(self.ceres_node, 0, 60)
     self.assertTrue(ceres_slice.fsPath.endswith('0@60.slice'))
 
+  def test_read_as_array_uses_nan_for_missing(self):
+    packed = struct.pack('!ddd', 1.0, NAN, 3.0)
+    ceres_slice = CeresSlice(self.ceres_node, 0, 60)
+    with patch('ceres.getsize', new=Mock(return_value=len(packed))):
+      with patch('__builtin__.open', mock_open(read_data=packed)):
+        series = ceres_slice.read(0, 180, asArray=True)
+    self.assertTrue(series.isArray)
+    self.assertEqual(180, series.endTime)
+    self.assertEqual([1.0, None, 3.0], [v for t, v in series])
+
+  def test_read_as_array_matches_list_read(self):
+    packed = struct.pack('!ddd', 1.0, NAN, 3.0)
+    ceres_slice = CeresSlice(self.ceres_node, 0, 60)
+    with patch('ceres.getsize', new=Mock(return_value=len(packed))):
+      with patch('__builtin__.open', mock_open(read_data=packed)):
+        array_series = ceres_slice.read(0, 180, asArray=True)
+      with patch('__builtin__.open', mock_open(read_data=packed)):
+        list_series = ceres_slice.read(0, 180)
+    self.assertEqual(list(list_series), list(array_series))
+
+
+class RecalculateSeriesTest(TestCase):
+  def test_array_matches_list(self):
+    values = [1.0, None, 3.0, None, None, 6.0, 7.0, 8.0, 9.0, None]
+    expected = recalculateSeries(values, 60, 180)
+    result = recalculateSeries(toArray(values), 60, 180)
+    self.assertEqual(expected, [None if isnan(v) else v for v in result])
+
+  def test_methods_match_across_implementations(self):
+    values = [1.0, None, 3.0, None, None, 6.0, 7.0, 8.0, 9.0, None]
+    expected = {
+      'avg': [2.0, None, 8.0, None],
+      'sum': [4.0, None, 24.0, None],
+      'min': [1.0, None, 7.0, None],
+      'max': [3.0, None, 9.0, None],
+      'last': [3.0, None, 9.0, None],
+      'count': [2, None, 3, None],
+    }
+    for method in AGGREGATION_METHODS:
+      pure = [aggregate(values[i:i + 3], method) for i in range(0, 10, 3)]
+      result = consolidateArray(toArray(values), 3, method)
+      self.assertEqual(expected[method], pure)
+      self.assertEqual(expected[method], [None if isnan(v) else v for v in result])
+      self.assertEqual(expected[method], recalculateSeries(values, 60, 180, method))
+
+  def test_all_missing_block_is_missing(self):
+    result = consolidateArray(toArray([None, None, 5.0, 5.0]), 2, 'count')
+    self.assertTrue(isnan(result[0]))
+    self.assertEqual(2.0, result[1])
+
+  def test_average_alias(self):
+    self.assertEqual('avg', getAggregationMethod('average'))
+
+  def test_invalid_method_raises(self):
+    self.assertRaises(ValueError, getAggregationMethod, 'median')
+    self.assertRaises(ValueError, recalculateSeries, [1.0, 2.0], 60, 120, 'median')
+
+
+class TrimFileTest(TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    os.close(fd)
+    self.values = [float(i) for i in range(3000)]
+    with open(self.path, 'wb') as fh:
+      fh.write(struct.pack('!%dd' % len(self.values), *self.values))
+
+  def tearDown(self):
+    os.unlink(self.path)
+
+  def trim(self, points):
+    with open(self.path, 'r+b') as fh:
+      kept = trimFile(fh, points * DATAPOINT_SIZE)
+    with open(self.path, 'rb') as fh:
+      data = fh.read()
+    values = list(struct.unpack('!%dd' % (len(data) / DATAPOINT_SIZE), data))
+    return kept, values
+
+  def test_trim_keeps_only_nulls_before_offset(self):
+    kept, values = self.trim(1001)
+    keptPoints = kept / DATAPOINT_SIZE
+    self.assertTrue(all(isnan(v) for v in values[:keptPoints]))
+    self.assertEqual(self.values[1001:], values[keptPoints:])
+
+  def test_trim_less_than_a_block_keeps_nulls(self):
+    with open(self.path, 'rb') as fh:
+      if fallocate is None or not canCollapse(fh, os.fstatvfs(fh.fileno()).f_bsize):
+        return  # copied instead, see test_trim_by_copying
+    kept, values = self.trim(60)
+    self.assertEqual(60 * DATAPOINT_SIZE, kept)
+    self.assertEqual(len(self.values), len(values))
+    self.assertTrue(all(isnan(v) for v in values[:60]))
+    self.assertEqual(self.values[60:], values[60:])
+
+  @patch('ceres.collapseSupport', new={})
+  def test_trim_less_than_a_block_without_collapse_copies(self):
+    with patch('ceres.fallocate', new=Mock(return_value=-1)):
+      kept, values = self.trim(60)
+    self.assertEqual(0, kept)
+    self.assertEqual(self.values[60:], values)
+
+  def test_trim_unmaps_the_file_while_it_shrinks(self):
+    pool = SliceMapPool(2)
+    self.addCleanup(pool.clear)
+    self.assertEqual(struct.pack('!d', 0.0), pool.read(self.path, 0, DATAPOINT_SIZE))
+    calls = []
+    def collapse(fd, mode, offset, length):
+      calls.append((pool.lock.locked(), len(pool)))
+      return -1
+    with patch('ceres.fallocate', new=collapse):
+      with open(self.path, 'r+b') as fh:
+        self.assertEqual(0, trimFile(fh, 1000 * DATAPOINT_SIZE, mapPool=pool))
+    self.assertEqual([(True, 0)], calls)
+    self.assertEqual(struct.pack('!d', 1000.0), pool.read(self.path, 0, DATAPOINT_SIZE))
+
+  @patch('ceres.fallocate', None)
+  def test_trim_by_copying(self):
+    with patch('ceres.TRIM_CHUNK_SIZE', 1000):
+      kept, values = self.trim(1001)
+    self.assertEqual(0, kept)
+    self.assertEqual(self.values[1001:], values)
+
+  def test_trim_everything(self):
+    with open(self.path, 'r+b') as fh:
+      self.assertEqual(None, trimFile(fh, len(self.values) * DATAPOINT_SIZE))
+
+
+class SliceMapPoolTest(TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pool = SliceMapPool(2)
+
+  def tearDown(self):
+    self.pool.clear()
+    shutil.rmtree(self.tmpdir)
+
+  def make_file(self, name, data):
+    path = os.path.join(self.tmpdir, name)
+    with open(path, 'wb') as fh:
+      fh.write(data)
+    return path
+
+  def test_read_returns_requested_range(self):
+    path = self.make_file('0@60.slice', 'abcdefgh')
+    self.assertEqual('cde', self.pool.read(path, 2, 3))
+    self.assertEqual(8, self.pool.size(path))
+
+  def test_read_past_end_returns_none(self):
+    path = self.make_file('0@60.slice', 'abcd')
+    self.assertEqual(None, self.pool.read(path, 4, 4))
+    empty = self.make_file('60@60.slice', '')
+    self.assertEqual(None, self.pool.read(empty, 0, 8))
+
+  def test_remaps_when_file_grows(self):
+    path = self.make_file('0@60.slice', 'abcd')
+    self.assertEqual('abcd', self.pool.read(path, 0, 8))
+    with open(path, 'ab') as fh:
+      fh.write('efgh')
+    self.assertEqual('abcdefgh', self.pool.read(path, 0, 8))
+
+  def test_evicts_least_recently_used(self):
+    paths = [self.make_file('%d@60.slice' % i, 'x') for i in range(3)]
+    self.pool.read(paths[0], 0, 1)
+    self.pool.read(paths[1], 0, 1)
+    self.pool.read(paths[0], 0, 1)
+    self.pool.read(paths[2], 0, 1)
+    self.assertEqual(2, len(self.pool))
+    self.assertEqual([paths[0], paths[2]], list(self.pool.entries))
+
+  def test_unlinked_file_raises_slice_deleted(self):
+    path = self.make_file('0@60.slice', 'abcd')
+    self.pool.read(path, 0, 4)
+    os.unlink(path)
+    self.assertRaises(SliceDeleted, self.pool.read, path, 0, 4)
+    self.assertEqual(0, len(self.pool))
+
+  def test_invalidate_drops_mapping(self):
+    path = self.make_file('0@60.slice', 'abcd')
+    self.pool.read(path, 0, 4)
+    self.pool.invalidate(path)
+    self.assertEqual(0, len(self.pool))
+
+  def test_slice_reads_through_tree_pool(self):
+    tree = CeresTree(self.tmpdir)
+    tree.setSliceMapPoolSize(4)
+    node = CeresNode(tree, 'sample_metric', self.tmpdir)
+    self.make_file('0@60.slice', struct.pack('!dd', 1.0, 2.0))
+    ceres_slice = CeresSlice(node, 0, 60)
+    self.assertEqual([(60, 2.0)], list(ceres_slice.read(60, 180)))
+    self.assertEqual(120, ceres_slice.endTime)
+    self.assertEqual(1, len(tree.sliceMapPool))
+    tree.setSliceMapPoolSize(0)
+
+
+class SliceIndexTest(TempTreeTestCase):
+  def setUp(self):
+    super(SliceIndexTest, self).setUp()
+    self.ceres_node = CeresNode(self.ceres_tree, 'sample_metric', self.tmpdir)
+    self.ceres_node.timeStep = 60
+    self.ceres_node.setSliceCachingBehavior('index')
+    for start, points in [(600, 10), (1200, 5), (3000, 2)]:
+      with open(os.path.join(self.tmpdir, '%d@60.slice' % start), 'wb') as fh:
+        fh.write(PACKED_NAN * points)
+
+  def test_slices_sorted_most_recent_first(self):
+    self.assertEqual([3000, 1200, 600], [s.startTime for s in self.ceres_node.slices])
+    self.assertEqual([3120, 1500, 1200], [s.endTime for s in self.ceres_node.slices])
+
+  def test_index_is_reused_while_directory_unchanged(self):
+    list(self.ceres_node.slices)
+    with patch('ceres.CeresNode.readSlices') as read_slices_mock:
+      list(self.ceres_node.slices)
+      self.assertFalse(read_slices_mock.called)
+
+  def test_index_rebuilt_when_directory_changes(self):
+    list(self.ceres_node.slices)
+    self.ceres_node.sliceIndex.mtime -= 1
+    open(os.path.join(self.tmpdir, '6000@60.slice'), 'wb').close()
+    self.assertEqual([6000, 3000, 1200, 600], [s.startTime for s in self.ceres_node.slices])
+
+  def test_create_adds_to_index(self):
+    list(self.ceres_node.slices)
+    CeresSlice.create(self.ceres_node, 900, 300)
+    with patch('ceres.CeresNode.readSlices') as read_slices_mock:
+      self.assertEqual([(3000, 60), (1200, 60), (900, 300), (600, 60)],
+                       [(s.startTime, s.timeStep) for s in self.ceres_node.slices])
+      self.assertFalse(read_slices_mock.called)
+
+  def test_write_updates_known_size(self):
+    self.ceres_node.write([(3120, 1.0), (3180, 2.0)])
+    self.assertEqual(3240, self.ceres_node.sliceIndex.slices[-1].endTime)
+
+  def test_slices_for_interval(self):
+    between = self.ceres_node.slicesForInterval
+    self.assertEqual([1200, 600], [s.startTime for s in between(900, 1800)])
+    self.assertEqual([1200], [s.startTime for s in between(1200, 3000)])
+    self.assertEqual([600], [s.startTime for s in between(0, 700)])
+    self.assertEqual([], [s.startTime for s in between(0, 500)])
+    self.assertEqual([], [s.startTime for s in between(1600, 2000)])
+
+  def test_slices_for_interval_includes_older_overlapping_slices(self):
+    with open(os.path.join(self.tmpdir, '0@60.slice'), 'wb') as fh:
+      fh.write(PACKED_NAN * 40)
+    self.ceres_node.clearSliceCache()
+    between = self.ceres_node.slicesForInterval
+    self.assertEqual([1200, 0], [s.startTime for s in between(1300, 1400)])
+    self.assertEqual([0], [s.startTime for s in between(1500, 2000)])
+
+  def test_appends_to_older_slices_are_seen(self):
+    list(self.ceres_node.slices)
+    with open(os.path.join(self.tmpdir, '1200@60.slice'), 'ab') as fh:
+      fh.write(PACKED_NAN * 10)
+    between = self.ceres_node.slicesForInterval
+    self.assertEqual([1200], [s.startTime for s in between(1600, 2000)])
+    self.assertEqual(2100, self.ceres_node.sliceIndex.slices[1].endTime)
+
+  def test_slices_for_interval_matches_uncached_behavior(self):
+    indexed = self.ceres_node.slicesForInterval(700, 3100)
+    self.ceres_node.setSliceCachingBehavior('none')
+    scanned = self.ceres_node.slicesForInterval(700, 3100)
+    self.assertEqual([s.fsPath for s in scanned], [s.fsPath for s in indexed])
 
+
+class CeresNodeReadTest(TempTreeTestCase):
+  def setUp(self):
+    super(CeresNodeReadTest, self).setUp()
+    self.ceres_node = CeresNode.create(self.ceres_tree, 'sample_metric', timeStep=60)
+
+  def test_read_pads_to_requested_interval(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0, 3.0])
+    series = self.ceres_node.read(480, 960)
+    self.assertEqual((480, 960, 60), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual([None, None, 1.0, 2.0, 3.0, None, None, None], series.values)
+
+  def test_read_across_slices(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0])
+    make_slice(self.ceres_node, 900, [5.0, 6.0])
+    series = self.ceres_node.read(600, 1020)
+    self.assertEqual([1.0, 2.0, None, None, None, 5.0, 6.0], series.values)
+
+  def test_read_most_recent_slice_wins(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0, 3.0, 4.0])
+    make_slice(self.ceres_node, 660, [20.0, 30.0])
+    series = self.ceres_node.read(600, 840)
+    self.assertEqual([1.0, 20.0, 30.0, 4.0], series.values)
+
+  def test_read_older_slice_fills_gaps(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0, 3.0, 4.0, 5.0])
+    make_slice(self.ceres_node, 660, [None, 30.0, None])
+    series = self.ceres_node.read(600, 900)
+    self.assertEqual([1.0, 2.0, 30.0, 4.0, 5.0], series.values)
+
+  def test_read_mixed_timesteps_uses_largest(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0], timeStep=120)
+    make_slice(self.ceres_node, 240, [3.0, 5.0, 7.0, 9.0])
+    series = self.ceres_node.read(0, 480)
+    self.assertEqual(120, series.timeStep)
+    self.assertEqual([1.0, 2.0, 4.0, 8.0], series.values)
+
+  def test_read_mixed_timesteps_buckets_on_largest_step(self):
+    node = CeresNode.create(self.ceres_tree, 'summed_metric', timeStep=60, aggregationMethod='sum')
+    make_slice(node, 0, [1.0, 2.0], timeStep=600)
+    make_slice(node, 1260, [float(minute) for minute in xrange(21, 50)])
+    expected = [1.0, 2.0, 225.0, 345.0, 445.0]
+    series = node.read(0, 3000)
+    self.assertEqual((0, 3000, 600), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual(expected, series.values)
+    self.assertEqual(expected, list(node.read(0, 3000, asArray=True).values))
+    for chunkPoints in (1, 2, 5):
+      chunks = list(node.readIter(0, 3000, chunkPoints, asArray=True))
+      self.assertEqual(expected, [value for chunk in chunks for value in chunk.values])
+
+  def test_read_unaligned_coarse_slice(self):
+    make_slice(self.ceres_node, 0, [1.0] * 5)
+    make_slice(self.ceres_node, 780, [1.0, 2.0, 3.0], timeStep=300)
+    series = self.ceres_node.read(600, 1800)
+    self.assertEqual((600, 1800, 300), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual([1.0, 2.0, 3.0, None], series.values)
+    chunks = self.ceres_node.readIter(600, 1800, 1, asArray=True)
+    self.assertEqual(list(series), [point for chunk in chunks for point in chunk])
+
+  def test_read_mixed_timesteps_aligns_to_largest(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0, 3.0, 4.0, 5.0], timeStep=300)
+    make_slice(self.ceres_node, 1500, [6.0] * 5)
+    series = self.ceres_node.read(660, 1800)
+    self.assertEqual((600, 1800, 300), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual([3.0, 4.0, 5.0, 6.0], series.values)
+
+  def test_read_without_slices_returns_nulls(self):
+    series = self.ceres_node.read(600, 900)
+    self.assertEqual((600, 900, 60), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual([None] * 5, series.values)
+
+  def test_read_as_array_matches_list_read(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0, 3.0, 4.0, 5.0])
+    make_slice(self.ceres_node, 660, [None, 30.0, None])
+    expected = list(self.ceres_node.read(540, 1000))
+    self.assertEqual(expected, list(self.ceres_node.read(540, 1000, asArray=True)))
+
+  def test_read_as_array_ignores_partial_datapoint(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0])
+    with open(os.path.join(self.ceres_node.fsPath, '600@60.slice'), 'ab') as fh:
+      fh.write(struct.pack('!d', 3.0)[:5])
+    values = self.ceres_node.read(600, 840, asArray=True).values
+    self.assertEqual([1.0, 2.0], list(values[:2]))
+    self.assertTrue(all(isnan(v) for v in values[2:]))
+
+  def test_slice_read_into(self):
+    make_slice(self.ceres_node, 600, [1.0, 2.0, 3.0])
+    slice = CeresSlice(self.ceres_node, 600, 60)
+    buffer = bytearray(PACKED_NAN * 4)
+    self.assertEqual(2, slice.readInto(1, memoryview(buffer)))
+    self.assertEqual(struct.pack('!3d', 2.0, 3.0, NAN), str(buffer[:24]))
+    self.assertRaises(NoData, slice.readInto, 3, memoryview(buffer))
+
+  def test_read_iter_matches_read(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], timeStep=120)
+    make_slice(self.ceres_node, 600, [7.0, None, 9.0, 10.0, 11.0])
+    make_slice(self.ceres_node, 900, [20.0, 30.0])
+    expected = self.ceres_node.read(60, 1500)
+    for chunkPoints in (1, 2, 5, 100):
+      chunks = list(self.ceres_node.readIter(60, 1500, chunkPoints))
+      self.assertEqual(list(expected), [point for chunk in chunks for point in chunk])
+      self.assertTrue(all(len(chunk) <= chunkPoints for chunk in chunks))
+      self.assertEqual(expected.endTime, chunks[-1].endTime)
+
+  def test_read_iter_without_slices(self):
+    chunks = list(self.ceres_node.readIter(600, 900, 2))
+    self.assertEqual([(600, 720), (720, 840), (840, 900)],
+                     [(chunk.startTime, chunk.endTime) for chunk in chunks])
+
+  def test_plan_skips_slices_outside_interval(self):
+    make_slice(self.ceres_node, 0, [1.0])
+    make_slice(self.ceres_node, 600, [1.0, 2.0])
+    make_slice(self.ceres_node, 6000, [1.0])
+    plan = self.ceres_node.planRead(600, 720)
+    self.assertEqual([600], [region[0].startTime for region in plan.regions])
+
+
+class CeresTreeFetchManyTest(TempTreeTestCase):
+  def setUp(self):
+    super(CeresTreeFetchManyTest, self).setUp()
+    self.ceres_tree.setFetchThreads(2)
+    fine = CeresNode.create(self.ceres_tree, 'metrics.fine', timeStep=60)
+    fine.write([(t, 1.0) for t in range(600, 1200, 60)])
+    coarse = CeresNode.create(self.ceres_tree, 'metrics.coarse', timeStep=120)
+    coarse.write([(t, 2.0) for t in range(600, 1200, 120)])
+
+  def tearDown(self):
+    self.ceres_tree.setFetchThreads(1)
+
+  def test_fetch_many_aligns_to_largest_timestep(self):
+    results = self.ceres_tree.fetchMany(['metrics.fine', 'metrics.coarse'], 540, 1260)
+    self.assertEqual(['metrics.coarse', 'metrics.fine'], sorted(results))
+    for series in results.values():
+      self.assertEqual((480, 1200, 120), (series.startTime, series.endTime, series.timeStep))
+    self.assertEqual([None, 1.0, 1.0, 1.0, 1.0, 1.0], results['metrics.fine'].values)
+    self.assertEqual([None, 2.0, 2.0, 2.0, 2.0, 2.0], results['metrics.coarse'].values)
+
+  def test_fetch_many_skips_missing_nodes(self):
+    results = self.ceres_tree.fetchMany(['metrics.fine', 'metrics.missing'], 600, 1200)
+    self.assertEqual(['metrics.fine'], list(results))
+
+  def test_fetch_many_matches_fetch(self):
+    self.ceres_tree.setFetchThreads(1)
+    results = self.ceres_tree.fetchMany(['metrics.fine'], 600, 1200, asArray=True)
+    expected = self.ceres_tree.fetch('metrics.fine', 600, 1200)
+    self.assertEqual(list(expected), list(results['metrics.fine']))
+
+
+class AsyncCeresTreeTest(TempTreeTestCase):
+  def setUp(self):
+    super(AsyncCeresTreeTest, self).setUp()
+    node = CeresNode.create(self.ceres_tree, 'metrics.foo', timeStep=60)
+    node.write([(t, 1.0) for t in range(600, 1200, 60)])
+    CeresNode.create(self.ceres_tree, 'metrics.bar', timeStep=60)
+    self.async_tree = AsyncCeresTree(self.ceres_tree, maxWorkers=2)
+
+  def tearDown(self):
+    self.async_tree.close()
+
+  def test_fetch(self):
+    series = self.async_tree.fetch('metrics.foo', 600, 1200).result(5)
+    self.assertEqual([1.0] * 10, series.values)
+
+  def test_fetch_missing_node(self):
+    future = self.async_tree.fetch('metrics.missing', 600, 1200)
+    self.assertRaises(NodeNotFound, future.result, 5)
+
+  def test_fetch_many_with_concurrency_limit(self):
+    future = self.async_tree.fetchMany(['metrics.foo', 'metrics.bar', 'metrics.missing'],
+                                       600, 1200, concurrency=1)
+    results = future.result(5)
+    self.assertEqual(['metrics.bar', 'metrics.foo'], sorted(results))
+    self.assertEqual([None] * 10, results['metrics.bar'].values)
+
+  def test_fetch_many_matches_sync_fetch_many(self):
+    fine = CeresNode.create(self.ceres_tree, 'metrics.fine', timeStep=60, aggregationMethod='sum')
+    fine.write([(t, 2.5) for t in range(600, 840, 60)])
+    coarse = CeresNode.create(self.ceres_tree, 'metrics.coarse', timeStep=120)
+    coarse.write([(600, 1.0), (720, 1.0)])
+    nodePaths = ['metrics.fine', 'metrics.coarse']
+    expected = self.ceres_tree.fetchMany(nodePaths, 600, 840)
+    results = self.async_tree.fetchMany(nodePaths, 600, 840).result(5)
+    self.assertEqual([5.0, 5.0], results['metrics.fine'].values)
+    for nodePath in nodePaths:
+      self.assertEqual(list(expected[nodePath]), list(results[nodePath]))
+
+  def test_find_and_store(self):
+    self.async_tree.store('metrics.bar', [(600, 5.0)]).result(5)
+    nodes = self.async_tree.find('metrics.*', 600, 660).result(5)
+    self.assertEqual(['metrics.bar', 'metrics.foo'], sorted(n.nodePath for n in nodes))
+
+  def test_cancel_running_call_fails_with_cancelled_error(self):
+    future = CeresFuture()
+    future.set_running_or_notify_cancel()
+    self.assertFalse(future.cancel())
+    self.assertTrue(future.stopRequested)
+    self.assertRaises(futures.CancelledError, future.result, 0)
+    future.succeed(None)  # late results are ignored
+    self.assertRaises(futures.CancelledError, future.result, 0)
+
+  def test_cancelled_plan_stops_reading(self):
+    node = self.ceres_tree.getNode('metrics.foo')
+    plan = node.planRead(600, 1200)
+    with patch('ceres.CeresSlice.read') as read_mock:
+      self.assertRaises(ReadCancelled, plan.execute, cancelled=lambda: True)
+      self.assertFalse(read_mock.called)
+
+
+class CeresWriteBufferTest(TestCase):
+  def setUp(self):
+    with patch('ceres.isdir', new=Mock(return_value=True)):
+      self.ceres_tree = CeresTree('/graphite/storage/ceres')
+    self.nodes = {}
+    for nodePath in ('metrics.foo', 'metrics.bar', 'metrics.baz'):
+      self.nodes[nodePath] = Mock(spec=CeresNode)
+    self.ceres_tree.getNode = Mock(side_effect=self.nodes.get)
+
+  def test_invalid_order(self):
+    self.assertRaises(ValueError, CeresWriteBuffer, self.ceres_tree, order='newest')
+
+  def test_store_invalid_node(self):
+    buffer = CeresWriteBuffer(self.ceres_tree)
+    self.assertRaises(NodeNotFound, buffer.store, 'metrics.missing', [(60, 1.0)])
+
+  def test_store_buffers_below_threshold(self):
+    buffer = CeresWriteBuffer(self.ceres_tree, maxPoints=3)
+    buffer.store('metrics.foo', [(60, 1.0)])
+    buffer.store('metrics.foo', [(120, 2.0)])
+    self.assertFalse(self.nodes['metrics.foo'].write.called)
+    self.assertEqual(2, len(buffer))
+
+  def test_store_writes_batch_at_threshold(self):
+    buffer = CeresWriteBuffer(self.ceres_tree, maxPoints=3)
+    buffer.store('metrics.foo', [(60, 1.0)])
+    buffer.store('metrics.foo', [(120, 2.0), (180, 3.0)])
+    self.nodes['metrics.foo'].write.assert_called_once_with([(60, 1.0), (120, 2.0), (180, 3.0)])
+    self.assertEqual(0, len(buffer))
+
+  def test_store_writes_expired_nodes(self):
+    buffer = CeresWriteBuffer(self.ceres_tree, maxAge=30)
+    with patch('ceres.time.time', new=Mock(return_value=1000)):
+      buffer.store('metrics.foo', [(60, 1.0)])
+    with patch('ceres.time.time', new=Mock(return_value=1040)):
+      buffer.store('metrics.bar', [(60, 1.0)])
+    self.nodes['metrics.foo'].write.assert_called_once_with([(60, 1.0)])
+    self.assertFalse(self.nodes['metrics.bar'].write.called)
+
+  def test_total_cap_flushes_largest_first(self):
+    buffer = CeresWriteBuffer(self.ceres_tree, maxBufferedPoints=3, order='largest')
+    buffer.store('metrics.foo', [(60, 1.0)])
+    buffer.store('metrics.bar', [(60, 1.0), (120, 1.0)])
+    buffer.store('metrics.baz', [(60, 1.0)])
+    self.assertTrue(self.nodes['metrics.bar'].write.called)
+    self.assertFalse(self.nodes['metrics.foo'].write.called)
+    self.assertFalse(self.nodes['metrics.baz'].write.called)
+
+  def test_total_cap_flushes_oldest_first(self):
+    buffer = CeresWriteBuffer(self.ceres_tree, maxBufferedPoints=3)
+    buffer.store('metrics.foo', [(60, 1.0)])
+    buffer.store('metrics.bar', [(60, 1.0), (120, 1.0)])
+    buffer.store('metrics.baz', [(60, 1.0)])
+    self.assertTrue(self.nodes['metrics.foo'].write.called)
+    self.assertFalse(self.nodes['metrics.bar'].write.called)
+
+  def test_close_flushes_everything(self):
+    with CeresWriteBuffer(self.ceres_tree) as buffer:
+      buffer.store('metrics.foo', [(60, 1.0)])
+      buffer.store('metrics.bar', [(60, 2.0)])
+    self.nodes['metrics.foo'].write.assert_called_once_with([(60, 1.0)])
+    self.nodes['metrics.bar'].write.assert_called_once_with([(60, 2.0)])
+    self.assertEqual(0, len(buffer))
+
+
+class ConsistentHashRingTest(TestCase):
+  def test_keys_map_to_stable_nodes(self):
+    ring = ConsistentHashRing(range(4))
+    keys = ['servers.host%d.cpu.user' % i for i in range(200)]
+    assignments = [ring.getNode(key) for key in keys]
+    self.assertEqual(assignments, [ConsistentHashRing(range(4)).getNode(key) for key in keys])
+    self.assertEqual(set(range(4)), set(assignments))
+
+  def test_adding_a_node_only_moves_its_keys(self):
+    keys = ['servers.host%d.cpu.user' % i for i in range(200)]
+    before = ConsistentHashRing(range(4))
+    after = ConsistentHashRing(range(5))
+    for key in keys:
+      if after.getNode(key) != 4:
+        self.assertEqual(before.getNode(key), after.getNode(key))
+
+
+class CeresTreeStoreManyTest(TempTreeTestCase):
+  def setUp(self):
+    super(CeresTreeStoreManyTest, self).setUp()
+    for i in range(6):
+      CeresNode.create(self.ceres_tree, 'metrics.m%d' % i, timeStep=60)
+    self.mapping = dict(('metrics.m%d' % i, [(600, float(i)), (660, float(i))]) for i in range(6))
+    self.mapping['metrics.missing'] = [(600, 1.0)]
+
+  def tearDown(self):
+    self.ceres_tree.setStoreProcesses(0)
+
+  def check_results(self, results):
+    self.assertEqual(sorted(self.mapping), sorted(results))
+    self.assertTrue(isinstance(results.pop('metrics.missing'), NodeNotFound))
+    self.assertEqual([None] * 6, results.values())
+    for i in range(6):
+      self.assertEqual([float(i)] * 2, self.ceres_tree.fetch('metrics.m%d' % i, 600, 720).values)
+
+  def test_store_many_in_process(self):
+    self.check_results(self.ceres_tree.storeMany(self.mapping))
+
+  def test_store_many_with_worker_processes(self):
+    self.ceres_tree.setStoreProcesses(2)
+    self.check_results(self.ceres_tree.storeMany(self.mapping))
+
+  def test_shards_are_disjoint(self):
+    pool = StoreWorkerPool.__new__(StoreWorkerPool)
+    pool.ring = ConsistentHashRing(range(3))
+    shards = pool.shard(self.mapping)
+    sharded = [nodePath for items in shards.values() for nodePath, datapoints in items]
+    self.assertEqual(sorted(self.mapping), sorted(sharded))
+
+
+class MetricNameIndexTest(TempTreeTestCase):
+  create_tree = True
+
+  def setUp(self):
+    super(MetricNameIndexTest, self).setUp()
+    for nodePath in ('a.b.c', 'a.b.d', 'a.bc.c', 'a.e', 'b.x'):
+      self.ceres_tree.createNode(nodePath, timeStep=60)
+
+  def test_no_index_by_default(self):
+    self.assertEqual(None, self.ceres_tree.nameIndex)
+
+  def test_rebuild_writes_sorted_names(self):
+    self.ceres_tree.rebuildNameIndex()
+    with open(join(self.tmpdir, '.ceres-tree', 'names')) as fh:
+      self.assertEqual(['a.b.c', 'a.b.d', 'a.bc.c', 'a.e', 'b.x'], fh.read().split())
+
+  def test_names_by_prefix(self):
+    self.ceres_tree.rebuildNameIndex()
+    index = self.ceres_tree.nameIndex
+    self.assertEqual(['a.b.c', 'a.b.d', 'a.bc.c'], list(index.names('a.b')))
+    self.assertEqual(['b.x'], list(index.names('b')))
+    self.assertEqual([], list(index.names('c')))
+
+  def test_match(self):
+    self.ceres_tree.rebuildNameIndex()
+    index = self.ceres_tree.nameIndex
+    self.assertEqual(['a.b.c', 'a.bc.c'], list(index.match('a.b*.c')))
+    self.assertEqual(['a.b.d'], list(index.match('a.?.d')))
+    self.assertEqual(['a.e'], list(index.match('a.e')))
+    self.assertEqual([], list(index.match('a')))
+
+  def test_match_leading_wildcards(self):
+    self.ceres_tree.rebuildNameIndex()
+    self.ceres_tree.createNode('c.b.c', timeStep=60)
+    index = self.ceres_tree.nameIndex
+    self.assertEqual(['a.b.c', 'a.bc.c', 'c.b.c'], list(index.match('*.*.c')))
+    self.assertEqual(['a.e', 'b.x'], list(index.match('?.[ex]')))
+    self.assertEqual(['a.b.c', 'c.b.c'], list(index.match('{a,c,d}.b.c')))
+
+  def test_match_names_sorting_between_siblings(self):
+    self.ceres_tree.rebuildNameIndex()
+    index = self.ceres_tree.nameIndex
+    with open(index.path, 'wb') as fh:
+      fh.write('\n'.join(sorted(['a.b', 'a.b-x.c', 'a.b.c', 'a.b.d', 'a.bc.c', 'a.e', 'b.x'])) + '\n')
+    self.assertEqual(['a.b', 'a.e'], list(index.match('a.*')))
+    self.assertEqual(['a.b.c', 'a.b-x.c', 'a.bc.c'], list(index.match('a.*.c')))
+
+  def test_find_uses_index(self):
+    self.ceres_tree.rebuildNameIndex()
+    with patch('ceres.MetricPattern.expand', new=Mock(side_effect=AssertionError)):
+      found = [node.nodePath for node in self.ceres_tree.find('a.*.c')]
+    self.assertEqual(['a.b.c', 'a.bc.c'], found)
+
+  def test_created_nodes_are_indexed(self):
+    self.ceres_tree.rebuildNameIndex()
+    self.ceres_tree.createNode('a.b.z', timeStep=60)
+    self.assertEqual(['a.b.c', 'a.b.d', 'a.b.z'], [node.nodePath for node in self.ceres_tree.find('a.b.*')])
+    other = CeresTree(self.tmpdir)
+    self.assertEqual(['a.b.z'], [node.nodePath for node in other.find('a.b.z')])
+
+  def test_nodes_created_by_trees_opened_before_the_index_are_indexed(self):
+    writer = CeresTree(self.tmpdir)
+    self.ceres_tree.rebuildNameIndex()
+    writer.createNode('a.b.z', timeStep=60)
+    self.assertEqual(['a.b.c', 'a.b.d', 'a.b.z'], list(self.ceres_tree.nameIndex.match('a.b.*')))
+
+  def test_removed_nodes_are_skipped(self):
+    self.ceres_tree.rebuildNameIndex()
+    shutil.rmtree(join(self.tmpdir, 'b', 'x'))
+    self.assertEqual([], list(self.ceres_tree.find('b.*')))
+
+  def test_rebuild_empties_log(self):
+    self.ceres_tree.rebuildNameIndex()
+    self.ceres_tree.createNode('c.d', timeStep=60)
+    self.ceres_tree.rebuildNameIndex()
+    self.assertFalse(exists(join(self.tmpdir, '.ceres-tree', 'names.log')))
+    self.assertEqual(['c.d'], list(self.ceres_tree.nameIndex.names('c')))
+
+
+class MetricPatternTest(TempTreeTestCase):
+  def setUp(self):
+    super(MetricPatternTest, self).setUp()
+    for nodePath in ('web1.cpu.user', 'web1.cpu.system', 'web2.cpu.user', 'web10.cpu.user',
+                     'db1.cpu.user', 'db1.mem.free'):
+      self.ceres_tree.createNode(nodePath, timeStep=60)
+
+  def tearDown(self):
+    self.ceres_tree.setFindThreads(1)
+
+  def test_expand_braces(self):
+    self.assertEqual(['a'], expandBraces('a'))
+    self.assertEqual(['ab', 'ac'], expandBraces('a{b,c}'))
+    self.assertEqual(['ac', 'ad', 'bc', 'bd'], expandBraces('{a,b}{c,d}'))
+    self.assertEqual(['a', 'bc', 'bd'], expandBraces('{a,b{c,d}}'))
+    self.assertEqual(['a{b'], expandBraces('a{b'))
+
+  def test_matches(self):
+    pattern = MetricPattern('web{1,2}.cpu.[!s]*')
+    self.assertTrue(pattern.matches('web1.cpu.user'))
+    self.assertTrue(pattern.matches('web2.cpu.user'))
+    self.assertFalse(pattern.matches('web1.cpu.system'))
+    self.assertFalse(pattern.matches('web10.cpu.user'))
+    self.assertFalse(MetricPattern('*.user').matches('web1.cpu.user'))
+    self.assertTrue(MetricPattern('web[0-9]?.*.user').matches('web10.cpu.user'))
+    self.assertTrue(MetricPattern('a[b').matches('a[b'))
+
+  def test_literal_components_are_not_listed(self):
+    pattern = MetricPattern('{web1,db1}.cpu.user')
+    with patch('os.listdir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual(['db1.cpu.user', 'web1.cpu.user'], list(pattern.expand(self.tmpdir)))
+
+  def test_find_with_braces_and_classes(self):
+    found = [node.nodePath for node in self.ceres_tree.find('{web,db}[0-9].{cpu,mem}.*')]
+    self.assertEqual(['db1.cpu.user', 'db1.mem.free', 'web1.cpu.system', 'web1.cpu.user',
+                      'web2.cpu.user'], found)
+
+  def test_find_skips_non_nodes(self):
+    self.assertEqual([], list(self.ceres_tree.find('web1.*')))
+    self.assertEqual([], list(self.ceres_tree.find('web1.cpu.user.*')))
+    self.assertEqual([], list(self.ceres_tree.find('missing.{a,b}')))
+
+  @patch('ceres.FIND_PARALLEL_WIDTH', new=2)
+  def test_find_lists_wide_levels_in_parallel(self):
+    self.ceres_tree.setFindThreads(3)
+    found = [node.nodePath for node in self.ceres_tree.find('*.*.user')]
+    self.assertEqual(['db1.cpu.user', 'web1.cpu.user', 'web10.cpu.user', 'web2.cpu.user'], found)
+    self.assertNotEqual(None, self.ceres_tree.findPool)
+
+  def test_find_with_braces_in_index(self):
+    self.ceres_tree.rebuildNameIndex()
+    found = [node.nodePath for node in self.ceres_tree.find('web{1,2}.cpu.{user,idle}')]
+    self.assertEqual(['web1.cpu.user', 'web2.cpu.user'], found)
+
+
+class NodeCacheTest(TempTreeTestCase):
+  def setUp(self):
+    super(NodeCacheTest, self).setUp()
+    self.ceres_tree.setNodeCacheSize(2, negativeTTL=60)
+    for nodePath in ('a', 'b', 'c'):
+      CeresNode.create(self.ceres_tree, nodePath, timeStep=60)
+
+  def test_hits_and_misses(self):
+    node = self.ceres_tree.getNode('a')
+    self.assertTrue(node is self.ceres_tree.getNode('a'))
+    stats = self.ceres_tree.nodeCache.stats()
+    self.assertEqual((1, 1), (stats['hits'], stats['misses']))
+
+  def test_evicts_least_recently_used(self):
+    self.ceres_tree.getNode('a')
+    self.ceres_tree.getNode('b')
+    self.ceres_tree.getNode('a')
+    self.ceres_tree.getNode('c')
+    cache = self.ceres_tree.nodeCache
+    self.assertEqual(2, len(cache))
+    self.assertEqual(1, cache.stats()['evictions'])
+    self.assertEqual(None, cache.get('b'))
+    self.assertNotEqual(None, cache.get('a'))
+
+  def test_missing_nodes_are_remembered(self):
+    self.assertEqual(None, self.ceres_tree.getNode('missing'))
+    with patch('ceres.CeresNode.isNodeDir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual(None, self.ceres_tree.getNode('missing'))
+    self.assertEqual(1, self.ceres_tree.nodeCache.stats()['negativeHits'])
+
+  def test_missing_entries_expire(self):
+    self.assertEqual(None, self.ceres_tree.getNode('d'))
+    CeresNode.create(self.ceres_tree, 'd', timeStep=60)
+    self.assertEqual(None, self.ceres_tree.getNode('d'))
+    with patch('time.time', new=Mock(return_value=time.time() + 61)):
+      self.assertNotEqual(None, self.ceres_tree.getNode('d'))
+
+  def test_create_node_invalidates_missing_entry(self):
+    self.assertEqual(None, self.ceres_tree.getNode('d'))
+    self.ceres_tree.createNode('d', timeStep=60)
+    self.assertNotEqual(None, self.ceres_tree.getNode('d'))
+
+  def test_negative_ttl_zero_disables_missing_entries(self):
+    self.ceres_tree.setNodeCacheSize(2, negativeTTL=0)
+    self.ceres_tree.getNode('missing')
+    self.assertEqual(0, len(self.ceres_tree.nodeCache))
+
+
+class ReadCacheTest(TempTreeTestCase):
+  def setUp(self):
+    super(ReadCacheTest, self).setUp()
+    self.ceres_tree.setReadCacheSize(1024 * 1024)
+    self.ceres_node = CeresNode.create(self.ceres_tree, 'sample_metric', timeStep=60)
+    self.ceres_node.write([(t, 1.0) for t in range(600, 1200, 60)])
+    self.age_files()
+
+  def age_files(self):
+    # entries over files modified within MTIME_GRANULARITY are not trusted
+    past = time.time() - 10 * MTIME_GRANULARITY
+    fsPath = self.ceres_node.fsPath
+    for path in [fsPath] + [os.path.join(fsPath, name) for name in os.listdir(fsPath)]:
+      os.utime(path, (past, past))
+
+  def test_repeated_read_hits(self):
+    first = self.ceres_node.read(600, 1200)
+    first.values[0] = 42.0  # callers get a copy
+    second = self.ceres_node.read(610, 1200)
+    self.assertEqual([1.0] * 10, second.values)
+    stats = self.ceres_tree.readCache.stats()
+    self.assertEqual((1, 1, 0.5), (stats['hits'], stats['misses'], stats['hitRate']))
+
+  def test_write_invalidates_overlapping_reads(self):
+    self.ceres_node.read(600, 900)
+    self.ceres_node.read(900, 1200)
+    self.ceres_node.write([(960, 5.0)])
+    self.assertEqual(1, len(self.ceres_tree.readCache))
+    self.assertEqual(5.0, self.ceres_node.read(900, 1200).values[1])
+
+  def test_delete_before_invalidates_earlier_reads(self):
+    self.ceres_node.read(600, 900)
+    self.ceres_node.read(900, 1200)
+    self.ceres_node.deleteBefore(720)
+    self.assertEqual(1, len(self.ceres_tree.readCache))
+    self.assertEqual([None, None, 1.0, 1.0, 1.0], self.ceres_node.read(600, 900).values)
+
+  def test_evicts_least_recently_used_by_size(self):
+    self.ceres_tree.setReadCacheSize(2 * (READ_CACHE_ENTRY_OVERHEAD + 5 * 32))
+    self.ceres_node.read(600, 900)
+    self.ceres_node.read(900, 1200)
+    self.ceres_node.read(600, 900)
+    self.ceres_node.read(660, 960)
+    cache = self.ceres_tree.readCache
+    self.assertEqual(1, cache.stats()['evictions'])
+    self.assertEqual([('sample_metric', 600, 900, 60), ('sample_metric', 660, 960, 60)],
+                     list(cache.entries))
+
+  def test_writes_by_other_trees_are_seen(self):
+    self.assertEqual([1.0] * 10, self.ceres_node.read(600, 1200).values)
+    # written through another tree, as another process would, so the cache is not told
+    other = CeresTree(self.tmpdir).getNode('sample_metric')
+    other.write([(720, 3.0)])
+    self.assertEqual(3.0, self.ceres_node.read(600, 1200).values[2])
+    self.assertEqual(1, self.ceres_tree.readCache.stats()['stale'])
+
+  def test_appends_to_preceding_slice_are_seen(self):
+    self.assertEqual([None] * 3, self.ceres_node.read(1200, 1380).values)
+    CeresTree(self.tmpdir).getNode('sample_metric').write([(1260, 3.0)])
+    self.assertEqual([None, 3.0, None], self.ceres_node.read(1200, 1380).values)
+
+  def test_recently_modified_files_are_not_trusted(self):
+    self.ceres_node.write([(1200, 2.0)])
+    self.ceres_node.read(600, 1260)
+    self.ceres_node.read(600, 1260)
+    self.assertEqual(0, self.ceres_tree.readCache.stats()['hits'])
+
+  def test_store_through_worker_processes_is_seen(self):
+    self.ceres_tree.createNode('other_metric', timeStep=60)
+    self.assertEqual([1.0] * 10, self.ceres_tree.fetch('sample_metric', 600, 1200).values)
+    self.ceres_tree.setStoreProcesses(2)
+    try:
+      self.ceres_tree.storeMany({'sample_metric': [(720, 42.0)], 'other_metric': [(600, 1.0)]})
+    finally:
+      self.ceres_tree.setStoreProcesses(0)
+    self.assertEqual(42.0, self.ceres_tree.fetch('sample_metric', 600, 1200).values[2])
+
+  def test_array_and_list_reads_share_entries(self):
+    expected = self.ceres_node.read(600, 1200).values
+    self.assertEqual(expected, list(self.ceres_node.read(600, 1200, asArray=True).values))
+    self.assertEqual(1, self.ceres_tree.readCache.stats()['hits'])
+
+
+class ExtentCatalogTest(TempTreeTestCase):
+  create_tree = True
+
+  def setUp(self):
+    super(ExtentCatalogTest, self).setUp()
+    self.ceres_tree.createNode('a', timeStep=60)
+    self.ceres_tree.createNode('b', timeStep=60)
+    self.ceres_tree.store('a', [(600, 1.0), (660, 2.0)])
+    self.ceres_tree.store('b', [(6000, 1.0)])
+    self.ceres_tree.rebuildExtentCatalog()
+    self.catalog = self.ceres_tree.extentCatalog
+
+  def tearDown(self):
+    self.catalog.close()
+
+  def find(self, fromTime, untilTime):
+    return [node.nodePath for node in self.ceres_tree.find('{a,b}', fromTime, untilTime)]
+
+  def test_rebuild_records_extents(self):
+    self.assertEqual((600, 720, 60), self.catalog.get('a'))
+    self.assertEqual((6000, 6060, 60), self.catalog.get('b'))
+
+  def test_find_answers_from_catalog(self):
+    with patch('os.listdir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual(['a'], self.find(0, 1000))
+      self.assertEqual([], self.find(0, 500))
+    # intervals after a node's latest data may have been written since
+    self.assertEqual(['b'], self.find(5000, 7000))
+    self.assertEqual([], self.find(2000, 3000))
+
+  def test_writes_extend_extents(self):
+    self.ceres_tree.store('a', [(3000, 1.0)])
+    self.assertEqual((600, 3060, 60), self.catalog.get('a'))
+    self.assertEqual(['a'], self.find(2000, 4000))
+
+  def test_writes_are_flushed_for_other_processes(self):
+    self.ceres_tree.store('b', [(300, 1.0)])
+    other = ExtentCatalog(CeresTree(self.tmpdir))
+    self.assertEqual((6000, 6060, 60), other.get('b'))
+    self.catalog.flush()
+    self.assertEqual((300, 6060, 60), other.get('b'))
+
+  def test_coarser_writes_keep_the_latest_timestep(self):
+    self.ceres_tree.getNode('a').write([(0, 1.0)], 300)
+    self.assertEqual((0, 720, 60), self.catalog.get('a'))
+    self.ceres_tree.getNode('a').write([(3000, 1.0)], 300)
+    self.catalog.flush()
+    self.assertEqual((0, 3300, 300), self.catalog.get('a'))
+
+  @patch('ceres.fallocate', None)
+  def test_delete_before_trims_extents(self):
+    self.ceres_tree.getNode('a').deleteBefore(660)
+    self.assertEqual((660, 720, 60), self.catalog.get('a'))
+    self.catalog.flush()
+    self.assertEqual((660, 720, 60), ExtentCatalog(CeresTree(self.tmpdir)).get('a'))
+    with patch('os.listdir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual([], self.find(0, 660))
+      self.assertEqual(['a'], self.find(0, 1000))
+
+  def test_write_after_delete_before(self):
+    node = self.ceres_tree.getNode('b')
+    node.deleteBefore(7000)
+    self.assertEqual(None, self.catalog.get('b'))
+    node.write([(9000, 1.0)])
+    self.assertEqual((9000, 9060, 60), self.catalog.get('b'))
+    self.catalog.flush()
+    self.assertEqual((9000, 9060, 60), ExtentCatalog(CeresTree(self.tmpdir)).get('b'))
+    self.assertEqual(['b'], self.find(8000, 10000))
+
+  def test_nodes_created_after_rebuild_are_cataloged(self):
+    self.ceres_tree.createNode('c', timeStep=60)
+    self.ceres_tree.store('c', [(120, 1.0)])
+    self.assertEqual((120, 180, 60), self.catalog.get('c'))
+    self.catalog.flush()
+    self.assertEqual((120, 180, 60), ExtentCatalog(CeresTree(self.tmpdir)).get('c'))
+    with patch('os.listdir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual(['c'], [node.nodePath for node in self.ceres_tree.find('c', 0, 1000)])
+      self.assertEqual([], [node.nodePath for node in self.ceres_tree.find('c', 1000, 2000)])
+
+  def test_uncataloged_nodes_are_checked_on_disk(self):
+    node = CeresNode.create(CeresTree(self.tmpdir), 'c', timeStep=60)
+    make_slice(node, 120, [1.0])
+    self.assertEqual(None, self.catalog.get('c'))
+    self.assertEqual(['c'], [node.nodePath for node in self.ceres_tree.find('c', 0, 1000)])
+    self.assertEqual([], [node.nodePath for node in self.ceres_tree.find('c', 1000, 2000)])
+
+  def test_find_with_read_only_catalog(self):
+    self.ceres_tree.createNode('c', timeStep=60)
+    self.ceres_tree.store('c', [(120, 1.0)])
+    self.catalog.flush()
+    self.catalog.db.execute('PRAGMA query_only = ON')
+    self.assertEqual(['a', 'c'], sorted(node.nodePath for node in self.ceres_tree.find('*', 0, 1000)))
+    self.assertEqual(['b'], self.find(5000, 7000))
+    self.catalog.db.execute('PRAGMA query_only = OFF')
+
+  def test_find_after_latest_answers_from_catalog(self):
+    other = CeresTree(self.tmpdir)
+    other.store('b', [(60000, 1.0)])
+    self.assertEqual((6000, 6060, 60), self.catalog.get('b'))
+    other.extentCatalog.flush()
+    with patch('os.listdir', new=Mock(side_effect=AssertionError)):
+      self.assertEqual(['b'], self.find(50000, 70000))
+      self.assertEqual([], self.find(70000, 80000))
+
+  def test_pending_writes_are_flushed_at_exit(self):
+    script = "from ceres import CeresTree; CeresTree(%r).store('b', [(9000, 1.0)])" % self.tmpdir
+    env = dict(os.environ, PYTHONPATH=dirname(dirname(abspath(__file__))))
+    subprocess.check_call([sys.executable, '-c', script], env=env)
+    self.assertEqual((6000, 9060, 60), self.catalog.get('b'))
+
+  @patch('ceres.INDEX_RECHECK_INTERVAL', new=0)
+  def test_catalog_built_after_opening_is_used(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    writer = CeresTree.createTree(root)
+    writer.createNode('c', timeStep=60)
+    writer.store('c', [(60, 1.0)])
+    CeresTree(root).rebuildExtentCatalog()
+    writer.store('c', [(120, 1.0)])
+    writer.close()
+    self.assertEqual((60, 180, 60), ExtentCatalog(CeresTree(root)).get('c'))
+
+
+class CompressedSliceTest(TempTreeTestCase):
+  def setUp(self):
+    super(CompressedSliceTest, self).setUp()
+    self.ceres_node = self.ceres_tree.createNode('metrics.foo', timeStep=60)
+    self.values = [float(i % 3) for i in range(600)]
+    self.values[100:150] = [None] * 50
+    self.ceres_node.write([(i * 60, v) for i, v in enumerate(self.values[:100])])
+    self.ceres_node.write([(i * 60, v) for i, v in enumerate(self.values) if i >= 150])  # padded
+    self.ceres_node.write([(60000, 5.0)])  # a later slice left raw
+
+  def test_values_roundtrip(self):
+    packed = struct.pack('!5d', 1.0, 1.0, NAN, -2.5, 1e300)
+    compressed = compressValues(packed, blockPoints=2)
+    self.assertEqual(packed, decompressValues(compressed))
+    self.assertEqual('', decompressValues(compressValues('')))
+
+  def test_unchanged_values_take_one_byte(self):
+    packed = struct.pack('!100d', *([42.0] * 100))
+    self.assertEqual(COMPRESSED_HEADER_SIZE + 2 * COMPRESSED_OFFSET_SIZE + 8 + 99,
+                     len(compressValues(packed)))
+
+  def test_compress_slices_skips_latest(self):
+    self.assertEqual(1, self.ceres_node.compressSlices())
+    self.assertEqual(['0@60.cslice', '60000@60.slice'],
+                     sorted(f for f in os.listdir(self.ceres_node.fsPath) if 'slice' in f))
+
+  def test_read_matches_raw_slice(self):
+    expected = self.ceres_node.read(0, 61000).values
+    self.ceres_node.compressSlices(includeLatest=True)
+    self.assertEqual(expected, self.ceres_node.read(0, 61000).values)
+    self.assertEqual(self.values[255:300], self.ceres_node.read(255 * 60, 300 * 60).values)
+
+  def test_read_decodes_only_needed_blocks(self):
+    self.ceres_node.compressSlices()
+    slice = list(self.ceres_node.slices)[1]
+    with patch('ceres.decodeBlock', wraps=decodeBlock) as decode_mock:
+      self.assertEqual(self.values[300:310], slice.read(300 * 60, 310 * 60).values)
+    self.assertEqual(1, decode_mock.call_count)
+
+  def test_end_time(self):
+    self.ceres_node.compressSlices()
+    slice = list(self.ceres_node.slices)[1]
+    self.assertTrue(isinstance(slice, CompressedSlice))
+    self.assertEqual(600 * 60, slice.endTime)
+
+  def test_read_past_end_raises_no_data(self):
+    self.ceres_node.compressSlices()
+    slice = list(self.ceres_node.slices)[1]
+    self.assertRaises(NoData, slice.read, 600 * 60, 700 * 60)
+
+  def test_write_into_compressed_slice(self):
+    self.ceres_node.compressSlices()
+    self.ceres_node.write([(120 * 60, 9.0), (620 * 60, 7.0)])
+    values = self.ceres_node.read(0, 700 * 60).values
+    self.assertEqual(9.0, values[120])
+    self.assertEqual(7.0, values[620])
+    self.assertEqual(None, values[610])
+    self.assertTrue(isinstance(list(self.ceres_node.slices)[-1], CompressedSlice))
+
+  def test_delete_before(self):
+    self.ceres_node.compressSlices()
+    slice = list(self.ceres_node.slices)[1]
+    slice.deleteBefore(500 * 60)
+    slice = list(self.ceres_node.slices)[1]
+    self.assertEqual((500 * 60, 600 * 60), (slice.startTime, slice.endTime))
+    self.assertEqual(self.values[500:], slice.read(500 * 60, 600 * 60).values)
+    self.assertRaises(SliceDeleted, slice.deleteBefore, 700 * 60)
+
+  def test_decompress_slices(self):
+    expected = self.ceres_node.read(0, 61000).values
+    self.ceres_node.compressSlices()
+    self.assertEqual(1, self.ceres_node.decompressSlices())
+    self.assertEqual(['0@60.slice', '60000@60.slice'],
+                     sorted(f for f in os.listdir(self.ceres_node.fsPath) if 'slice' in f))
+    self.assertEqual(expected, self.ceres_node.read(0, 61000).values)
+
+  def test_read_through_map_pool(self):
+    self.ceres_tree.setSliceMapPoolSize(4)
+    expected = self.ceres_node.read(0, 61000).values
+    self.ceres_node.compressSlices()
+    self.assertEqual(expected, self.ceres_node.read(0, 61000).values)
+
+
+class DataTypeTest(TempTreeTestCase):
+  def write_node(self, dataType, datapoints):
+    node = self.ceres_tree.createNode('metrics.%s' % dataType, timeStep=60, dataType=dataType)
+    node.write(datapoints)
+    return self.ceres_tree.getNode(node.nodePath)  # reloads metadata
+
+  def test_default_is_float64(self):
+    node = self.write_node('float64', [(0, 1.5)])
+    self.assertEqual(8, os.path.getsize(list(node.slices)[0].fsPath))
+
+  def test_invalid_data_type(self):
+    self.assertRaises(ValueError, self.ceres_tree.createNode, 'metrics.foo', dataType='int8')
+    self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'metrics', 'foo')))
+
+  def test_float32(self):
+    node = self.write_node('float32', [(0, 1.5), (60, 0.1)])
+    node.write([(180, 1e300)])
+    slice = list(node.slices)[0]
+    self.assertEqual(16, os.path.getsize(slice.fsPath))
+    self.assertEqual(240, slice.endTime)
+    values = node.read(0, 240).values
+    self.assertEqual([1.5, None, float('inf')], [values[0], values[2], values[3]])
+    self.assertAlmostEqual(0.1, values[1], places=6)
+
+  def test_int64(self):
+    node = self.write_node('int64', [(0, 2 ** 53 + 1)])
+    node.write([(120, 7.0)])
+    self.assertEqual([2 ** 53 + 1, None, 7], node.read(0, 180).values)
+    array = node.read(0, 180, asArray=True).values
+    self.assertEqual(7.0, array[2])
+    self.assertTrue(isnan(array[1]))
+
+  @patch('ceres.fallocate', None)
+  def test_delete_before(self):
+    node = self.write_node('float32', [(i * 60, float(i)) for i in range(10)])
+    slice = list(node.slices)[0]
+    slice.deleteBefore(300)
+    slice = list(node.slices)[0]
+    self.assertEqual((300, 600), (slice.startTime, slice.endTime))
+    self.assertEqual([5.0, 6.0, 7.0, 8.0, 9.0], node.read(300, 600).values)
+
+  def test_compressed_float32(self):
+    node = self.write_node('float32', [(i * 60, float(i % 4)) for i in range(300)])
+    node.write([(30000, 1.0)])
+    node.compressSlices()
+    self.assertEqual([float(i % 4) for i in range(300)], node.read(0, 18000).values)
+    node.write([(18000, 2.0)])
+    self.assertEqual([3.0, 2.0], node.read(17940, 18060).values)
+
+
+# trimmed slices are copied down and renamed, however little is dropped
+@patch('ceres.fallocate', None)
+class RollupTest(TempTreeTestCase):
+  def setUp(self):
+    super(RollupTest, self).setUp()
+    for nodePath in ('metrics.a', 'metrics.b'):
+      node = self.ceres_tree.createNode(nodePath, timeStep=60, retentions=[[60, 10], [300, 12]])
+      node.write([(t, float(t / 60)) for t in range(0, 6000, 60)])
+
+  def check_rolled_up(self, nodePath):
+    node = self.ceres_tree.getNode(nodePath)
+    self.assertEqual([(300, 2400), (60, 5400)],
+                     sorted(((s.timeStep, s.startTime) for s in node.slices), reverse=True))
+    series = node.read(0, 6000)
+    self.assertEqual((0, 300), (series.startTime, series.timeStep))
+    self.assertEqual([None] * 8 + [float(5 * k + 2) for k in range(8, 20)], series.values)
+
+  def test_node_rollup(self):
+    node = self.ceres_tree.getNode('metrics.a')
+    self.assertEqual(18, node.rollup(now=6000))
+    self.check_rolled_up('metrics.a')
+
+  def test_node_rollup_is_repeatable(self):
+    node = self.ceres_tree.getNode('metrics.a')
+    node.rollup(now=6000)
+    self.assertEqual(0, node.rollup(now=6000))
+    self.check_rolled_up('metrics.a')
+
+  def test_read_after_rollup_and_trim(self):
+    node = self.ceres_tree.createNode('metrics.sum', timeStep=60, retentions=[[60, 10], [300, 12]],
+                                      aggregationMethod='sum')
+    node.write([(t, float(t / 60)) for t in range(0, 6000, 60)])
+    node.rollup(now=6000)
+    node.deleteBefore(5460, 60)
+    self.assertEqual([(300, 2400), (60, 5460)],
+                     sorted(((s.timeStep, s.startTime) for s in node.slices), reverse=True))
+    series = node.read(2400, 6000)
+    self.assertEqual((2400, 300), (series.startTime, series.timeStep))
+    # minutes 91-94 and 95-99 of the fine slice
+    self.assertEqual([float(25 * k + 10) for k in range(8, 18)] + [370.0, 485.0], series.values)
+    self.assertEqual(series.values, list(node.read(2400, 6000, asArray=True).values))
+
+  def test_node_without_retentions(self):
+    node = self.ceres_tree.createNode('metrics.c', timeStep=60)
+    node.write([(0, 1.0)])
+    self.assertEqual(0, node.rollup(now=10 ** 9))
+    self.assertEqual(1, len(list(node.slices)))
+
+  def test_tree_rollup_in_parallel(self):
+    results = self.ceres_tree.rollup(processes=2, now=6000)
+    self.assertEqual({'metrics.a': 18, 'metrics.b': 18}, results)
+    self.check_rolled_up('metrics.a')
+    self.check_rolled_up('metrics.b')
+
+  def test_tree_rollup_resumes_from_checkpoint(self):
+    checkpoint = os.path.join(self.tmpdir, 'rollup.checkpoint')
+    with open(checkpoint, 'w') as fh:
+      fh.write('metrics.a\n')
+    self.assertEqual(['metrics.b'], self.ceres_tree.rollup(checkpoint=checkpoint, now=6000).keys())
+    self.assertFalse(os.path.exists(checkpoint))
+    self.assertEqual(1, len(list(self.ceres_tree.getNode('metrics.a').slices)))
+
+  def test_failed_nodes_are_not_checkpointed(self):
+    checkpoint = os.path.join(self.tmpdir, 'rollup.checkpoint')
+    error = ValueError('rollup failed')
+
+    def worker(item):
+      if item == 'c':
+        raise KeyboardInterrupt()
+      return item, error if item == 'b' else 1
+
+    self.assertRaises(KeyboardInterrupt, self.ceres_tree.runWorkers, ['a', 'b', 'c'],
+                      lambda tree: None, (), worker, checkpoint=checkpoint)
+    with open(checkpoint) as fh:
+      self.assertEqual(['a'], fh.read().split())
+    results = self.ceres_tree.runWorkers(['a', 'b'], lambda tree: None, (), worker,
+                                         checkpoint=checkpoint)
+    self.assertEqual({'b': error}, results)
+
+
+class DefragmentTest(TempTreeTestCase):
+  def setUp(self):
+    super(DefragmentTest, self).setUp()
+    self.ceres_node = self.ceres_tree.createNode('metrics.a', timeStep=60)
+
+  def slice_infos(self):
+    return sorted(self.ceres_node.readSlices())
+
+  def test_merges_adjacent_slices(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0])
+    make_slice(self.ceres_node, 300, [3.0])
+    make_slice(self.ceres_node, 600, [4.0])
+    expected = list(self.ceres_node.read(0, 720))
+    self.assertEqual(2, self.ceres_node.defragment(includeLatest=True))
+    self.assertEqual([(0, 60)], self.slice_infos())
+    self.assertEqual(expected, list(self.ceres_node.read(0, 720)))
+
+  def test_leaves_latest_slice(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0])
+    make_slice(self.ceres_node, 300, [3.0])
+    make_slice(self.ceres_node, 600, [4.0])
+    self.assertEqual(1, self.ceres_node.defragment())
+    self.assertEqual([(0, 60), (600, 60)], self.slice_infos())
+
+  def test_respects_max_gap(self):
+    make_slice(self.ceres_node, 0, [1.0])
+    make_slice(self.ceres_node, 600, [2.0])
+    make_slice(self.ceres_node, 660, [3.0])
+    self.assertEqual(1, self.ceres_node.defragment(maxGap=5, includeLatest=True))
+    self.assertEqual([(0, 60), (600, 60)], self.slice_infos())
+
+  def test_later_slice_wins_where_overlapping(self):
+    make_slice(self.ceres_node, 0, [1.0, 2.0, 3.0, 4.0])
+    make_slice(self.ceres_node, 60, [20.0, None])
+    self.assertEqual(1, self.ceres_node.defragment(includeLatest=True))
+    self.assertEqual([1.0, 20.0, 3.0, 4.0], self.ceres_node.read(0, 240).values)
+
+  def test_keeps_slices_another_timestep_starts_between(self):
+    make_slice(self.ceres_node, 0, [1.0])
+    make_slice(self.ceres_node, 120, [2.0], timeStep=120)
+    make_slice(self.ceres_node, 300, [3.0])
+    make_slice(self.ceres_node, 6000, [4.0])
+    self.assertEqual(0, self.ceres_node.defragment())
+    self.assertEqual(4, len(self.slice_infos()))
+
+  def test_tree_defragment_in_parallel(self):
+    other = self.ceres_tree.createNode('metrics.b', timeStep=60)
+    for node in (self.ceres_node, other):
+      make_slice(node, 0, [1.0])
+      make_slice(node, 120, [2.0])
+      make_slice(node, 600, [3.0])
+    results = self.ceres_tree.defragment(processes=2)
+    self.assertEqual({'metrics.a': 1, 'metrics.b': 1}, results)
+    self.assertEqual([(0, 60), (600, 60)], self.slice_infos())
+
+
+class SliceRotationTest(TempTreeTestCase):
+  def setUp(self):
+    super(SliceRotationTest, self).setUp()
+    self.ceres_tree.setMaxSlicePoints(10)
+    self.ceres_node = self.ceres_tree.createNode('metrics.a', timeStep=60)
+
+  def slice_infos(self, node=None):
+    return sorted((node or self.ceres_node).readSlices())
+
+  def test_write_starts_slices_at_span_boundaries(self):
+    self.ceres_node.write([(t, 1.0) for t in range(300, 1500, 60)])
+    self.ceres_node.write([(t, 2.0) for t in range(1500, 1800, 60)])
+    self.assertEqual([(300, 60), (600, 60), (1200, 60)], self.slice_infos())
+    self.assertEqual([1.0] * 20 + [2.0] * 5, self.ceres_node.read(300, 1800).values)
+
+  def test_node_metadata_overrides_tree(self):
+    node = self.ceres_tree.createNode('metrics.b', timeStep=60, maxSlicePoints=5)
+    node.write([(t, 1.0) for t in range(0, 600, 60)])
+    self.assertEqual([(0, 60), (300, 60)], self.slice_infos(node))
+
+  def test_expired_slices_are_unlinked(self):
+    self.ceres_node.write([(t, 1.0) for t in range(0, 1800, 60)])
+    self.ceres_node.deleteBefore(1200)
+    self.assertEqual([(1200, 60)], self.slice_infos())
+
+  def test_invalid_max_slice_points(self):
+    self.assertRaises(ValueError, self.ceres_tree.setMaxSlicePoints, 0)
+
+  def test_worker_processes_use_tree_settings(self):
+    self.ceres_tree.setStoreProcesses(2)
+    try:
+      self.ceres_tree.storeMany({'metrics.a': [(t, 1.0) for t in range(300, 1500, 60)]})
+    finally:
+      self.ceres_tree.setStoreProcesses(0)
+    self.assertEqual([(300, 60), (600, 60), (1200, 60)], self.slice_infos())
+
+    node = self.ceres_tree.createNode('metrics.b', timeStep=60)
+    self.ceres_tree.mapNodes('write', ([(t, 1.0) for t in range(300, 1500, 60)],),
+                             nodePattern='metrics.b', processes=2)
+    self.assertEqual([(300, 60), (600, 60), (1200, 60)], self.slice_infos(node))
+
+  def test_write_before_slices_keeps_existing_data(self):
+    self.ceres_tree.setMaxSlicePoints(None)
+    self.ceres_node.write([(960, 6.0)])
+    self.ceres_node.write([(540, 6.0), (600, 9.0)])
+    self.ceres_node.write([(540, 9.0)])
+    self.assertEqual([9.0, 9.0], self.ceres_node.read(540, 660).values)
+
+
+class InstrumentationTest(TempTreeTestCase):
+  def setUp(self):
+    super(InstrumentationTest, self).setUp()
+    self.ceres_tree.setInstrumentation()
+    self.ceres_tree.createNode('a.b', timeStep=60)
+
+  def test_disabled_by_default(self):
+    self.assertEqual(None, CeresTree(self.tmpdir).stats())
+
+  def test_counts_filesystem_operations(self):
+    self.ceres_tree.store('a.b', [(t, 1.0) for t in range(600, 1200, 60)])
+    self.ceres_tree.fetch('a.b', 600, 1200)
+    counters = self.ceres_tree.stats()['counters']
+    self.assertEqual(80, counters['bytesWritten'])
+    self.assertEqual(80, counters['bytesRead'])
+    self.assertTrue(counters['listdir'] >= 2)
+    self.assertTrue(counters['open'] >= 2)
+    self.assertTrue(counters['stat'] >= 2)
+
+  def test_times_operations(self):
+    self.ceres_tree.store('a.b', [(600, 1.0)])
+    self.ceres_tree.fetch('a.b', 600, 1200)
+    self.assertEqual(['a.b'], [node.nodePath for node in self.ceres_tree.find('a.*')])
+    self.ceres_tree.getNode('a.b').deleteBefore(660)
+    latencies = self.ceres_tree.stats()['latencies']
+    for operation in ('fetch', 'find', 'store', 'write', 'deleteBefore'):
+      self.assertEqual(1, latencies[operation]['count'], operation)
+      self.assertEqual(1, sum(count for bound, count in latencies[operation]['buckets']))
+      self.assertEqual(None, latencies[operation]['buckets'][-1][0])
+
+  def test_emitter_sends_interval_activity(self):
+    sink = Mock()
+    emitter = StatsEmitter(self.ceres_tree.instrumentation, sink, prefix='ceres.test')
+    self.ceres_tree.instrumentation.record('fetch', 0.003)
+    self.ceres_tree.instrumentation.count('open', 2)
+    lines = emitter.emit(now=100)
+    self.assertTrue('ceres.test.open 2 100' in lines)
+    self.assertTrue('ceres.test.latency.fetch.count 1 100' in lines)
+    self.assertTrue('ceres.test.latency.fetch.p50 0.005000 100' in lines)
+    self.assertFalse([line for line in lines if '.latency.store.' in line])
+    sink.send.assert_called_once_with(''.join(line + '\n' for line in lines))
+    self.assertTrue('ceres.test.open 0 160' in emitter.emit(now=160))
+
+
+class ImportWhisperTest(TempTreeTestCase):
+  def setUp(self):
+    import whisper
+    self.whisper = whisper
+    super(ImportWhisperTest, self).setUp()
+    self.whisper_root = os.path.join(self.tmpdir, 'whisper')
+    os.makedirs(os.path.join(self.whisper_root, 'a'))
+    self.now = 1400000100
+    self.wsp_path = os.path.join(self.whisper_root, 'a', 'b.wsp')
+    whisper.create(self.wsp_path, [(60, 10), (300, 10)], aggregationMethod='max')
+    whisper.update_many(self.wsp_path, [(self.now - i * 60, float(i)) for i in range(50)],
+                        now=self.now)
+
+  def make_tree(self, root):
+    self.ceres_root = os.path.join(root, 'ceres')
+    return CeresTree.createTree(self.ceres_root)
+
+  def test_archives_are_written_at_their_own_timeStep(self):
+    results = self.ceres_tree.importWhisper(self.whisper_root, now=self.now)
+    node = self.ceres_tree.getNode('a.b')
+    metadata = node.readMetadata()
+    self.assertEqual([[60, 10], [300, 10]], metadata['retentions'])
+    self.assertEqual('max', metadata['aggregationMethod'])
+    # the finer archive takes over at the first 300s boundary of its retention
+    self.assertEqual([(self.now - 2700, self.now - 300, 300), (self.now - 300, self.now + 60, 60)],
+                     sorted((s.startTime, s.endTime, s.timeStep) for s in node.slices))
+    self.assertEqual({'a/b.wsp': 14}, results)
+
+    (start, end, step), values = self.whisper.fetch(self.wsp_path, self.now - 360, self.now,
+                                                    now=self.now)
+    self.assertEqual(values, node.read(start, end).values)
+
+  def test_checkpoint_skips_imported_files(self):
+    checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+    with open(checkpoint, 'w') as fh:
+      fh.write('a/b.wsp\n')
+    self.assertEqual({}, self.ceres_tree.importWhisper(self.whisper_root, checkpoint=checkpoint,
+                                                       now=self.now))
+    self.assertFalse(self.ceres_tree.hasNode('a.b'))
+    self.assertFalse(os.path.exists(checkpoint))
+
+  def test_reimport_writes_same_datapoints(self):
+    importWhisperFile(self.ceres_tree, self.wsp_path, 'a.b', now=self.now)
+    first = self.ceres_tree.fetch('a.b', self.now - 3000, self.now).values
+    importWhisperFile(self.ceres_tree, self.wsp_path, 'a.b', now=self.now)
+    self.assertEqual(first, self.ceres_tree.fetch('a.b', self.now - 3000, self.now).values)